@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+
+"""
+Benchmark of ldapuser commands against an in-process fake directory
+
+For every directory size a tree of users, each with its primary group, and
+of supplementary groups is generated in memory (see fakeldap.py). Every
+command then runs in process against it and reports its mean wall time and,
+for the last run, the number of LDAP requests (round trips) and the
+approximate bytes of entries and modifications exchanged.
+
+Usage: commands.py [--users SIZES] [--groups N] [--group-size N] [--runs N]
+                   [--max-round-trips N]
+
+Options:
+--users SIZES           Comma separated directory sizes [default: 1000,10000]
+--groups N              Supplementary groups [default: 50]
+--group-size N          Members of each supplementary group [default: 500]
+--runs N                Runs per command [default: 3]
+--max-round-trips N     Fail when a command needs more round trips than N
+"""
+
+from docopt import docopt
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+
+import fakeldap
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+BASEDN = 'dc=example,dc=com'
+USERS = 'ou=Users,' + BASEDN
+GROUPS = 'ou=Groups,' + BASEDN
+FIRST_ID = 10000
+
+CONFIG = '''
+[ldap]
+server = ldap://fake
+binddn = cn=Manager,%(base)s
+bindpw = secret
+pagesize = 500
+
+[user]
+basedn = %(users)s
+minuid = %(first)d
+maxuid = %(last)d
+
+[group]
+basedn = %(groups)s
+mingid = %(first)d
+maxgid = %(last)d
+'''
+
+# (name, arguments), the run number is substituted for %(run)d
+COMMANDS = [
+    ('user show <user>', ['user', 'show', 'user000001']),
+    ('user show', ['user', 'show']),
+    ('user show --ndjson', ['user', 'show', '--ndjson']),
+    ('user create', ['user', 'create', 'bench%(run)d']),
+    ('user create --group x3', ['user', 'create', '--group', 'group0001', '--group', 'group0002',
+                                '--group', 'group0003', 'benchg%(run)d']),
+    ('user update --group x3', ['user', 'update', '--group', 'group0001', '--group', 'group0002',
+                                '--group', 'group%(run)04d', 'user000002']),
+    ('group show <group>', ['group', 'show', 'group0001']),
+    ('group member --add', ['group', 'member', '--add', 'user%(run)06d', 'group0005']),
+    ('group member --del', ['group', 'member', '--del', 'user%(run)06d', 'group0005']),
+    ('group create', ['group', 'create', 'benchgroup%(run)d']),
+    ('check', ['check']),
+]
+
+
+def generate(directory, users, groups, group_size):
+    """
+    Fill directory with users, their primary groups and supplementary groups
+    """
+    for dn, name in ((BASEDN, 'example'), (USERS, 'Users'), (GROUPS, 'Groups')):
+        directory.add(dn, {'objectClass': ['top', 'organizationalUnit'], 'ou': [name]})
+    names = ['user%06d' % i for i in range(users)]
+    for i, name in enumerate(names):
+        number = str(FIRST_ID + i)
+        directory.add('uid=%s,%s' % (name, USERS), {
+            'objectClass': ['top', 'inetOrgPerson', 'posixAccount', 'shadowAccount',
+                            'hostObject', 'ldapPublicKey'],
+            'cn': [name], 'sn': [name], 'uid': [name],
+            'uidNumber': [number], 'gidNumber': [number],
+            'homeDirectory': ['/home/' + name], 'loginShell': ['/bin/bash'],
+            'mail': [name + '@example.com'], 'userPassword': ['{SSHA}' + 'x' * 32],
+            'sshPublicKey': ['ssh-rsa ' + 'A' * 372], 'host': ['web%02d' % (i % 20)]})
+        directory.add('cn=%s,%s' % (name, GROUPS), {
+            'objectClass': ['top', 'posixGroup'], 'cn': [name], 'gidNumber': [number]})
+    rand = random.Random(users)
+    for j in range(groups):
+        name = 'group%04d' % j
+        directory.add('cn=%s,%s' % (name, GROUPS), {
+            'objectClass': ['top', 'posixGroup'], 'cn': [name],
+            'gidNumber': [str(FIRST_ID + users + j)],
+            'memberUid': rand.sample(names, min(group_size, users))})
+
+
+def benchmark(size, args, config):
+    directory = fakeldap.FakeDirectory()
+    fakeldap.install(directory)
+    import ldapuser
+    ldapuser.CONFIG = config
+    ldapuser.ch.stream = open(os.devnull, 'w')
+
+    generate(directory, size, int(args['--groups']), int(args['--group-size']))
+    with open(config, 'w') as f:
+        f.write(CONFIG % {'base': BASEDN, 'users': USERS, 'groups': GROUPS,
+                          'first': FIRST_ID, 'last': FIRST_ID + 4 * size})
+
+    max_round_trips = args['--max-round-trips'] and int(args['--max-round-trips'])
+    failed = False
+    stdout = sys.stdout
+    print "\n%d users, %d entries" % (size, len(directory.entries))
+    print "%-28s %10s %12s %12s" % ('command', 'mean ms', 'round trips', 'kbytes')
+    for name, argv in COMMANDS:
+        timings = []
+        for run in range(1, int(args['--runs']) + 1):
+            directory.reset()
+            start = time.time()
+            sys.stdout = open(os.devnull, 'w')
+            status = 0
+            try:
+                ldapuser.run([arg % {'run': run} for arg in argv])
+            except SystemExit as e:
+                status = e.code
+            finally:
+                sys.stdout = stdout
+            if status:
+                print "FAIL %s: exit status %s" % (name, status)
+                failed = True
+            timings.append((time.time() - start) * 1000)
+        print "%-28s %10.1f %12d %12.1f" % (name, sum(timings) / len(timings),
+                                            directory.round_trips, directory.bytes / 1024.0)
+        if max_round_trips and directory.round_trips > max_round_trips:
+            print "FAIL %s: %d round trips over the limit of %d" % (name, directory.round_trips,
+                                                                    max_round_trips)
+            failed = True
+    return failed
+
+
+def main():
+    args = docopt(__doc__)
+    logging.disable(logging.WARNING)
+    config = tempfile.NamedTemporaryFile(suffix='.conf', delete=False).name
+    failed = False
+    try:
+        for size in args['--users'].split(','):
+            failed = benchmark(int(size), args, config) or failed
+    finally:
+        os.unlink(config)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,338 @@
+"""
+In-process stand-in for python-ldap used by the benchmarks
+
+install() registers fake ldap, ldap.controls and ldap.filter modules whose
+connections all talk to one FakeDirectory held in memory. The directory
+counts the requests it receives (round trips) and the approximate size of
+the entries and modifications exchanged, so commands can be compared
+without a server. Only the parts of python-ldap used by ldapuser are
+implemented: simple filters, base/onelevel/subtree scopes, the Simple
+Paged Results control and the synchronous and message id APIs.
+"""
+
+import fnmatch
+import re
+import sys
+import types
+
+SCOPE_BASE, SCOPE_ONELEVEL, SCOPE_SUBTREE = 0, 1, 2
+MOD_ADD, MOD_DELETE, MOD_REPLACE = 0, 1, 2
+OPT_NETWORK_TIMEOUT = 0x5005
+RES_ANY = -1
+RES_ADD, RES_MODIFY, RES_DELETE, RES_SEARCH_RESULT = 105, 103, 107, 101
+
+ERRORS = ['SERVER_DOWN', 'NO_SUCH_OBJECT', 'ALREADY_EXISTS', 'TYPE_OR_VALUE_EXISTS',
+          'NO_SUCH_ATTRIBUTE', 'CONSTRAINT_VIOLATION', 'SIZELIMIT_EXCEEDED', 'FILTER_ERROR']
+
+
+class LDAPError(Exception):
+    pass
+
+
+class SimplePagedResultsControl(object):
+    controlType = '1.2.840.113556.1.4.319'
+
+    def __init__(self, criticality=False, size=None, cookie=''):
+        self.criticality = criticality
+        self.size = size
+        self.cookie = cookie
+
+
+def escape_filter_chars(value, escape_mode=0):
+    for char, escaped in (('\\', r'\5c'), ('*', r'\2a'), ('(', r'\28'), (')', r'\29'), ('\x00', r'\00')):
+        value = value.replace(char, escaped)
+    return value
+
+
+def install(directory):
+    """
+    Register the fake modules in sys.modules, serving directory
+
+    Installing again only switches the directory, so the exception classes
+    of modules imported earlier stay valid
+    """
+    if hasattr(sys.modules.get('ldap'), 'directory'):
+        sys.modules['ldap'].directory = directory
+        return sys.modules['ldap']
+    ldap = types.ModuleType('ldap')
+    ldap.directory = directory
+    for name in ('SCOPE_BASE', 'SCOPE_ONELEVEL', 'SCOPE_SUBTREE', 'MOD_ADD', 'MOD_DELETE',
+                 'MOD_REPLACE', 'OPT_NETWORK_TIMEOUT', 'RES_ANY', 'RES_ADD', 'RES_MODIFY',
+                 'RES_DELETE', 'RES_SEARCH_RESULT', 'LDAPError'):
+        setattr(ldap, name, globals()[name])
+    for name in ERRORS:
+        setattr(ldap, name, type(name, (LDAPError,), {}))
+    ldap.initialize = lambda uri: FakeConnection(ldap.directory, ldap)
+    controls = types.ModuleType('ldap.controls')
+    controls.SimplePagedResultsControl = SimplePagedResultsControl
+    filter_module = types.ModuleType('ldap.filter')
+    filter_module.escape_filter_chars = escape_filter_chars
+    ldap.controls = controls
+    ldap.filter = filter_module
+    sys.modules.update([('ldap', ldap), ('ldap.controls', controls), ('ldap.filter', filter_module)])
+    return ldap
+
+
+def parse_filter(filterstr):
+    """
+    Parse an LDAP filter into nested (operator, operands) tuples
+    """
+    filterstr = filterstr.strip()
+    if not filterstr.startswith('('):
+        filterstr = '(' + filterstr + ')'
+    node, position = _parse(filterstr, 0)
+    return node
+
+
+def _parse(filterstr, i):
+    i += 1
+    if filterstr[i] in '&|':
+        operator = filterstr[i]
+        i += 1
+        operands = []
+        while filterstr[i] == '(':
+            node, i = _parse(filterstr, i)
+            operands.append(node)
+        return (operator, operands), i + 1
+    if filterstr[i] == '!':
+        node, i = _parse(filterstr, i + 1)
+        return ('!', node), i + 1
+    end = filterstr.index(')', i)
+    item = filterstr[i:end]
+    for operator in ('>=', '<=', '='):
+        if operator in item:
+            attribute, value = item.split(operator, 1)
+            return (operator, attribute.lower(), value), end + 1
+    raise ValueError("Bad filter item: %s" % item)
+
+
+def _unescape(value):
+    return re.sub(r'\\([0-9a-fA-F]{2})', lambda m: chr(int(m.group(1), 16)), value)
+
+
+def _number(value):
+    try:
+        return int(value)
+    except ValueError:
+        return value
+
+
+def match(node, attributes):
+    """
+    Return whether the lowercased attributes match a parsed filter
+    """
+    operator = node[0]
+    if operator == '&':
+        return all(match(operand, attributes) for operand in node[1])
+    if operator == '|':
+        return any(match(operand, attributes) for operand in node[1])
+    if operator == '!':
+        return not match(node[1], attributes)
+    operator, attribute, value = node
+    values = attributes.get(attribute, [])
+    if operator == '=' and value == '*':
+        return bool(values)
+    if operator == '=' and '*' in value:
+        pattern = '*'.join(_unescape(part) for part in value.split('*')).lower()
+        return any(fnmatch.fnmatchcase(v.lower(), pattern) for v in values)
+    value = _unescape(value)
+    if operator == '>=':
+        return any(_number(v) >= _number(value) for v in values)
+    if operator == '<=':
+        return any(_number(v) <= _number(value) for v in values)
+    return any(v.lower() == value.lower() for v in values)
+
+
+class FakeDirectory(object):
+    """
+    Entries held in memory with request and traffic counters
+    """
+    def __init__(self):
+        # normalized dn -> (dn, attributes)
+        self.entries = {}
+        self.lowered = {}
+        self.round_trips = 0
+        self.bytes = 0
+        self.operations = {}
+
+    def norm(self, dn):
+        return ','.join(part.strip() for part in dn.lower().split(','))
+
+    def add(self, dn, attributes):
+        self.entries[self.norm(dn)] = (dn, dict((k, list(v)) for k, v in attributes.items()))
+        self.update(self.norm(dn))
+
+    def update(self, key):
+        # attributes by lowercased name, for filter matching
+        dn, attributes = self.entries[key]
+        self.lowered[key] = dict((k.lower(), v) for k, v in attributes.iteritems())
+
+    def count(self, operation, size=0):
+        self.round_trips += 1
+        self.bytes += size
+        self.operations[operation] = self.operations.get(operation, 0) + 1
+
+    def reset(self):
+        self.round_trips = 0
+        self.bytes = 0
+        self.operations = {}
+
+
+def _size(dn, attributes):
+    return len(dn) + sum(len(k) + sum(len(v) for v in values) for k, values in attributes)
+
+
+class FakeConnection(object):
+    """
+    LDAPObject stand-in, asynchronous requests complete immediately
+    """
+    def __init__(self, directory, ldap):
+        self.directory = directory
+        self.ldap = ldap
+        self.msgid = 0
+        self.results = {}
+        # paged search cookie -> remaining entries
+        self.pages = {}
+
+    def set_option(self, option, value):
+        pass
+
+    def simple_bind_s(self, who='', cred=''):
+        self.directory.count('bind', len(who) + len(cred))
+
+    def whoami_s(self):
+        self.directory.count('whoami')
+        return 'dn:'
+
+    def unbind_s(self):
+        pass
+
+    def _find(self, base, scope, filterstr, attrlist):
+        entries = self.directory.entries
+        base = self.directory.norm(base)
+        if base not in entries:
+            raise self.ldap.NO_SUCH_OBJECT({'desc': 'No such object'})
+        if scope == SCOPE_BASE:
+            keys = [base]
+        else:
+            suffix = ',' + base
+            keys = [key for key in entries if key.endswith(suffix) and
+                    (scope == SCOPE_SUBTREE or ',' not in key[:-len(suffix)])]
+            if scope == SCOPE_SUBTREE:
+                keys.append(base)
+        node = parse_filter(filterstr or '(objectClass=*)')
+        wanted = attrlist and '*' not in attrlist and set(a.lower() for a in attrlist)
+        found = []
+        for key in sorted(keys):
+            dn, attributes = entries[key]
+            if not match(node, self.directory.lowered[key]):
+                continue
+            found.append((dn, dict((k, list(v)) for k, v in attributes.iteritems()
+                                   if not wanted or k.lower() in wanted)))
+        return found
+
+    def _result(self, result):
+        self.msgid += 1
+        self.results[self.msgid] = result
+        return self.msgid
+
+    def search_ext(self, base, scope, filterstr='(objectClass=*)', attrlist=None, attrsonly=0,
+                   serverctrls=None, clientctrls=None, timeout=-1, sizelimit=0):
+        page = [c for c in serverctrls or [] if isinstance(c, SimplePagedResultsControl)]
+        try:
+            if page and page[0].cookie:
+                found = self.pages.pop(page[0].cookie)
+            else:
+                found = self._find(base, scope, filterstr, attrlist)
+        except LDAPError as e:
+            self.directory.count('search')
+            return self._result(e)
+        controls = []
+        if page:
+            found, rest = found[:page[0].size], found[page[0].size:]
+            cookie = ''
+            if rest:
+                cookie = str(len(self.pages) + self.msgid + 1)
+                self.pages[cookie] = rest
+            controls.append(SimplePagedResultsControl(False, 0, cookie))
+        self.directory.count('search', sum(_size(dn, a.items()) for dn, a in found))
+        return self._result((RES_SEARCH_RESULT, found, None, controls))
+
+    def search_s(self, base, scope, filterstr='(objectClass=*)', attrlist=None, attrsonly=0):
+        return self.result3(self.search_ext(base, scope, filterstr, attrlist))[1]
+
+    def result3(self, msgid=RES_ANY, all=1, timeout=None):
+        if msgid == RES_ANY:
+            msgid = min(self.results)
+        result = self.results.pop(msgid)
+        if isinstance(result, Exception):
+            raise result
+        return result[0], result[1], msgid, result[3]
+
+    def result(self, msgid=RES_ANY, all=1, timeout=None):
+        return self.result3(msgid, all, timeout)[:3]
+
+    def _write(self, operation, rtype, size, function, *args):
+        self.directory.count(operation, size)
+        try:
+            function(*args)
+        except LDAPError as e:
+            return self._result(e)
+        return self._result((rtype, [], None, []))
+
+    def add(self, dn, modlist):
+        return self._write('add', RES_ADD, _size(dn, modlist), self._add, dn, modlist)
+
+    def add_s(self, dn, modlist):
+        return self.result(self.add(dn, modlist))
+
+    def _add(self, dn, modlist):
+        if self.directory.norm(dn) in self.directory.entries:
+            raise self.ldap.ALREADY_EXISTS({'desc': 'Already exists'})
+        self.directory.add(dn, dict((k, [v] if isinstance(v, basestring) else v) for k, v in modlist))
+
+    def modify(self, dn, modlist):
+        return self._write('modify', RES_MODIFY, _size(dn, [(a, v or []) for op, a, v in modlist]),
+                           self._modify, dn, modlist)
+
+    def modify_s(self, dn, modlist):
+        return self.result(self.modify(dn, modlist))
+
+    def _modify(self, dn, modlist):
+        key = self.directory.norm(dn)
+        if key not in self.directory.entries:
+            raise self.ldap.NO_SUCH_OBJECT({'desc': 'No such object'})
+        dn, attributes = self.directory.entries[key]
+        attributes = dict((k, list(v)) for k, v in attributes.items())
+        names = dict((k.lower(), k) for k in attributes)
+        for operation, attribute, values in modlist:
+            if isinstance(values, basestring):
+                values = [values]
+            attribute = names.get(attribute.lower(), attribute)
+            current = attributes.get(attribute, [])
+            if operation == MOD_ADD:
+                if [v for v in values if v in current]:
+                    raise self.ldap.TYPE_OR_VALUE_EXISTS({'desc': 'Type or value exists'})
+                attributes[attribute] = current + list(values)
+            elif operation == MOD_DELETE:
+                if values is None:
+                    values = current
+                if not current or [v for v in values if v not in current]:
+                    raise self.ldap.NO_SUCH_ATTRIBUTE({'desc': 'No such attribute'})
+                attributes[attribute] = [v for v in current if v not in values]
+            else:
+                attributes[attribute] = list(values or [])
+            if not attributes[attribute]:
+                del attributes[attribute]
+        self.directory.entries[key] = (dn, attributes)
+        self.directory.update(key)
+
+    def delete(self, dn):
+        return self._write('delete', RES_DELETE, len(dn), self._delete, dn)
+
+    def delete_s(self, dn):
+        return self.result(self.delete(dn))
+
+    def _delete(self, dn):
+        if self.directory.entries.pop(self.directory.norm(dn), None) is None:
+            raise self.ldap.NO_SUCH_OBJECT({'desc': 'No such object'})
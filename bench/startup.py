@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+
+"""
+Startup benchmark for the ldapuser help and usage paths
+
+Every case runs in a fresh interpreter with networking disabled and the
+python-ldap modules blocked from importing, so a case fails when printing
+help or a usage error reads the configuration, connects or imports ldap.
+
+Usage: startup.py [--runs N] [--max-ms MS]
+
+Options:
+--runs N        Runs per case [default: 10]
+--max-ms MS     Fail when the mean time of a case exceeds MS milliseconds
+"""
+
+from docopt import docopt
+import os
+import subprocess
+import sys
+import time
+
+LDAPUSER = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'ldapuser.py')
+
+GUARD = '''
+import socket
+import sys
+
+def refuse(*args, **kwargs):
+    raise AssertionError('network access during startup')
+
+socket.socket = socket.create_connection = refuse
+
+
+class Blocker(object):
+    def find_module(self, name, path=None):
+        if name.split('.')[0] in ('ldap', '_ldap', 'ldif', 'ldapurl'):
+            return self
+
+    def load_module(self, name):
+        raise AssertionError('%%s imported during startup' %% name)
+
+sys.meta_path.insert(0, Blocker())
+sys.argv = ['ldapuser'] + %r
+execfile(%r, {'__name__': '__main__'})
+'''
+
+# (arguments, expected exit status)
+CASES = [
+    (['help'], 0),
+    (['--version'], 0),
+    (['--help'], 0),
+    (['user'], 0),
+    (['group'], 0),
+    (['help', 'user', 'create'], 0),
+    (['help', 'import'], 0),
+    (['import'], 0),
+    (['user', 'create'], 1),
+    (['group', 'member', '--bogus', 'x'], 1),
+    (['nosuchcommand'], 0),
+]
+
+
+def run_case(argv):
+    start = time.time()
+    process = subprocess.Popen([sys.executable, '-c', GUARD % (argv, LDAPUSER)],
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout, stderr = process.communicate()
+    return time.time() - start, process.returncode, stderr
+
+
+def main():
+    args = docopt(__doc__)
+    runs = int(args['--runs'])
+    max_ms = float(args['--max-ms']) if args['--max-ms'] else None
+
+    failed = False
+    print "%-40s %10s %10s" % ('case', 'mean ms', 'min ms')
+    for argv, status in CASES:
+        timings = []
+        for i in range(runs):
+            elapsed, returncode, stderr = run_case(argv)
+            if returncode != status or 'AssertionError' in stderr:
+                print "FAIL %s: exit status %s\n%s" % (' '.join(argv), returncode, stderr)
+                failed = True
+                break
+            timings.append(elapsed * 1000)
+        else:
+            mean = sum(timings) / len(timings)
+            print "%-40s %10.1f %10.1f" % (' '.join(argv), mean, min(timings))
+            if max_ms and mean > max_ms:
+                print "FAIL %s: %.1f ms over the %.1f ms limit" % (' '.join(argv), mean, max_ms)
+                failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,12 +3,33 @@
 """
 The ldapuser command-line client issues calls to a LDAP servers.
 
-Usage: ldapuser <command> [<args>...]
+Usage: ldapuser [--profile] [--stats TARGET] [--cached] <command> [<args>...]
+
+Options:
+  --profile         Print a summary of the LDAP requests made when done
+  --stats TARGET    Send request statistics to TARGET: a file appended to as
+                    JSON lines or udp://host:port for StatsD
+  --cached          Read users and groups from the local snapshot in
+                    read-only commands, see ``ldapuser help sync``
 
 Subcommands, use ``ldapuser help [subcommand]`` to learn more::
 
   user          manage users
   group         manage groups
+  host          show who has access to hosts
+  import        bulk import users and groups
+  export        export users and groups to LDIF
+  diff          compare exports with each other or the directory
+  export-maps   write passwd, group and shadow files for a host
+  keys          print the SSH public keys of a user, for sshd
+  sync          refresh the local snapshot read by --cached
+  plan          show the changes bringing the directory to a desired state
+  apply         bring the directory to a desired state
+  check         report and repair inconsistent users and groups
+  serve         serve commands over a local socket
+
+From Python, ``ldapuser.Directory`` offers the same operations returning
+User and Group objects, ``ldapuser.AsyncDirectory`` runs them concurrently.
 
 """
 
@@ -19,12 +40,54 @@ from docopt import DocoptExit
 from string import ascii_lowercase, ascii_uppercase, digits
 from ConfigParser import ConfigParser, NoOptionError, NoSectionError
 from random import choice
+from itertools import chain, islice
+from collections import deque
+from fnmatch import fnmatchcase
 import os
 import sys
-import ldap
-import hashlib
+import importlib
 import base64
+import csv
+import heapq
+import json
 import logging
+import marshal
+import Queue
+import re
+import select
+import signal
+import socket
+import SocketServer
+import tempfile
+import threading
+import time
+
+class LazyModule(object):
+    """
+    Module imported on first attribute access
+
+    Keeps the import cost of python-ldap and friends off the help and usage
+    paths. submodules are imported along with the module
+    """
+    def __init__(self, name, submodules=()):
+        self._name = name
+        self._submodules = submodules
+        self._module = None
+
+    def __getattr__(self, attribute):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+            for submodule in self._submodules:
+                importlib.import_module(submodule)
+        return getattr(self._module, attribute)
+
+
+ldap = LazyModule('ldap', ['ldap.controls', 'ldap.filter'])
+ldif = LazyModule('ldif')
+gzip = LazyModule('gzip')
+hashlib = LazyModule('hashlib')
+sqlite3 = LazyModule('sqlite3')
+ldap_syncrepl = LazyModule('ldap.syncrepl')
 
 # logger settings
 logging.basicConfig(level=logging.INFO)
@@ -39,134 +102,2715 @@ logger.addHandler(ch)
 # ldapuser configuration file
 CONFIG = '/etc/ldapuser/ldapuser.conf'
 
+# socket used by `ldapuser serve` unless configured otherwise
+DEFAULT_SOCKET = '/var/run/ldapuser/ldapuser.sock'
+
+# attributes read for the passwd, group and shadow maps
+MAP_ATTRIBUTES = dict([
+    ('user', ['uidNumber', 'gidNumber', 'givenName', 'homeDirectory', 'loginShell', 'userPassword',
+              'shadowLastChange', 'shadowMin', 'shadowMax', 'shadowWarning', 'shadowInactive',
+              'shadowExpire', 'modifyTimestamp']),
+    ('group', ['gidNumber', 'memberUid', 'member', 'modifyTimestamp']),
+])
+
+# ID kind -> (config section, attribute, objectClass)
+ID_POOLS = dict([
+    ('uid', ('user', 'uidNumber', 'posixAccount')),
+    ('gid', ('group', 'gidNumber', 'posixGroup')),
+])
+
+# attempts at moving the ID counter before giving up
+ALLOCATE_RETRIES = 10
+
+# seconds a server that went down is skipped before being tried again
+FAILED_SERVER_DELAY = 30
+
+
+class LdapUserError(Exception):
+    """
+    Base class of the errors raised by Directory
+    """
+
+
+class ConfigError(LdapUserError):
+    """
+    The configuration is missing or invalid
+    """
+
+
+class NoSuchUser(LdapUserError):
+    pass
+
+
+class NoSuchGroup(LdapUserError):
+    pass
+
+
+class AlreadyExists(LdapUserError):
+    pass
+
+
+class PartialFailure(LdapUserError):
+    """
+    Some of the steps of an operation failed
+
+    result is what the operation returns and errors lists ((kind, name),
+    error) pairs for the failed steps
+    """
+    def __init__(self, message, result, errors):
+        LdapUserError.__init__(self, message)
+        self.result = result
+        self.errors = errors
+
+
+class InvalidId(LdapUserError):
+    """
+    A UID or GID is out of range or already in use
+    """
+
+
+class Entry(object):
+    """
+    A directory entry: its name (uid or cn), DN and attributes
+
+    attributes maps attribute names to lists of values as returned by
+    python-ldap
+    """
+    def __init__(self, name, dn, attributes):
+        self.name = name
+        self.dn = dn
+        self.attributes = attributes
+
+    def get(self, attribute, default=None):
+        """
+        Return the first value of attribute
+        """
+        values = self.attributes.get(attribute)
+        return values[0] if values else default
+
+    def number(self, attribute):
+        value = self.get(attribute)
+        return int(value) if value is not None else None
+
+    def __repr__(self):
+        return "<%s %s>" % (self.__class__.__name__, self.dn)
+
+
+class User(Entry):
+    """
+    A posixAccount entry
+
+    groups holds the groups the user is a member of. password is only set
+    on the users returned by Directory.create_user, in clear text
+    """
+    password = None
+
+    @property
+    def uid_number(self):
+        return self.number('uidNumber')
+
+    @property
+    def gid_number(self):
+        return self.number('gidNumber')
+
+    @property
+    def home(self):
+        return self.get('homeDirectory')
+
+    @property
+    def shell(self):
+        return self.get('loginShell')
+
+    @property
+    def mail(self):
+        return self.get('mail')
+
+    @property
+    def hosts(self):
+        return [host for host in self.attributes.get('host', []) if host != 'None']
+
+    @property
+    def ssh_keys(self):
+        return [key for key in self.attributes.get('sshPublicKey', []) if key != 'None']
+
+    @property
+    def groups(self):
+        return self.attributes.get('group', [])
+
+
+class Group(Entry):
+    """
+    A posixGroup or groupOfNames entry
+    """
+    @property
+    def kind(self):
+        object_classes = [c.lower() for c in self.attributes.get('objectClass', [])]
+        return 'groupOfNames' if 'groupofnames' in object_classes else 'posixGroup'
+
+    @property
+    def gid_number(self):
+        return self.number('gidNumber')
+
+    @property
+    def members(self):
+        """
+        Member names, from memberUid or the RDN of the member DNs
+        """
+        return self.attributes.get('memberUid', []) + \
+            [member.split(',')[0].split('=', 1)[1] for member in self.attributes.get('member', [])]
+
+
+class TextWriter(object):
+    """
+    Writes entries in the human readable listing format
+    """
+    def __init__(self, stream, hidden=()):
+        self.stream = stream
+        self.hidden = hidden
+        self.idx = 0
+        self.stream.write("\n")
+
+    def write(self, name, dn, attributes):
+        self.stream.write("[%d] => NAME: %s, DN: %s\n" % (self.idx, name, dn))
+        self.stream.write("----------------------------------------------------------------------------------\n")
+        for attribute_key, attribute_value in attributes.iteritems():
+            if [h for h in self.hidden if h in attribute_key]:
+                continue
+            if not attribute_value:
+                attribute_value = ['']
+            for attribute in attribute_value:
+                self.stream.write("%s: %s\n" % (attribute_key, attribute))
+        self.stream.write("\n")
+        self.idx += 1
+
+    def close(self):
+        self.stream.flush()
+
+
+class NDJSONWriter(object):
+    """
+    Writes entries as newline delimited JSON, one object per entry
+
+    Every record is written as soon as it is received so consumers can
+    process it while the search is still running
+    """
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, name, dn, attributes):
+        self.stream.write(json.dumps({'name': name, 'dn': dn, 'attributes': attributes}))
+        self.stream.write("\n")
+
+    def close(self):
+        self.stream.flush()
+
+
+class JSONWriter(NDJSONWriter):
+    """
+    Writes entries as elements of a single JSON array
+
+    The array is written incrementally, nothing is buffered in memory
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        self.separator = "[\n"
+
+    def write(self, name, dn, attributes):
+        self.stream.write(self.separator)
+        self.stream.write(json.dumps({'name': name, 'dn': dn, 'attributes': attributes}))
+        self.separator = ",\n"
+
+    def close(self):
+        self.stream.write("[]\n" if self.separator == "[\n" else "\n]\n")
+        self.stream.flush()
+
+
+class ExternalSort(object):
+    """
+    Sorts (dn, entry) pairs by DN in bounded memory
+
+    Entries are kept until chunk of them were added, then written sorted to
+    a temporary file. Iterating merges the sorted files, so at most chunk
+    entries plus one entry per file are held in memory
+    """
+    def __init__(self, chunk=10000):
+        self.chunk = chunk
+        self.buffer = []
+        self.files = []
+
+    def add(self, dn, entry):
+        self.buffer.append((dn_key(dn), dn, entry))
+        if len(self.buffer) >= self.chunk:
+            self._spill()
+
+    def _spill(self):
+        self.buffer.sort()
+        f = tempfile.TemporaryFile()
+        for item in self.buffer:
+            marshal.dump(item, f)
+        self.files.append(f)
+        self.buffer = []
+
+    def _read(self, f):
+        f.seek(0)
+        while True:
+            try:
+                yield marshal.load(f)
+            except EOFError:
+                return
+
+    def __iter__(self):
+        self.buffer.sort()
+        for key, dn, entry in heapq.merge(self.buffer, *[self._read(f) for f in self.files]):
+            yield dn, entry
+
+    def close(self):
+        for f in self.files:
+            f.close()
+        self.files = []
+        self.buffer = []
+
+
+class KeyCache(object):
+    """
+    SSH public keys and hosts of users kept in a sqlite file
+
+    Every row holds the keys and hosts of a user, or none when the user
+    was not found, and the time they were read. Rows are fresh for ttl
+    seconds (negative_ttl for users not found) and may be used stale for
+    stale more seconds while they are read again
+    """
+    def __init__(self, path, ttl=300, negative_ttl=60, stale=86400):
+        self.path = path
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.stale = stale
+        self.db = sqlite3.connect(path, timeout=5, isolation_level=None)
+        self.db.execute('CREATE TABLE IF NOT EXISTS keys (user TEXT PRIMARY KEY, found INTEGER, '
+                        'keys TEXT, hosts TEXT, fetched REAL, revalidating REAL)')
+
+    def get(self, user):
+        """
+        Return (found, keys, hosts, fetched) for user, None when not cached
+        """
+        row = self.db.execute('SELECT found, keys, hosts, fetched FROM keys WHERE user = ?',
+                              (user.decode('utf-8'),)).fetchone()
+        if row is None:
+            return None
+        found, keys, hosts, fetched = row
+        return (bool(found), [key.encode('utf-8') for key in keys.splitlines()],
+                [host.encode('utf-8') for host in hosts.splitlines()], fetched)
+
+    def put(self, user, found, keys, hosts, fetched):
+        self.db.execute('INSERT OR REPLACE INTO keys VALUES (?, ?, ?, ?, ?, NULL)',
+                        (user.decode('utf-8'), int(found), '\n'.join(keys).decode('utf-8'),
+                         '\n'.join(hosts).decode('utf-8'), fetched))
+
+    def claim(self, user, now, timeout=30):
+        """
+        Return whether the caller should read user again
+
+        Only one of the processes finding the same stale row gets it, until
+        timeout seconds passed without the row being refreshed
+        """
+        return self.db.execute('UPDATE keys SET revalidating = ? WHERE user = ? AND '
+                               '(revalidating IS NULL OR revalidating < ?)',
+                               (now, user.decode('utf-8'), now - timeout)).rowcount == 1
+
+    def close(self):
+        self.db.close()
+
+
+class Snapshot(object):
+    """
+    Local copy of the user and group entries in a sqlite file
+
+    Entries are stored with their attributes and the values of the
+    SNAPSHOT_INDEXED attributes are indexed, so searches on them are
+    local index lookups. sync() brings the copy up to date with the
+    directory, either with a syncrepl refreshOnly search (RFC 4533)
+    resuming from the stored cookie or by reading the entries whose
+    modifyTimestamp is not older than the newest one seen and the DNs of
+    all entries to find the deleted ones
+    """
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path, timeout=30)
+        self.db.text_factory = str
+        with self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS entries '
+                            '(key TEXT PRIMARY KEY, dn TEXT, uuid TEXT, attributes BLOB)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS entries_uuid ON entries (uuid)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS attrs (key TEXT, attribute TEXT, value TEXT)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS attrs_value ON attrs (attribute, value)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS attrs_key ON attrs (key)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value)')
+
+    def meta(self, name, default=None):
+        row = self.db.execute('SELECT value FROM meta WHERE name = ?', (name,)).fetchone()
+        return row[0] if row else default
+
+    def set_meta(self, name, value):
+        self.db.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', (name, value))
+
+    def synced(self):
+        """
+        Return the time of the last sync, None before the first one
+        """
+        return self.meta('synced')
+
+    def invalidate(self):
+        """
+        Make the next open_snapshot sync first, after writes it has not seen
+        """
+        with self.db:
+            self.set_meta('stale', 1)
+
+    def sync(self, directory, full=False):
+        """
+        Read the changes of the entries under the bases of directory
+
+        The sync option of the cache section selects timestamp (default)
+        or syncrepl. With full, or when the method changed, the snapshot is
+        read again from scratch. Returns the number of entries read or
+        deleted
+        """
+        method = getattr(directory, 'cache_sync', 'timestamp')
+        if method not in ('timestamp', 'syncrepl'):
+            raise ConfigError("Invalid cache sync method: %s" % method)
+        changes = 0
+        with self.db:
+            if full or self.meta('sync') != method:
+                for table in ('entries', 'attrs', 'meta'):
+                    self.db.execute('DELETE FROM %s' % table)
+                self.set_meta('sync', method)
+            for base in directory._bases():
+                changes += getattr(self, '_sync_' + method)(directory, base)
+            self.set_meta('synced', time.time())
+            self.set_meta('stale', 0)
+        return changes
+
+    def search(self, base, scope, filterstr='(objectClass=*)', attrlist=None):
+        """
+        Return the (dn, attributes) of the entries matching a search
+
+        Equality filters on indexed attributes, alone, in an & or all the
+        terms of an |, select the candidates through the index, other
+        searches scan the entries under base
+        """
+        base_key = dn_key(base)
+        node = parse_filter(filterstr or '(objectClass=*)')
+        if scope == ldap.SCOPE_BASE:
+            keys = [base_key]
+        else:
+            keys = self._candidates(node)
+        if keys is None:
+            rows = self.db.execute('SELECT key, dn, attributes FROM entries WHERE key = ? OR '
+                                   'substr(key, -?) = ? ORDER BY key',
+                                   (base_key, len(base_key) + 1, ',' + base_key))
+        else:
+            keys = sorted(keys)
+            rows = chain.from_iterable(
+                self.db.execute('SELECT key, dn, attributes FROM entries WHERE key IN (%s) ORDER BY key' %
+                                ','.join('?' * len(keys[i:i + 500])), keys[i:i + 500]).fetchall()
+                for i in range(0, len(keys), 500))
+        wanted = attrlist and set(attribute.lower() for attribute in attrlist)
+        entries = []
+        for key, dn, data in rows:
+            if not self._in_scope(key, base_key, scope):
+                continue
+            attributes = marshal.loads(str(data))
+            if not match_filter(node, dict((k.lower(), v) for k, v in attributes.iteritems())):
+                continue
+            if wanted and '*' not in wanted:
+                attributes = dict((k, v) for k, v in attributes.iteritems() if k.lower() in wanted)
+            entries.append((dn, attributes))
+        return entries
+
+    def close(self):
+        self.db.close()
+
+    def _in_scope(self, key, base_key, scope):
+        if scope == ldap.SCOPE_BASE:
+            return key == base_key
+        if scope == ldap.SCOPE_ONELEVEL:
+            return key.split(',', 1)[1:] == [base_key]
+        return key == base_key or key.endswith(',' + base_key)
+
+    def _candidates(self, node):
+        """
+        Return the keys of the entries an indexed lookup finds for a parsed
+        filter, None when it can't be answered from the index
+        """
+        if node[0] == '=' and node[1] in SNAPSHOT_INDEXED and '*' not in node[2]:
+            return set(row[0] for row in self.db.execute(
+                'SELECT key FROM attrs WHERE attribute = ? AND value = ?',
+                (node[1], unescape_filter_value(node[2]).lower())))
+        if node[0] == '&':
+            for operand in node[1]:
+                keys = self._candidates(operand)
+                if keys is not None:
+                    return keys
+        if node[0] == '|':
+            keys = set()
+            for operand in node[1]:
+                found = self._candidates(operand)
+                if found is None:
+                    return None
+                keys |= found
+            return keys
+        return None
+
+    def _put(self, dn, attributes, uuid=None):
+        key = dn_key(dn)
+        self.db.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)',
+                        (key, dn, uuid, buffer(marshal.dumps(dict(attributes)))))
+        self.db.execute('DELETE FROM attrs WHERE key = ?', (key,))
+        self.db.executemany('INSERT INTO attrs VALUES (?, ?, ?)', [
+            (key, attribute.lower(), value.lower()) for attribute, values in attributes.items()
+            if attribute.lower() in SNAPSHOT_INDEXED for value in values])
+
+    def _delete(self, key):
+        self.db.execute('DELETE FROM entries WHERE key = ?', (key,))
+        self.db.execute('DELETE FROM attrs WHERE key = ?', (key,))
+
+    def _keys(self, base):
+        base_key = dn_key(base)
+        return [row[0] for row in self.db.execute(
+            'SELECT key FROM entries WHERE key = ? OR substr(key, -?) = ?',
+            (base_key, len(base_key) + 1, ',' + base_key))]
+
+    def _sync_timestamp(self, directory, base):
+        timestamp = self.meta('timestamp:' + base)
+        changes = 0
+        filterstr = '(objectClass=*)'
+        if timestamp:
+            present = set(dn_key(dn) for dn, attributes in directory._search(
+                base, ldap.SCOPE_SUBTREE, filterstr, ['1.1']))
+            for key in self._keys(base):
+                if key not in present:
+                    self._delete(key)
+                    changes += 1
+            filterstr = '(modifyTimestamp>=%s)' % timestamp
+        for dn, attributes in directory._search(base, ldap.SCOPE_SUBTREE, filterstr,
+                                                ['*', 'modifyTimestamp']):
+            modified = attributes.pop('modifyTimestamp', [None])[0]
+            if modified > timestamp:
+                timestamp = modified
+            self._put(dn, attributes)
+            changes += 1
+        self.set_meta('timestamp:' + base, timestamp)
+        return changes
+
+    def _sync_syncrepl(self, directory, base):
+        snapshot = self
+        conn = directory.rconn
+        changes = [0]
+        # entryUUIDs presented during the refresh
+        present = set()
+
+        def delete_uuids(uuids):
+            for uuid in uuids:
+                row = snapshot.db.execute('SELECT key FROM entries WHERE uuid = ?', (uuid,)).fetchone()
+                if row:
+                    snapshot._delete(row[0])
+                    changes[0] += 1
+
+        class Consumer(ldap_syncrepl.SyncreplConsumer):
+            def __getattr__(self, name):
+                return getattr(conn, name)
+
+            def syncrepl_get_cookie(self):
+                return snapshot.meta('cookie:' + base)
+
+            def syncrepl_set_cookie(self, cookie):
+                snapshot.set_meta('cookie:' + base, cookie)
+
+            def syncrepl_entry(self, dn, attributes, uuid):
+                snapshot._put(dn, attributes, uuid)
+                changes[0] += 1
+
+            def syncrepl_delete(self, uuids):
+                delete_uuids(uuids)
+
+            def syncrepl_present(self, uuids, refreshDeletes=False):
+                if uuids is not None and refreshDeletes:
+                    delete_uuids(uuids)
+                elif uuids is not None:
+                    present.update(uuids)
+                elif not refreshDeletes:
+                    # end of a present phase: entries not presented are gone
+                    base_key = dn_key(base)
+                    delete_uuids([uuid for key, uuid in snapshot.db.execute(
+                        'SELECT key, uuid FROM entries WHERE key = ? OR substr(key, -?) = ?',
+                        (base_key, len(base_key) + 1, ',' + base_key)).fetchall()
+                        if uuid not in present])
+                    present.clear()
+                else:
+                    present.clear()
+
+        consumer = Consumer()
+        msgid = consumer.syncrepl_search(base, ldap.SCOPE_SUBTREE, mode='refreshOnly',
+                                         cookie=consumer.syncrepl_get_cookie(),
+                                         filterstr='(objectClass=*)', attrlist=['*'])
+        consumer.syncrepl_poll(msgid=msgid, all=1)
+        return changes[0]
+
+
+class SnapshotConnection(object):
+    """
+    Read only stand-in for an LDAPObject answering searches from a Snapshot
+    """
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+        self.results = {}
+        self.msgid = 0
+
+    def search_ext(self, base, scope, filterstr='(objectClass=*)', attrlist=None, attrsonly=0,
+                   serverctrls=None, clientctrls=None, timeout=-1, sizelimit=0):
+        self.msgid += 1
+        self.results[self.msgid] = self.snapshot.search(base, scope, filterstr, attrlist)
+        return self.msgid
+
+    def result3(self, msgid, all=1, timeout=None):
+        # all entries come in one page, without a paged results cookie
+        return ldap.RES_SEARCH_RESULT, self.results.pop(msgid), msgid, []
+
+    def search_s(self, base, scope, filterstr='(objectClass=*)', attrlist=None, attrsonly=0):
+        return self.snapshot.search(base, scope, filterstr, attrlist)
+
+
+class Directory(object):
+    """
+    Client for the users and groups managed by ldapuser
+
+    Reads the ldapuser configuration (CONFIG unless a path is given),
+    returns User and Group objects and raises LdapUserError subclasses.
+    Other python-ldap errors propagate unchanged. The connections are
+    opened on first use and shared by every call, so a batch of operations
+    runs over them without reconnecting:
 
-class ldapuser():
-    def __init__(self):
-        config = ConfigParser()
+        directory = Directory()
+        for user in directory.iter_users():
+            print user.name, user.groups
+    """
+    def __init__(self, config=None):
+        parser = ConfigParser()
         try:
-            config.read(CONFIG)
-            [setattr(self,section + '_' + option, config.get(section, option))
-             for section in config.sections() for option in config.options(section)]
+            parser.read(config or CONFIG)
+            [setattr(self, section + '_' + option, parser.get(section, option))
+             for section in parser.sections() for option in parser.options(section)]
         except (IOError, NoOptionError, NoSectionError) as e:
-            logger.error("%s" % e)
-            sys.exit(1)
+            raise ConfigError("%s" % e)
 
-        try:
-            self.conn = ldap.initialize(self.ldap_server)
-            if getattr(self, 'ldap_timeout', None):
-                self.conn.set_option(ldap.OPT_NETWORK_TIMEOUT, float(self.ldap_timeout))
-            self.conn.simple_bind_s(self.ldap_binddn, self.ldap_bindpw)
-            logger.info("LDAP connection to (%s) initialized" % self.ldap_server)
-        except ldap.SERVER_DOWN:
-            logger.error("Cant connect to LDAP server (%s)" % self.ldap_server)
-            sys.exit(1)
+        self.servers = self._servers()
+        self._connect()
+        self._reset()
 
-    def user(self):
+    def _servers(self):
         """
-        Valid commands are:
+        Return the configured (role, uri) pairs
 
-        user create         Create a new user
-        user update         Updates an user
-        user delete         Deletes an user
-        user show           Shows info about user(s)
+        `servers` lists comma separated "role uri" items where role is
+        provider (takes writes) or consumer (read only replica); a plain
+        `server` is a single provider
+        """
+        servers = []
+        for item in getattr(self, 'ldap_servers', '').split(','):
+            if item.strip():
+                role, uri = item.split()
+                if role not in ('provider', 'consumer'):
+                    raise ConfigError("Invalid LDAP server role '%s' for %s" % (role, uri))
+                servers.append((role, uri))
+        if getattr(self, 'ldap_server', None):
+            servers.insert(0, ('provider', self.ldap_server))
+        if not [server for server_role, server in servers if server_role == 'provider']:
+            raise ConfigError("No LDAP provider configured")
+        return servers
 
-        Use `ldapuser help [command]` to learn more
+    def _connect(self):
         """
-        sys.exit(1)
+        Set up the LDAP connections
 
-    def user_create(self, args):
+        self.conn goes to the providers and is used for writes and the reads
+        they depend on, self.rconn goes to the fastest consumer answering and
+        is used by read only commands. Both connect on first use and move to
+        the next server when the current one goes down
         """
-        Create a new user
+        providers = [uri for role, uri in self.servers if role == 'provider']
+        consumers = [uri for role, uri in self.servers if role == 'consumer']
+        self.conn = FailoverConnection([(providers, False)], self._bind)
+        if consumers:
+            self.rconn = FailoverConnection([(consumers, True), (providers, False)], self._bind)
+        else:
+            self.rconn = self.conn
 
-        Usage: ldapuser user create [--uid UID] [--gid GID] [--group GROUP ...] [--pass PASSWORD]
-                                  [--home HOME] [--shell SHELL] [--gecos GECOS] [--sshkey SSHKEY]
-                                  [--host HOST ...] [--mail MAIL] <user>
+    def _bind(self, uri):
+        """
+        Open and bind a connection to a single server
+        """
+        conn = ldap.initialize(uri)
+        conn.set_option(ldap.OPT_NETWORK_TIMEOUT, float(getattr(self, 'ldap_timeout', 3)))
+        conn.simple_bind_s(self.ldap_binddn, self.ldap_bindpw)
+        logger.info("LDAP connection to (%s) initialized" % uri)
+        return conn
 
-        Options:
-        --uid UID               User ID
-        --gid GID               Group ID
-        --group GROUP           Additional groups user belongs to
-        --pass PASSWORD         Password
-        --home HOME             Home directory
-        --shell SHELL           Default shell
-        --gecos GECOS           Gecos
-        --sshkey SSHKEY         Public SSH key
-        --host HOST             Hosts user has an access to
-        --mail MAIL
+    def _reset(self):
+        """
+        Forget state cached for a single invocation
+        """
+        # group name -> attribute holding its members
+        self._member_attributes = {}
+        # group name -> users that are members directly or through nested groups
+        self._effective_members = None
+        # sorted names of the groups forming each cycle of nested groups
+        self._group_cycles = None
 
+    def get_user(self, name, attributes=None):
         """
-        user = args.get('<user>')
-        uid = self._getuid(uid=args.get('--uid'))
-        gid = self._getgid(gid=args.get('--gid'))
-        groups = args.get('--group')
-        password = self._getpass(password=args.get('--pass'))
-        home = args.get('--home')
-        shell = args.get('--shell')
-        gecos = args.get('--gecos')
-        sshkey = args.get('--sshkey')
-        host = self._gethosts(args.get('--host'))
-        mail = args.get('--mail')
-
-        if not home:
-            home = '/home/%s' % user
-        if not shell:
-            shell = '/bin/bash'
-        if not gecos:
-            gecos = user
-        if not host:
-            host = 'None'
-        if not mail:
-            mail = "%s@o2.com" % user
-
-        if sshkey:
-            try:
-                with open(sshkey) as f:
-                    sshkey = f.readlines()[0].strip()
-            except:
-                logger.error("Can't open ssh key file: %s" % sshkey)
-                sys.exit(1)
+        Return the user called name, with its groups
+
+        attributes limits the attributes read, the groups are only looked up
+        when it includes 'group'
+        """
+        attrlist, with_groups = self._user_attributes(attributes)
+        try:
+            users = list(self._search(self._user_dn(name), ldap.SCOPE_BASE,
+                                      '(objectclass=posixAccount)', attrlist))
+        except ldap.NO_SUCH_OBJECT:
+            users = []
+        if not users:
+            raise NoSuchUser("User not found '%s'" % name)
+        group_index = self._group_index(self._member_filter([name])) if with_groups else None
+        return self._user(users[0][0], users[0][1], group_index)
+
+    def iter_users(self, filterstr=None, attributes=None):
+        """
+        Iterate over the users, with their groups
+
+        filterstr is an LDAP filter the users must match as well, attributes
+        limits the attributes read; the groups are only looked up when it
+        includes 'group'. Users are yielded as the pages of the search
+        arrive. The groups of all users come from a single search of the
+        group tree, with a filter from one search per page for the members
+        of that page
+        """
+        attrlist, with_groups = self._user_attributes(attributes)
+        if filterstr:
+            filterstr = '(&(objectclass=posixAccount)%s)' % filterstr
+        users = self._search(self.user_basedn, ldap.SCOPE_SUBTREE,
+                             filterstr or '(objectclass=posixAccount)', attrlist)
+        if not with_groups:
+            for user_dn, user_attributes in users:
+                yield self._user(user_dn, user_attributes)
+        elif not filterstr:
+            group_index = self._group_index()
+            for user_dn, user_attributes in users:
+                yield self._user(user_dn, user_attributes, group_index)
         else:
-            sshkey = 'None'
+            page_size = int(getattr(self, 'ldap_pagesize', 500))
+            while True:
+                page = list(islice(users, page_size))
+                if not page:
+                    break
+                group_index = self._group_index(self._member_filter(
+                    [self._rdn_value(entry[0]) for entry in page]))
+                for user_dn, user_attributes in page:
+                    yield self._user(user_dn, user_attributes, group_index)
 
-        user_record = [
-            ('objectClass',
-             ['top', 'inetOrgPerson',
-              'posixAccount', 'shadowAccount',
-              'hostObject', 'ldapPublicKey']),
-            ('cn', [user]),
-            ('sn', [user]),
-            ('uid', [user]),
-            ('uidNumber', [uid]),
-            ('gidNumber', [gid]),
-            ('homeDirectory', [home]),
-            ('mail', [mail]),
-            ('loginShell', [shell]),
-            ('userPassword', [password[1]]),
-            ('sshPublicKey', [sshkey]),
-            ('host', host)]
+    def iter_entries(self):
+        """
+        Iterate over every entry under the user and group bases
 
-        user_dn = "uid=%s,%s" % (user, self.user_basedn)
+        Yields (dn, attributes) as the pages of the searches arrive
+        """
+        for base in self._bases():
+            for dn, attributes in self._search(base, ldap.SCOPE_SUBTREE):
+                yield dn, attributes
+
+    def open_snapshot(self, max_staleness=None):
+        """
+        Return the Snapshot in the file set by the path option of the cache
+        section
+
+        It is synced first when older than max_staleness seconds, the
+        max_staleness option by default, or after invalidate_snapshot. When
+        the directory can't be reached an older snapshot is used anyway
+        """
+        snapshot = self._snapshot()
+        if max_staleness is None:
+            max_staleness = float(getattr(self, 'cache_max_staleness', 60))
+        synced = snapshot.synced()
+        if synced is None or snapshot.meta('stale') or time.time() - synced > max_staleness:
+            try:
+                snapshot.sync(self)
+            except ldap.SERVER_DOWN as e:
+                if synced is None:
+                    raise
+                logger.warning("Using the snapshot of %d seconds ago: %s" %
+                               (time.time() - synced, ldap_error(e)))
+        return snapshot
+
+    def invalidate_snapshot(self):
+        """
+        Make the next open_snapshot sync first, if there is a snapshot
+        """
+        path = getattr(self, 'cache_path', None)
+        if not path or not os.path.exists(path):
+            return
+        snapshot = self._snapshot()
+        try:
+            snapshot.invalidate()
+        finally:
+            snapshot.close()
+
+    def _snapshot(self):
+        path = getattr(self, 'cache_path', None)
+        if not path:
+            raise ConfigError("No snapshot path set in the cache section")
+        try:
+            return Snapshot(path)
+        except sqlite3.Error as e:
+            raise ConfigError("Can't open snapshot %s: %s" % (path, e))
+
+    def _bases(self):
+        """
+        Return the user and group bases, without one under the other
+        """
+        user_base, group_base = dn_key(self.user_basedn), dn_key(self.group_basedn)
+        if user_base.endswith(',' + group_base):
+            return [self.group_basedn]
+        if group_base == user_base or group_base.endswith(',' + user_base):
+            return [self.user_basedn]
+        return [self.user_basedn, self.group_basedn]
+
+    def create_user(self, name, uid=None, gid=None, groups=None, password=None, home=None,
+                    shell=None, mail=None, sshkey=None, hosts=None):
+        """
+        Create a user with its primary group and add it to groups
 
+        Missing IDs are allocated and a random password is generated unless
+        one is given. The clear text password is set as the password of the
+        returned User. An existing primary group is kept.
+
+        Once the user entry is added, the primary group and the memberships
+        are written concurrently. When some of them fail PartialFailure is
+        raised with the new User and every failure
+        """
+        groups = [g for g in groups or [] if g]
+        found = self._groups(groups)
+        for group in groups:
+            if group not in found:
+                raise NoSuchGroup("Invalid group: %s" % group)
+        uid = self._getuid(uid=uid)
+        gid = self._getgid(gid=gid)
+        password = self._getpass(password=password)
+
+        user_dn = self._user_dn(name)
+        user_record = self._user_record(name, uid, gid, password[1], home=home, shell=shell,
+                                        mail=mail, sshkey=sshkey, host=hosts)
         try:
             self.conn.add_s(user_dn, user_record)
-            logger.info("User '%s' created successfully with password: %s" %
-                        (user, password[0]))
-            self.group_create({'--gid': gid, '<group>': user})
-            if groups:
-                for group in groups:
-                    self.group_create_member({'user': user, 'group': group})
         except ldap.ALREADY_EXISTS:
-            logger.error("User '%s' already exists" % user)
+            raise AlreadyExists("User '%s' already exists" % name)
 
-    def user_update(self, args):
+        operations = [(('group', name), 'add',
+                       (self._group_dn(name), self._group_record(name, gid=gid)))]
+        for group in groups:
+            attribute = self._member_attribute(group)
+            operations.append((('member', group), 'modify',
+                               (self._group_dn(group),
+                                [(ldap.MOD_ADD, attribute, [self._member_value(attribute, name)])])))
+        errors = []
+        for (kind, group), error in self._pipeline(operations, len(operations)):
+            if kind == 'group' and isinstance(error, ldap.ALREADY_EXISTS):
+                logger.warning("Group '%s' already exists" % group)
+            elif kind == 'group' and not error:
+                self._member_attributes[group] = 'memberUid'
+            elif error and not isinstance(error, ldap.TYPE_OR_VALUE_EXISTS):
+                groups.remove(group)
+                errors.append(((kind, group), error))
+
+        user = User(name, user_dn, dict(user_record))
+        user.attributes['group'] = groups
+        user.password = password[0]
+        if errors:
+            raise PartialFailure("User '%s' created, %d of its group operations failed" %
+                                 (name, len(errors)), user, errors)
+        return user
+
+    def update_user(self, name, uid=None, gid=None, password=None, home=None, shell=None,
+                    gecos=None, sshkey=None, hosts=None, mail=None):
         """
-        Updates an user
+        Change the given attributes of a user
 
-        Usage: ldapuser user update [--uid UID] [--gid GID] [--group GROUP ...] [--pass PASSWORD]
-                                  [--home HOME] [--shell SHELL] [--gecos GECOS] [--sshkey SSHKEY]
-                                  [--host HOST ...]  [--mail MAIL] <user>
+        Attributes whose stored values already match are left alone. Returns
+        the modifications made, an empty list when the user was up to date
+        """
+        changes = self._user_changes(uid=uid, gid=gid, home=home, shell=shell, gecos=gecos,
+                                     sshkey=sshkey, hosts=hosts, mail=mail)
+        if password:
+            changes.append(('userPassword', [self._getpass(password)[1]]))
 
-        Options:
+        user_dn = self._user_dn(name)
+        try:
+            user_record = self.conn.search_s(user_dn, ldap.SCOPE_BASE, '(objectclass=posixAccount)',
+                                             [k for k, v in changes] or ['1.1'])[0][1]
+        except (ldap.NO_SUCH_OBJECT, IndexError):
+            raise NoSuchUser("No such user: '%s'" % name)
+        modlist = self._modlist(user_record, changes)
+        if modlist:
+            try:
+                self.conn.modify_s(user_dn, modlist)
+            except ldap.TYPE_OR_VALUE_EXISTS:
+                raise LdapUserError("User '%s' has a duplicate host value" % name)
+        return modlist
+
+    def delete_user(self, name):
+        """
+        Delete a user and its primary group
+        """
+        try:
+            self.conn.delete_s(self._user_dn(name))
+        except ldap.NO_SUCH_OBJECT:
+            raise NoSuchUser("User '%s' doesnt exist" % name)
+        try:
+            self.delete_group(name)
+        except NoSuchGroup as e:
+            logger.warning(e)
+
+    def user_groups(self, name):
+        """
+        Return the names of the groups a user is a member of
+        """
+        return self._user_groups(name)
+
+    def effective_groups(self, name):
+        """
+        Return the groups a user is a member of, directly or through nested
+        groupOfNames, sorted by name
+        """
+        self.get_user(name, [])
+        return sorted(group for group, users in self._closures().iteritems() if name in users)
+
+    def effective_members(self, group):
+        """
+        Return the users that are members of a group, directly or through
+        nested groupOfNames, sorted by name
+        """
+        closures = self._closures()
+        if group not in closures:
+            raise NoSuchGroup("Group not found '%s'" % group)
+        return sorted(closures[group])
+
+    def set_user_groups(self, name, groups):
+        """
+        Make groups the only groups a user is a member of
+
+        Returns the (added, removed) group names
+        """
+        groups = [g for g in groups if g]
+        found = self._groups(groups)
+        for group in groups:
+            if group not in found:
+                raise NoSuchGroup("Invalid group: %s" % group)
+        current = self._user_groups(name)
+        removed = [g for g in current if g not in groups]
+        added = [g for g in groups if g not in current]
+        for group in removed:
+            self.remove_members(group, [name])
+        for group in added:
+            self.add_members(group, [name])
+        return added, removed
+
+    def get_group(self, name):
+        """
+        Return the group called name
+        """
+        try:
+            groups = list(self._search(self._group_dn(name), ldap.SCOPE_BASE,
+                                       '(|(objectclass=posixGroup)(objectclass=groupOfNames))'))
+        except ldap.NO_SUCH_OBJECT:
+            groups = []
+        if not groups:
+            raise NoSuchGroup("Group not found '%s'" % name)
+        return self._group(*groups[0])
+
+    def iter_groups(self, conn=None):
+        """
+        Iterate over all groups as the pages of the search arrive
+
+        conn is the connection searched, the read connection by default
+        """
+        for group_dn, group_attributes in self._search(
+                self.group_basedn, ldap.SCOPE_SUBTREE,
+                '(|(objectclass=posixGroup)(objectclass=groupOfNames))', conn=conn):
+            yield self._group(group_dn, group_attributes)
+
+    def create_group(self, name, gid=None, members=None, groupofnames=False):
+        """
+        Create a posixGroup, or a groupOfNames when groupofnames is set
+
+        A posixGroup gets a newly allocated GID unless gid is given
+        """
+        if groupofnames:
+            group_record = self._group_record(name, members=members or [], groupofnames=True)
+        else:
+            group_record = self._group_record(name, gid=self._getgid(gid=gid), members=members)
+        group_dn = self._group_dn(name)
+        try:
+            self.conn.add_s(group_dn, group_record)
+        except ldap.ALREADY_EXISTS:
+            raise AlreadyExists("Group '%s' already exists" % name)
+        self._cache_group_type(name, dict(group_record))
+        return Group(name, group_dn, dict(group_record))
+
+    def update_group(self, name, gid=None):
+        """
+        Change the GID of a posixGroup
+
+        Returns the modifications made, an empty list when the group was up
+        to date
+        """
+        changes = [('gidNumber', gid and self._getgid(gid=gid))]
+        changes = [(k, v) for k, v in changes if v]
+
+        group_dn = self._group_dn(name)
+        try:
+            group_record = self.conn.search_s(group_dn, ldap.SCOPE_BASE, '(objectclass=posixGroup)',
+                                              [k for k, v in changes] or ['1.1'])[0][1]
+        except (ldap.NO_SUCH_OBJECT, IndexError):
+            raise NoSuchGroup("Group not found '%s'" % name)
+        modlist = self._modlist(group_record, changes)
+        if modlist:
+            self.conn.modify_s(group_dn, modlist)
+        return modlist
+
+    def delete_group(self, name):
+        """
+        Delete a group
+        """
+        try:
+            self.conn.delete_s(self._group_dn(name))
+        except ldap.NO_SUCH_OBJECT:
+            raise NoSuchGroup("Group '%s' doesnt exist" % name)
+        self._member_attributes.pop(name, None)
+
+    def add_members(self, group, users):
+        """
+        Add users to a group
+
+        All users are added with a single modify, when some of them are
+        members already the others are added one by one. Returns the users
+        that were added
+        """
+        return self._change_members(group, users, ldap.MOD_ADD, ldap.TYPE_OR_VALUE_EXISTS)
+
+    def remove_members(self, group, users):
+        """
+        Remove users from a group
+
+        Returns the users that were removed, users that are not members are
+        skipped
+        """
+        return self._change_members(group, users, ldap.MOD_DELETE, ldap.NO_SUCH_ATTRIBUTE)
+
+    def set_members(self, group, users):
+        """
+        Make users the only members of a group
+
+        Returns the members of the group
+        """
+        attribute = self._member_attribute(group)
+        users = self._unique(users)
+        self.conn.modify_s(self._group_dn(group),
+                           [(ldap.MOD_REPLACE, attribute,
+                             [self._member_value(attribute, user) for user in users])])
+        return users
+
+    def import_records(self, records, window=64):
+        """
+        Create users, groups and entries from import records
+
+        records are dicts with either:
+
+        user        and optionally uid, gid, groups, pass, home, shell, sshkey,
+                    host and mail, as CSV rows of `ldapuser import`
+        group       and optionally gid, members and groupofnames
+        dn, entry   an LDIF entry, added as it is
+
+        The IDs of the whole batch are allocated up front and the adds, then
+        the primary groups of the users added, then their memberships, are
+        pipelined with at most window operations in flight. The primary group
+        and memberships of a user that could not be added are skipped. Generated passwords are stored in the pass field of their
+        record. Yields (kind, name, error) as the results arrive, where kind
+        is user, group, entry or member (named by a (user, group) pair) and
+        error is None on success
+        """
+        need_uid = need_gid = 0
+        for record in records:
+            if 'dn' in record:
+                object_classes = [c.lower() for c in record['entry'].get('objectClass', [])]
+                need_uid += 'posixaccount' in object_classes and 'uidNumber' not in record['entry']
+                need_gid += 'posixgroup' in object_classes and 'gidNumber' not in record['entry']
+            elif record.get('user'):
+                need_uid += not record.get('uid')
+                need_gid += not record.get('gid')
+            elif record.get('group'):
+                need_gid += not record.get('gid') and not record.get('groupofnames')
+        uids = iter(self._allocate('uid', need_uid) if need_uid else [])
+        gids = iter(self._allocate('gid', need_gid) if need_gid else [])
+
+        adds = []
+        # (user, add of its primary group), sent once the user is added
+        primary_groups = []
+        memberships = []
+        created_groups = {}
+        for record in records:
+            if 'dn' in record:
+                entry = record['entry']
+                object_classes = [c.lower() for c in entry.get('objectClass', [])]
+                if 'posixaccount' in object_classes and 'uidNumber' not in entry:
+                    entry['uidNumber'] = [next(uids)]
+                if 'posixgroup' in object_classes and 'gidNumber' not in entry:
+                    entry['gidNumber'] = [next(gids)]
+                adds.append((('entry', record['dn']), 'add', (record['dn'], entry.items())))
+            elif record.get('user'):
+                user = record['user']
+                uid = self._getuid(uid=record['uid']) if record.get('uid') else next(uids)
+                gid = self._getgid(gid=record['gid']) if record.get('gid') else next(gids)
+                password = self._getpass(password=record.get('pass'))
+                record['pass'] = password[0]
+                hosts = record.get('host')
+                if isinstance(hosts, basestring):
+                    hosts = [host.strip() for host in hosts.split(',') if host.strip()]
+                user_record = self._user_record(user, uid, gid, password[1],
+                                                home=record.get('home'), shell=record.get('shell'),
+                                                mail=record.get('mail'), sshkey=record.get('sshkey'),
+                                                host=hosts)
+                adds.append((('user', user), 'add', (self._user_dn(user), user_record)))
+                primary_groups.append((user, (('group', user), 'add',
+                                              (self._group_dn(user), self._group_record(user, gid=gid)))))
+                for group in (record.get('groups') or '').split(','):
+                    if group.strip():
+                        memberships.append((group.strip(), user))
+            elif record.get('group'):
+                group = record['group']
+                members = [m.strip() for m in (record.get('members') or '').split(',') if m.strip()]
+                groupofnames = (record.get('groupofnames') or '').lower() in ('1', 'yes', 'true')
+                if groupofnames:
+                    group_record = self._group_record(group, members=members, groupofnames=True)
+                else:
+                    gid = self._getgid(gid=record['gid']) if record.get('gid') else next(gids)
+                    group_record = self._group_record(group, gid=gid, members=members)
+                created_groups[group] = 'member' if groupofnames else 'memberUid'
+                adds.append((('group', group), 'add', (self._group_dn(group), group_record)))
+            else:
+                logger.error("Skipping record without user or group: %s" % record)
+
+        failed_users = set()
+        for (kind, name), error in self._pipeline(adds, window):
+            if error and kind == 'user':
+                failed_users.add(name)
+            elif error and kind == 'group':
+                # looked up with the other existing groups
+                created_groups.pop(name, None)
+            yield kind, name, error
+        for (kind, name), error in self._pipeline(
+                [add for added, add in primary_groups if added not in failed_users], window):
+            yield kind, name, error
+        memberships = [m for m in memberships if m[1] not in failed_users]
+
+        self._member_attributes.update(created_groups)
+        existing = self._groups([g for g in set(g for g, u in memberships) if g not in created_groups])
+        modifies = []
+        for group, user in memberships:
+            if group not in created_groups and group not in existing:
+                yield 'member', (user, group), NoSuchGroup("no such group")
+                continue
+            attribute = self._member_attribute(group)
+            modifies.append(((user, group), 'modify',
+                             (self._group_dn(group),
+                              [(ldap.MOD_ADD, attribute, [self._member_value(attribute, user)])])))
+        for name, error in self._pipeline(modifies, window):
+            if isinstance(error, ldap.TYPE_OR_VALUE_EXISTS):
+                error = None
+            yield 'member', name, error
+
+    def plan_state(self, state, prune=False, conn=None):
+        """
+        Return the operations bringing the directory to a desired state
+
+        state is a dict with optional users and groups, both mapping names
+        to dicts:
+
+        users       uid, gid, home, shell, gecos, mail, sshkey, hosts and
+                    groups, password only applies to new users
+        groups      gid, members and groupofnames
+
+        Only the attributes given are managed. A user listing its groups is
+        removed from the other groups, a group listing its members keeps
+        only them and the users listing it. New users get their primary
+        group, missing IDs are allocated for the whole plan and generated
+        passwords are stored in the password field of their user. With
+        prune, users and groups missing from state are deleted, along with
+        the primary groups of deleted users.
+
+        The current users and groups are read with one search each, from
+        conn or the read connection; pass the provider connection self.conn
+        when the plan is applied, a lagging consumer would plan changes
+        already made. Returns a list of (key, method, arguments) operations
+        for apply_plan, keyed by (kind, name): adds first, then modifies,
+        then deletes
+        """
+        users = state.get('users') or {}
+        groups = state.get('groups') or {}
+        current_users = dict((self._rdn_value(dn), attributes) for dn, attributes in self._search(
+            self.user_basedn, ldap.SCOPE_SUBTREE, '(objectclass=posixAccount)', conn=conn))
+        current_groups = dict((group.name, group) for group in self.iter_groups(conn))
+
+        user_groups = dict((name, self._state_list(user['groups']))
+                           for name, user in users.iteritems() if 'groups' in user)
+        for name, listed in user_groups.iteritems():
+            for group in listed:
+                if group not in groups and group not in current_groups:
+                    raise NoSuchGroup("Invalid group of user '%s': %s" % (name, group))
+
+        new_users = sorted(name for name in users if name not in current_users)
+        new_groups = sorted(name for name in groups if name not in current_groups)
+        # groups with the name of a new user are its primary group
+        primary_gids = dict((name, groups.get(name, {}).get('gid') or
+                             (name in current_groups and current_groups[name].get('gidNumber')))
+                            for name in new_users)
+        uids_taken = set(attributes.get('uidNumber', [None])[0] for attributes in current_users.values())
+        need_uid = len([new for new in new_users if not users[new].get('uid')])
+        need_gid = len([new for new in new_users
+                        if not users[new].get('gid') and not primary_gids[new]]) + \
+            len([new for new in new_groups if not groups[new].get('gid') and
+                 not groups[new].get('groupofnames') and new not in new_users])
+        uids = iter(self._allocate('uid', need_uid) if need_uid else [])
+        gids = iter(self._allocate('gid', need_gid) if need_gid else [])
+
+        adds = []
+        for name in new_users:
+            user = users[name]
+            if user.get('uid'):
+                uid = str(user['uid'])
+                low, high = self._id_range('uid')
+                if not low <= int(uid) <= high or uid in uids_taken:
+                    raise InvalidId("Invalid or used UID for user '%s': %s" % (name, uid))
+            else:
+                uid = next(uids)
+            gid = str(user.get('gid') or primary_gids[name] or next(gids))
+            password = self._getpass(password=user.get('password'))
+            user['password'] = password[0]
+            adds.append((('user', name), 'add', (self._user_dn(name), self._user_record(
+                name, uid, gid, password[1], home=user.get('home'), shell=user.get('shell'),
+                mail=user.get('mail'), sshkey=user.get('sshkey'),
+                host=self._state_list(user.get('hosts'))))))
+            if name not in groups and name not in current_groups:
+                adds.append((('group', name), 'add',
+                             (self._group_dn(name), self._group_record(name, gid=gid))))
+            elif name in groups and not groups[name].get('gid'):
+                groups[name]['gid'] = gid
+
+        deleted_users = deleted_groups = set()
+        if prune:
+            kept = set(groups) | set(group for listed in user_groups.values() for group in listed)
+            deleted_users = set(name for name in current_users if name not in users)
+            deleted_groups = set(name for name in current_groups if name not in kept and name not in users)
+
+        group_base = dn_key(self.group_basedn)
+        members = {}
+        for name in set(groups) | set(current_groups):
+            current = current_groups[name].members if name in current_groups else []
+            if 'members' in groups.get(name, {}):
+                wanted = self._state_list(groups[name]['members'])
+            else:
+                # nested groups stay while they are kept
+                nested = set()
+                if name in current_groups:
+                    nested = set(self._rdn_value(value) for value in
+                                 current_groups[name].attributes.get('member', [])
+                                 if dn_key(value).endswith(',' + group_base))
+                wanted = [member for member in current if member not in user_groups and
+                          not (prune and member not in users and
+                               (member not in nested or member in deleted_groups))]
+            wanted.extend(user for user, listed in sorted(user_groups.iteritems())
+                          if name in listed and user not in wanted)
+            members[name] = wanted
+
+        for name in new_groups:
+            group = groups[name]
+            if group.get('groupofnames'):
+                record = self._group_record(name, members=members[name], groupofnames=True)
+            else:
+                record = self._group_record(name, gid=str(group.get('gid') or next(gids)),
+                                            members=members[name])
+            adds.append((('group', name), 'add', (self._group_dn(name), record)))
+
+        modifies = []
+        for name in sorted(set(users) & set(current_users)):
+            modlist = self._modlist(current_users[name], self._user_changes(**dict(
+                (field, users[name].get(field))
+                for field in ('uid', 'gid', 'home', 'shell', 'gecos', 'mail', 'sshkey', 'hosts'))))
+            if modlist:
+                modifies.append((('user', name), 'modify', (self._user_dn(name), modlist)))
+        for name in sorted(current_groups):
+            if name in deleted_groups:
+                continue
+            group = current_groups[name]
+            changes = []
+            if name in groups and groups[name].get('gid') and group.kind == 'posixGroup':
+                changes.append(('gidNumber', str(groups[name]['gid'])))
+            modlist = self._modlist(group.attributes, changes)
+            attribute = self._member_attribute(name)
+            stored = group.attributes.get(attribute, [])
+            if attribute == 'member':
+                # the stored DNs are compared and deleted as they are, nested
+                # groups included, only new members get a user DN
+                by_name = dict((self._rdn_value(value), value) for value in stored)
+                wanted = [by_name.get(member) or self._member_value(attribute, member)
+                          for member in members[name]]
+                stored_keys = set(dn_key(value) for value in stored)
+                wanted_keys = set(dn_key(value) for value in wanted)
+                added = [value for value in wanted if dn_key(value) not in stored_keys]
+                removed = [value for value in stored if dn_key(value) not in wanted_keys]
+            else:
+                added = [member for member in members[name] if member not in stored]
+                removed = [value for value in stored if value not in members[name]]
+            if added:
+                modlist.append((ldap.MOD_ADD, attribute, added))
+            if removed:
+                modlist.append((ldap.MOD_DELETE, attribute, removed))
+            if modlist:
+                modifies.append((('group', name), 'modify', (group.dn, modlist)))
+
+        deletes = [(('user', deleted), 'delete', (self._user_dn(deleted),))
+                   for deleted in sorted(deleted_users)]
+        deletes.extend((('group', name), 'delete', (current_groups[name].dn,))
+                       for name in sorted(deleted_groups))
+        return adds + modifies + deletes
+
+    def apply_plan(self, operations, window=64):
+        """
+        Run the operations returned by plan_state
+
+        At most window operations are in flight. Yields (key, error) as the
+        results arrive, error is None on success
+        """
+        return self._pipeline(operations, window)
+
+    def check_consistency(self, conn=None):
+        """
+        Return the inconsistencies between users and groups and the
+        operations repairing those that can be repaired safely
+
+        Users and groups are read with one paged search each and joined in
+        memory on names, DNs and ID numbers. Problems are (check, kind, name,
+        detail) tuples, check being one of:
+
+        dangling        a memberUid or member value names no user (or group,
+                        for member)
+        duplicate       a uidNumber or posixGroup gidNumber is used twice
+        range           a uidNumber or gidNumber is outside minuid..maxuid or
+                        mingid..maxgid
+        primary         no posixGroup has the gidNumber of a user
+        cycle           nested groups are members of each other, reported
+                        for the first group of the cycle
+
+        Operations are (key, method, arguments) for apply_plan, keyed by
+        (kind, name): one modify per group deleting its dangling values and
+        a primary group added for users missing theirs, when no group has
+        their name and no other user shares their gidNumber. IDs are never
+        renumbered, files on the hosts are owned by them. Entries are read
+        from conn, the read connection by default; pass the provider
+        connection self.conn when the repairs are applied
+        """
+        users = {}
+        user_dns = set()
+        for user_dn, user_attributes in self._search(self.user_basedn, ldap.SCOPE_SUBTREE,
+                                                     '(objectclass=posixAccount)',
+                                                     ['uidNumber', 'gidNumber'], conn=conn):
+            users[self._rdn_value(user_dn)] = user_attributes
+            user_dns.add(dn_key(user_dn))
+        groups = {}
+        group_dns = set()
+        for group_dn, group_attributes in self._search(
+                self.group_basedn, ldap.SCOPE_SUBTREE,
+                '(|(objectclass=posixGroup)(objectclass=groupOfNames))',
+                ['objectClass', 'gidNumber', 'memberUid', 'member'], conn=conn):
+            group = self._group(group_dn, group_attributes)
+            groups[group.name] = group
+            group_dns.add(dn_key(group_dn))
+
+        problems = []
+        operations = []
+        for name in sorted(groups):
+            group = groups[name]
+            members = group.attributes.get('member', [])
+            dangling = [('memberUid', [v for v in group.attributes.get('memberUid', []) if v not in users]),
+                        ('member', [v for v in members
+                                    if dn_key(v) not in user_dns and dn_key(v) not in group_dns])]
+            modlist = []
+            for attribute, values in dangling:
+                for value in values:
+                    problems.append(('dangling', 'group', name, "%s '%s'" % (attribute, value)))
+                # a groupOfNames needs at least one member left
+                if values and (attribute == 'memberUid' or len(values) < len(members)):
+                    modlist.append((ldap.MOD_DELETE, attribute, values))
+            if modlist:
+                operations.append((('group', name), 'modify', (group.dn, modlist)))
+
+        # computed again from the entries just read, not from an earlier call
+        self._effective_members = None
+        self._closures([(g.dn, g.attributes) for g in groups.itervalues()])
+        for cycle in self._group_cycles:
+            problems.append(('cycle', 'group', cycle[0], "nested groups form a cycle: %s" % ', '.join(cycle)))
+
+        gids = {}
+        for name, group in groups.iteritems():
+            if group.kind == 'posixGroup':
+                gids.setdefault(group.get('gidNumber'), []).append(name)
+        uids = {}
+        for name, user_attributes in users.iteritems():
+            uids.setdefault(user_attributes.get('uidNumber', [None])[0], []).append(name)
+        for kind, numbers in (('uid', uids), ('gid', gids)):
+            entry_kind = 'user' if kind == 'uid' else 'group'
+            low, high = self._id_range(kind)
+            for number in sorted(numbers, key=lambda number: (len(number or ''), number)):
+                names = sorted(numbers[number])
+                if len(names) > 1:
+                    problems.extend(('duplicate', entry_kind, name, "%sNumber %s also used by %s" % (
+                        kind, number, ', '.join(other for other in names if other != name)))
+                        for name in names)
+                if not (number or '').isdigit() or not low <= int(number) <= high:
+                    problems.extend(('range', entry_kind, name, "%sNumber %s outside %d..%d" % (
+                        kind, number, low, high)) for name in names)
+
+        missing = {}
+        for name in sorted(users):
+            gid = users[name].get('gidNumber', [None])[0]
+            if gid not in gids:
+                missing.setdefault(gid, []).append(name)
+        for gid, names in sorted(missing.iteritems()):
+            for name in names:
+                problems.append(('primary', 'user', name, "no posixGroup with gidNumber %s" % gid))
+            # a group per user would share the gid, the repair is left to the operator
+            if gid is not None and len(names) == 1 and names[0] not in groups:
+                name = names[0]
+                operations.append((('group', name), 'add',
+                                   (self._group_dn(name), self._group_record(name, gid=gid))))
+        return problems, operations
+
+    def get_user_hosts(self, name):
+        """
+        Return the hosts user name has access to
+        """
+        return self.get_user(name, ['host']).hosts
+
+    def host_users(self, pattern):
+        """
+        Return the names of the users with access to the hosts matching
+        pattern, where * matches any text
+
+        Users with the host value * have access to every host
+        """
+        users = []
+        for hosts, user in self._host_search(pattern):
+            if hosts:
+                users.append(user.name)
+        return sorted(users)
+
+    def index_hosts(self, pattern=None):
+        """
+        Return the users with access to every host, or to the hosts matching
+        pattern, as a dict of host -> sorted user names
+
+        Built from one paged search. Users with the host value * are listed
+        under *
+        """
+        index = {}
+        for hosts, user in self._host_search(pattern):
+            for host in hosts:
+                index.setdefault(host, []).append(user.name)
+        for users in index.values():
+            users.sort()
+        return index
+
+    def _host_search(self, pattern=None):
+        """
+        Yield (hosts matching pattern, User) for the users the server finds
+        with a matching host value, or with host *
+        """
+        if pattern:
+            value = '*'.join(ldap.filter.escape_filter_chars(part) for part in pattern.split('*'))
+            filterstr = '(&(objectClass=posixAccount)(|(host=%s)(host=\\2a)))' % value
+        else:
+            filterstr = '(&(objectClass=posixAccount)(host=*))'
+        for user_dn, user_attributes in self._search(self.user_basedn, ldap.SCOPE_SUBTREE,
+                                                     filterstr, ['host']):
+            user = self._user(user_dn, user_attributes)
+            # the server matches without case, the placeholder None is no host
+            yield [host for host in user.hosts if not pattern or host_matches(host, pattern)], user
+
+    def host_entries(self, host, entries=None):
+        """
+        Return the users allowed on host and all posixGroups for host_maps
+
+        Without entries every user with the host value (or *) and every
+        posixGroup is read in one paged search each. entries returned by an earlier
+        call are refreshed in place instead: only users and groups whose
+        modifyTimestamp is not older than the newest one seen are read, and
+        a DN-only search of each finds the entries deleted, or users no
+        longer allowed on host, since. entries is a dict of host, timestamp,
+        users and groups, the latter mapping normalized DNs to (dn,
+        attributes), that can be saved with marshal. Its fetched field
+        counts the entries read
+        """
+        host_filter = '(&(objectClass=posixAccount)(|(host=%s)(host=\\2a)))' % \
+            ldap.filter.escape_filter_chars(host)
+        if not entries or entries.get('host') != host:
+            entries = {'host': host, 'timestamp': None, 'users': {}, 'groups': {}}
+        timestamp = entries['timestamp']
+        entries['fetched'] = 0
+        for kind, base, filterstr in (('users', self.user_basedn, host_filter),
+                                      ('groups', self.group_basedn, '(objectClass=posixGroup)')):
+            cached = entries[kind]
+            if timestamp:
+                present = set(dn_key(dn) for dn, attributes in self._search(
+                    base, ldap.SCOPE_SUBTREE, filterstr, ['1.1']))
+                for key in [k for k in cached if k not in present]:
+                    del cached[key]
+                filterstr = '(&%s(modifyTimestamp>=%s))' % (filterstr, timestamp)
+            for dn, attributes in self._search(base, ldap.SCOPE_SUBTREE, filterstr,
+                                               MAP_ATTRIBUTES[kind[:-1]]):
+                cached[dn_key(dn)] = (dn, attributes)
+                entries['fetched'] += 1
+                modified = attributes.get('modifyTimestamp', [None])[0]
+                if modified > entries['timestamp']:
+                    entries['timestamp'] = modified
+        return entries
+
+    def host_maps(self, entries):
+        """
+        Return the passwd, group and shadow lines for host_entries
+
+        Users are joined to their groups in memory. Groups list only the
+        users allowed on the host and are left out when none of them is a
+        member or has the group as primary group. The shadow password is
+        the userPassword of {CRYPT} hashes and * for any other scheme
+        """
+        users = []
+        for dn, attributes in entries['users'].values():
+            user = Entry(self._rdn_value(dn), dn, attributes)
+            users.append((user.number('uidNumber'), user.name, user))
+        users.sort()
+        names = set(name for number, name, user in users)
+        primary = set(user.get('gidNumber') for number, name, user in users)
+
+        maps = {'passwd': [], 'shadow': [], 'group': []}
+        for number, name, user in users:
+            maps['passwd'].append(':'.join([name, 'x', user.get('uidNumber', ''), user.get('gidNumber', ''),
+                                            user.get('givenName', ''), user.get('homeDirectory', ''),
+                                            user.get('loginShell', '')]))
+            password = user.get('userPassword', '')
+            password = password[len('{CRYPT}'):] if password.upper().startswith('{CRYPT}') else '*'
+            maps['shadow'].append(':'.join([name, password] + [
+                user.get(attribute, '') for attribute in ('shadowLastChange', 'shadowMin', 'shadowMax',
+                                                          'shadowWarning', 'shadowInactive',
+                                                          'shadowExpire')] + ['']))
+
+        groups = []
+        for dn, attributes in entries['groups'].values():
+            gid = attributes.get('gidNumber', [''])[0]
+            members = [member for member in Group(None, dn, attributes).members if member in names]
+            if members or gid in primary:
+                groups.append((int(gid or 0), self._rdn_value(dn), gid, members))
+        for number, name, gid, members in sorted(groups):
+            maps['group'].append(':'.join([name, 'x', gid, ','.join(members)]))
+        return maps
+
+    def _user_dn(self, user):
+        return "uid=%s,%s" % (user, self.user_basedn)
+
+    def _group_dn(self, group):
+        return "cn=%s,%s" % (group, self.group_basedn)
+
+    def _user(self, user_dn, user_attributes, group_index=None):
+        """
+        Return a User for a search result, with its groups from group_index
+        """
+        name = self._rdn_value(user_dn)
+        if group_index is not None:
+            user_attributes['group'] = []
+            for group in group_index.get(name, []) + group_index.get(self._user_dn(name), []):
+                if group not in user_attributes['group']:
+                    user_attributes['group'].append(group)
+        return User(name, user_dn, user_attributes)
+
+    def _user_attributes(self, attributes):
+        """
+        Return the attribute list to request for the given user attributes
+        and whether their groups are wanted
+        """
+        if attributes is None:
+            return None, True
+        attrlist = [attribute for attribute in attributes if attribute != 'group']
+        # 1.1 requests no attributes at all
+        return attrlist or ['1.1'], 'group' in attributes
+
+    def _member_filter(self, users):
+        """
+        Return a filter matching the groups any of users is a member of
+        """
+        return '(|%s)' % ''.join('(memberUid=%s)(member=%s)' % (
+            ldap.filter.escape_filter_chars(user),
+            ldap.filter.escape_filter_chars(self._user_dn(user))) for user in users)
+
+    def _rdn_value(self, dn):
+        return dn.split(',')[0].split('=', 1)[1]
+
+    def _group(self, group_dn, group_attributes):
+        self._cache_group_type(group_dn.split(',')[0].split('cn=')[1], group_attributes)
+        return Group(group_dn.split(',')[0].split('cn=')[1], group_dn, group_attributes)
+
+    def _change_members(self, group, users, operation, skipped):
+        """
+        Add or delete the member values of users in a single modify
+
+        When the modify fails with the skipped error, meaning some of the
+        users already are (or are not) members, the users are retried one
+        by one. Returns the users that were changed
+        """
+        attribute = self._member_attribute(group)
+        group_dn = self._group_dn(group)
+        users = self._unique(users)
+        try:
+            self.conn.modify_s(group_dn, [(operation, attribute,
+                                           [self._member_value(attribute, u) for u in users])])
+            return users
+        except skipped:
+            if len(users) == 1:
+                return []
+        changed = []
+        for user in users:
+            try:
+                self.conn.modify_s(group_dn, [(operation, attribute,
+                                               [self._member_value(attribute, user)])])
+                changed.append(user)
+            except skipped:
+                pass
+        return changed
+
+    def _unique(self, values):
+        unique = []
+        for value in values:
+            if value and value not in unique:
+                unique.append(value)
+        return unique
+
+    def _search(self, base, scope, filterstr='(objectClass=*)', attrlist=None, conn=None):
+        """
+        Search the directory page by page
+
+        Works like search_s but uses the Simple Paged Results control and
+        returns an iterator, so entries are consumed as each page arrives and
+        the server sizelimit does not truncate large trees. The first page is
+        fetched up front so errors such as NO_SUCH_OBJECT surface here.
+        Searches go to the read connection unless conn is given
+        """
+        entries = self._paged_search(conn or self.rconn, base, scope, filterstr, attrlist)
+        try:
+            first = [next(entries)]
+        except StopIteration:
+            first = []
+        return chain(first, entries)
+
+    def _paged_search(self, conn, base, scope, filterstr, attrlist):
+        page_size = int(getattr(self, 'ldap_pagesize', 500))
+        page = ldap.controls.SimplePagedResultsControl(True, size=page_size, cookie='')
+        while True:
+            msgid = conn.search_ext(base, scope, filterstr, attrlist,
+                                    serverctrls=[page])
+            rtype, rdata, rmsgid, serverctrls = conn.result3(msgid)
+            for dn, attributes in rdata:
+                # skip search continuation references
+                if dn is not None:
+                    yield dn, attributes
+            cookies = [c.cookie for c in serverctrls
+                       if c.controlType == ldap.controls.SimplePagedResultsControl.controlType]
+            if not cookies or not cookies[0]:
+                break
+            page.cookie = cookies[0]
+
+    def _user_record(self, user, uid, gid, password, home=None, shell=None,
+                     mail=None, sshkey=None, host=None):
+        """
+        Return the attributes of a new user entry, applying defaults
+        """
+        return [
+            ('objectClass',
+             ['top', 'inetOrgPerson',
+              'posixAccount', 'shadowAccount',
+              'hostObject', 'ldapPublicKey']),
+            ('cn', [user]),
+            ('sn', [user]),
+            ('uid', [user]),
+            ('uidNumber', [uid]),
+            ('gidNumber', [gid]),
+            ('homeDirectory', [home or '/home/%s' % user]),
+            ('mail', [mail or "%s@o2.com" % user]),
+            ('loginShell', [shell or '/bin/bash']),
+            ('userPassword', [password]),
+            ('sshPublicKey', [sshkey or 'None']),
+            ('host', host or ['None'])]
+
+    def _user_changes(self, uid=None, gid=None, home=None, shell=None, gecos=None,
+                      sshkey=None, hosts=None, mail=None):
+        """
+        Return the (attribute, value(s)) pairs for the given user fields
+        """
+        changes = [('uidNumber', uid and str(uid)),
+                   ('gidNumber', gid and str(gid)),
+                   ('homeDirectory', home),
+                   ('loginShell', shell),
+                   ('givenName', gecos),
+                   ('sshPublicKey', sshkey),
+                   ('host', self._state_list(hosts) if isinstance(hosts, basestring) else hosts),
+                   ('mail', mail)]
+        return [(k, v) for k, v in changes if v]
+
+    def _state_list(self, value):
+        """
+        Return a list from a list or comma separated string
+        """
+        if isinstance(value, basestring):
+            return [item.strip() for item in value.split(',') if item.strip()]
+        return [str(item) for item in value or []]
+
+    def _group_record(self, group, gid=None, members=None, groupofnames=False):
+        """
+        Return the attributes of a new posixGroup or groupOfNames entry
+        """
+        group_record = [('cn', [group])]
+        if groupofnames:
+            group_record.append(('objectClass', ['top', 'groupOfNames']))
+            group_record.append(('member', ["uid=%s,%s" % (member, self.user_basedn)
+                                            for member in members]))
+        else:
+            group_record.append(('objectClass', ['top', 'posixGroup']))
+            group_record.append(('gidNumber', [gid]))
+            if members:
+                group_record.append(('memberUid', members))
+        return group_record
+
+    def _pipeline(self, operations, window):
+        """
+        Run write operations asynchronously with a bounded in-flight window
+
+        operations yields (key, method, arguments) tuples where method is an
+        asynchronous LDAPObject method such as 'add', 'modify' or 'delete'.
+        Yields (key, error) pairs as the results are collected, error is None
+        for successful operations
+        """
+        pending = deque()
+        for key, method, arguments in operations:
+            if len(pending) >= window:
+                yield self._pipeline_result(*pending.popleft())
+            pending.append((key, getattr(self.conn, method)(*arguments)))
+        while pending:
+            yield self._pipeline_result(*pending.popleft())
+
+    def _pipeline_result(self, key, msgid):
+        try:
+            self.conn.result(msgid)
+            return key, None
+        except ldap.LDAPError as e:
+            return key, e
+
+    def _modlist(self, entry, changes):
+        """
+        Return the modifications needed to apply changes to entry
+
+        changes is a list of (attribute, value(s)) pairs. Attributes whose
+        stored values already match are skipped and missing ones are added
+        """
+        current = dict((k.lower(), v) for k, v in entry.iteritems())
+        modlist = []
+        for attribute, values in changes:
+            if isinstance(values, basestring):
+                values = [values]
+            stored = current.get(attribute.lower())
+            if stored is None:
+                modlist.append((ldap.MOD_ADD, attribute, values))
+            elif sorted(stored) != sorted(values):
+                modlist.append((ldap.MOD_REPLACE, attribute, values))
+        return modlist
+
+    def _groups(self, groups):
+        """
+        Return the names of the given groups that exist, in one search
+        """
+        if not groups:
+            return []
+        found = []
+        for group_dn, group_attributes in self._search(
+                self.group_basedn, ldap.SCOPE_ONELEVEL,
+                '(|%s)' % ''.join('(cn=%s)' % ldap.filter.escape_filter_chars(group) for group in groups),
+                ['objectClass'], conn=self.conn):
+            group = group_dn.split(',')[0].split('cn=')[1]
+            self._cache_group_type(group, group_attributes)
+            found.append(group)
+        return found
+
+    def _user_groups(self, user):
+        """
+        Return the names of the groups user is a member of
+
+        Uses a single server side filter on memberUid and member instead of
+        reading the member lists of every group
+        """
+        user_dn = "uid=%s,%s" % (user, self.user_basedn)
+        groups = []
+        for group_dn, group_attributes in self._search(
+                self.group_basedn, ldap.SCOPE_SUBTREE,
+                '(|(memberUid=%s)(member=%s))' % (ldap.filter.escape_filter_chars(user),
+                                                  ldap.filter.escape_filter_chars(user_dn)),
+                ['objectClass'], conn=self.conn):
+            group = group_dn.split(',')[0].split('cn=')[1]
+            self._cache_group_type(group, group_attributes)
+            groups.append(group)
+        return groups
+
+    def _member_attribute(self, group):
+        """
+        Return the attribute holding the members of a group
+
+        memberUid for posixGroup and member for groupOfNames. The group type
+        is looked up once and cached for the rest of the invocation
+        """
+        if group not in self._member_attributes:
+            try:
+                entry = self.conn.search_s(self._group_dn(group), ldap.SCOPE_BASE,
+                                           '(objectClass=*)', ['objectClass'])[0][1]
+            except ldap.NO_SUCH_OBJECT:
+                raise NoSuchGroup("Group not found '%s'" % group)
+            self._cache_group_type(group, entry)
+        return self._member_attributes[group]
+
+    def _cache_group_type(self, group, entry):
+        object_classes = [c.lower() for c in entry.get('objectClass', [])]
+        if 'groupofnames' in object_classes:
+            self._member_attributes[group] = 'member'
+        else:
+            self._member_attributes[group] = 'memberUid'
+
+    def _member_value(self, attribute, user):
+        """
+        Return the value identifying user in the given member attribute
+        """
+        if attribute == 'member':
+            return "uid=%s,%s" % (user, self.user_basedn)
+        return user
+
+    def _group_index(self, filterstr='(objectClass=*)'):
+        """
+        Return group memberships indexed by member
+
+        Maps every memberUid value and every member DN to the names of the
+        groups it belongs to, built from a single search of the group tree
+        """
+        return self._index_groups(self._search(self.group_basedn, ldap.SCOPE_SUBTREE,
+                                               filterstr, ['memberUid', 'member']))
+
+    def _closures(self, entries=None):
+        """
+        Return group -> users that are members directly or through nested
+        groups, for all groups
+
+        Built once per invocation from a single search of the group tree,
+        or from the group entries given. member values under the group base
+        are nested groups, others users. Strongly connected groups (Tarjan's
+        algorithm, without recursion) share one closure, so cycles end and
+        are kept in _group_cycles, and every group reuses the closures of
+        the groups nested in it
+        """
+        if self._effective_members is not None:
+            return self._effective_members
+        if entries is None:
+            entries = self._search(self.group_basedn, ldap.SCOPE_SUBTREE,
+                                   '(|(objectclass=posixGroup)(objectclass=groupOfNames))',
+                                   ['objectClass', 'memberUid', 'member'])
+        group_base = dn_key(self.group_basedn)
+        # group name -> (users, nested groups)
+        graph = {}
+        cycles = []
+        for group_dn, group_attributes in entries:
+            name = self._rdn_value(group_dn)
+            self._cache_group_type(name, group_attributes)
+            users, groups = set(group_attributes.get('memberUid', [])), set()
+            for member in group_attributes.get('member', []):
+                if dn_key(member).endswith(',' + group_base):
+                    groups.add(self._rdn_value(member))
+                else:
+                    users.add(self._rdn_value(member))
+            graph[name] = (users, groups)
+
+        closures = {}
+        index = {}
+        low = {}
+        stack = []
+        for root in graph:
+            if root in index:
+                continue
+            index[root] = low[root] = len(index)
+            stack.append(root)
+            work = [(root, iter(graph[root][1]))]
+            while work:
+                group, nested = work[-1]
+                for child in nested:
+                    if child not in graph:
+                        # member DN of a missing group
+                        continue
+                    if child not in index:
+                        index[child] = low[child] = len(index)
+                        stack.append(child)
+                        work.append((child, iter(graph[child][1])))
+                        break
+                    if child not in closures:
+                        # still on the stack: part of the same component
+                        low[group] = min(low[group], index[child])
+                else:
+                    work.pop()
+                    if work:
+                        parent = work[-1][0]
+                        low[parent] = min(low[parent], low[group])
+                    if low[group] != index[group]:
+                        continue
+                    component = stack[stack.index(group):]
+                    del stack[stack.index(group):]
+                    users = set()
+                    for member in component:
+                        users |= graph[member][0]
+                        for child in graph[member][1]:
+                            users |= closures.get(child, set())
+                    if len(component) > 1 or group in graph[group][1]:
+                        logger.debug("Nested groups form a cycle: %s" % ', '.join(sorted(component)))
+                        cycles.append(sorted(component))
+                    for member in component:
+                        closures[member] = users
+        self._effective_members = closures
+        self._group_cycles = sorted(cycles)
+        return closures
+
+    def _index_groups(self, groups):
+        index = {}
+        for group_dn, group_attributes in groups:
+            members = group_attributes.get('memberUid', []) + group_attributes.get('member', [])
+            if not members:
+                continue
+            group = group_dn.split(',')[0].split('cn=')[1]
+            for member in members:
+                index.setdefault(member, []).append(group)
+        return index
+
+    def _getuid(self, uid=None):
+        """
+        Return valid UID
+
+        If no UID provided allocate the next available one
+        Raise an exception if provided UID already exists
+        """
+        if uid:
+            uid = int(uid)
+            minuid, maxuid = self._id_range('uid')
+            if minuid <= uid <= maxuid:
+                if self._id_taken('uid', uid):
+                    # UID already exists - rise exception
+                    raise InvalidId("UID (%s) already exists" % uid)
+                return str(uid)
+            else:
+                raise InvalidId("Invalid UID: %s, Valid range: %s..%s" % (uid, minuid, maxuid))
+        return self._allocate('uid')[0]
+
+    def _getgid(self, gid=None):
+        """
+        Return valid GID
+
+        If no GID provided allocate the next available one
+        """
+        if gid:
+            gid = int(gid)
+            mingid, maxgid = self._id_range('gid')
+            if mingid <= gid <= maxgid:
+                return str(gid)
+            else:
+                raise InvalidId("Invalid GID: %s, Valid range: %s..%s" % (gid, mingid, maxgid))
+        return self._allocate('gid')[0]
+
+    def _id_range(self, kind):
+        section = ID_POOLS[kind][0]
+        return (int(getattr(self, '%s_min%s' % (section, kind), 1500)),
+                int(getattr(self, '%s_max%s' % (section, kind), 2000)))
+
+    def _id_taken(self, kind, number):
+        section, attribute, objectclass = ID_POOLS[kind]
+        return bool(self.conn.search_s(getattr(self, section + '_basedn'),
+                                       ldap.SCOPE_SUBTREE,
+                                       '(&(objectClass=%s)(%s=%d))' % (objectclass, attribute, number),
+                                       [attribute]))
+
+    def _allocate(self, kind, count=1):
+        """
+        Allocate count free UIDs or GIDs (kind is 'uid' or 'gid')
+
+        IDs in use are always read from the providers, a consumer lagging
+        behind would hand out IDs just taken. The allocation method is
+        chosen by the `allocate` option of the user or group section:
+
+        counter     Take IDs from the counter entry configured with `nextdn`,
+                    advanced with an atomic delete+add modify (default when
+                    `nextdn` is set)
+        fill        Reuse the lowest free IDs in the min..max range, found with
+                    a bitmap built in one paged pass (not safe against
+                    concurrent allocations)
+        scan        Use the IDs following the highest one in use (default
+                    without `nextdn`)
+        """
+        section = ID_POOLS[kind][0]
+        method = getattr(self, section + '_allocate',
+                         'counter' if getattr(self, section + '_nextdn', None) else 'scan')
+        if method == 'counter':
+            return self._allocate_counter(kind, count)
+        elif method == 'fill':
+            return self._allocate_fill(kind, count)
+        elif method == 'scan':
+            return self._allocate_scan(kind, count)
+        raise ConfigError("Invalid %s allocate method: %s" % (section, method))
+
+    def _allocate_counter(self, kind, count):
+        section, attribute, objectclass = ID_POOLS[kind]
+        counter_dn = getattr(self, section + '_nextdn')
+        basedn = getattr(self, section + '_basedn')
+        low, high = self._id_range(kind)
+        for attempt in range(ALLOCATE_RETRIES):
+            try:
+                counter = self.conn.search_s(counter_dn, ldap.SCOPE_BASE,
+                                             '(objectClass=*)', [attribute])[0][1]
+            except ldap.NO_SUCH_OBJECT:
+                raise ConfigError("%s counter entry (%s) does not exist" % (kind.upper(), counter_dn))
+            if attribute in counter:
+                current = counter[attribute][0]
+                first = max(int(current), low)
+            else:
+                # seed an empty counter from the highest ID in use
+                current = None
+                first = int(self._allocate_scan(kind, 1)[0])
+            # IDs above the counter may have been set explicitly (--uid),
+            # fetch just those instead of every ID in the tree
+            taken = set(int(entry[attribute][0]) for dn, entry in
+                        self._search(basedn, ldap.SCOPE_SUBTREE,
+                                     '(&(objectClass=%s)(%s>=%d))' % (objectclass, attribute, first),
+                                     [attribute], conn=self.conn))
+            ids = []
+            number = first
+            while len(ids) < count:
+                if number > high:
+                    raise LdapUserError("No free %s left in range %s..%s" % (kind.upper(), low, high))
+                if number not in taken:
+                    ids.append(str(number))
+                number += 1
+            if current is None:
+                modlist = [(ldap.MOD_ADD, attribute, [str(number)])]
+            else:
+                modlist = [(ldap.MOD_DELETE, attribute, [current]),
+                           (ldap.MOD_ADD, attribute, [str(number)])]
+            try:
+                self.conn.modify_s(counter_dn, modlist)
+                return ids
+            except (ldap.NO_SUCH_ATTRIBUTE, ldap.TYPE_OR_VALUE_EXISTS,
+                    ldap.CONSTRAINT_VIOLATION):
+                # the counter moved under us - another client allocated first
+                logger.debug("%s counter changed, retrying allocation" % kind.upper())
+        raise LdapUserError("Could not allocate %s after %d attempts" % (kind.upper(), ALLOCATE_RETRIES))
+
+    def _allocate_fill(self, kind, count):
+        section, attribute, objectclass = ID_POOLS[kind]
+        low, high = self._id_range(kind)
+        used = bytearray((high - low) // 8 + 1)
+        for dn, entry in self._search(getattr(self, section + '_basedn'),
+                                      ldap.SCOPE_SUBTREE,
+                                      '(&(objectClass=%s)(%s>=%d)(%s<=%d))' %
+                                      (objectclass, attribute, low, attribute, high),
+                                      [attribute], conn=self.conn):
+            offset = int(entry[attribute][0]) - low
+            if 0 <= offset <= high - low:
+                used[offset >> 3] |= 1 << (offset & 7)
+        ids = []
+        for offset in xrange(high - low + 1):
+            if not used[offset >> 3] & (1 << (offset & 7)):
+                ids.append(str(low + offset))
+                if len(ids) == count:
+                    return ids
+        raise LdapUserError("No free %s left in range %s..%s" % (kind.upper(), low, high))
+
+    def _allocate_scan(self, kind, count):
+        section, attribute, objectclass = ID_POOLS[kind]
+        low, high = self._id_range(kind)
+        last = None
+        for dn, entry in self._search(getattr(self, section + '_basedn'),
+                                      ldap.SCOPE_SUBTREE,
+                                      'objectClass=%s' % objectclass,
+                                      [attribute], conn=self.conn):
+            number = int(entry[attribute][0])
+            if low <= number <= high and (last is None or number > last):
+                last = number
+        first = low if last is None else last + 1
+        if first + count - 1 > high:
+            raise LdapUserError("No free %s left in range %s..%s" % (kind.upper(), low, high))
+        return [str(free) for free in range(first, first + count)]
+
+    def _getpass(self, password=None, size=9, chars=ascii_lowercase + ascii_uppercase + digits):
+        if not password:
+            password = ''.join(choice(chars) for x in range(size))
+        salt = os.urandom(4)
+        h = hashlib.sha1(password)
+        h.update(salt)
+        return password, '{SSHA}' + base64.encodestring(h.digest() + salt)[:-1]
+
+
+class ldapuser(Directory):
+    """
+    Command line interface on top of Directory
+
+    Every command is a method whose docstring holds its usage
+    """
+    def __init__(self, config=None):
+        try:
+            Directory.__init__(self, config)
+        except ConfigError as e:
+            logger.error("%s" % e)
+            sys.exit(1)
+
+    def serve(self, args):
+        """
+        Serves ldapuser commands over a local Unix socket
+
+        Usage: ldapuser serve [--socket PATH] [--pool SIZE]
+
+        Options:
+        --socket PATH       Socket to listen on (default: serve.socket from the config file)
+        --pool SIZE         Number of bound LDAP connections (default: serve.pool or 4)
+
+        Clients forward their commands when LDAPUSER_SOCKET is set to the socket
+        path. The socket is only accessible by the user running the server and
+        file arguments are opened by the server, so pass absolute paths.
+        """
+        path = args.get('--socket') or getattr(self, 'serve_socket', DEFAULT_SOCKET)
+        size = int(args.get('--pool') or getattr(self, 'serve_pool', 4))
+
+        if os.path.exists(path):
+            try:
+                forward(path, ['--version'], open(os.devnull, 'w'))
+                logger.error("ldapuser server already running on %s" % path)
+                sys.exit(1)
+            except socket.error:
+                # stale socket from a previous server
+                os.unlink(path)
+
+        pool = ConnectionPool([self] + [ldapuser() for i in range(size - 1)],
+                              float(getattr(self, 'serve_check', 30)))
+        server = CommandServer(path, pool)
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        logger.info("Serving ldapuser commands on %s with %d connections" % (path, size))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            os.unlink(path)
+
+    def bulk_import(self, args):
+        """
+        Imports users and groups from a CSV or LDIF file
+
+        Usage: ldapuser import [--format FORMAT] [--window SIZE] <file>
+
+        Options:
+        --format FORMAT     Input format: csv or ldif, guessed from the file extension by default
+        --window SIZE       Maximum number of LDAP operations in flight [default: 64]
+
+        CSV files start with a header row. User rows have a `user` column and may
+        set uid, gid, groups, pass, home, shell, sshkey, host and mail; group rows
+        have a `group` column and may set gid, members and groupofnames. Lists of
+        groups, members and hosts are comma separated.
+
+        LDIF entries are added as they are, posixAccount and posixGroup entries
+        without uidNumber or gidNumber get newly allocated IDs.
+        """
+        path = args.get('<file>')
+        input_format = (args.get('--format') or os.path.splitext(path)[1][1:]).lower()
+        window = int(args.get('--window') or 64)
+        try:
+            with open(path) as f:
+                if input_format == 'csv':
+                    records = list(csv.DictReader(f))
+                elif input_format == 'ldif':
+                    records = []
+                    parser = ldif.LDIFParser(f)
+                    parser.handle = lambda dn, entry: records.append({'dn': dn, 'entry': entry})
+                    parser.parse()
+                else:
+                    logger.error("Unknown import format: '%s'" % input_format)
+                    sys.exit(1)
+        except IOError:
+            logger.error("Can't open import file: %s" % path)
+            sys.exit(1)
+
+        users = {}
+        for record in records:
+            if record.get('user'):
+                if record.get('host'):
+                    record['host'] = self._gethosts([record['host']])
+                users[record['user']] = record
+
+        failed = 0
+        for kind, name, error in self.import_records(records, window):
+            if kind == 'member':
+                if error:
+                    failed += 1
+                    print "[FAILED] member '%s' of group '%s': %s" % (name[0], name[1], ldap_error(error))
+                else:
+                    print "[OK] member '%s' of group '%s'" % name
+            elif error:
+                failed += 1
+                print "[FAILED] %s '%s': %s" % (kind, name, ldap_error(error))
+            elif kind == 'user':
+                print "[OK] user '%s' created with password: %s" % (name, users[name]['pass'])
+            else:
+                print "[OK] %s '%s' created" % (kind, name)
+
+        logger.info("Imported %d records, %d operations failed" % (len(records), failed))
+        if failed:
+            sys.exit(1)
+
+    def export(self, args):
+        """
+        Exports users and groups to LDIF
+
+        Usage: ldapuser export [--gzip] [--output FILE]
+
+        Options:
+        --gzip              Compress the output, the default for FILE ending in .gz
+        --output FILE       File to write to instead of the standard output
+
+        Entries are written as the pages of the searches arrive.
+        """
+        path = args.get('--output')
+        compress = args.get('--gzip') or (path or '').endswith('.gz')
+        try:
+            f = open(path, 'wb') if path and path != '-' else sys.stdout
+        except IOError as e:
+            logger.error("Can't open export file: %s" % e)
+            sys.exit(1)
+        stream = gzip.GzipFile(fileobj=f, mode='wb') if compress else f
+        writer = ldif.LDIFWriter(stream)
+        count = 0
+        try:
+            for dn, attributes in self.iter_entries():
+                writer.unparse(dn, attributes)
+                count += 1
+        finally:
+            if compress:
+                stream.close()
+            if f is not sys.stdout:
+                f.close()
+            else:
+                f.flush()
+        logger.info("Exported %d entries" % count)
+
+    def diff(self, args):
+        """
+        Compares two exports, or an export with the directory
+
+        Usage: ldapuser diff [--chunk SIZE] <old> [<new>]
+
+        Options:
+        --chunk SIZE        Entries sorted in memory at once [default: 10000]
+
+        Exports are LDIF files as written by `ldapuser export`, compressed or
+        not. Without <new> the current users and groups are compared with <old>.
+        Both sides are sorted by DN through temporary files and merged, so
+        memory use does not grow with their size. Added entries are shown with
+        +, removed ones with - and changed ones with ~ followed by the values
+        removed and added. Exits with 1 when there are differences.
+        """
+        chunk = int(args.get('--chunk') or 10000)
+        old = self._sorted_ldif(args.get('<old>'), chunk)
+        if args.get('<new>'):
+            new = self._sorted_ldif(args.get('<new>'), chunk)
+        else:
+            new = ExternalSort(chunk)
+            for dn, attributes in self.iter_entries():
+                new.add(dn, attributes)
+
+        changes = 0
+        try:
+            for change, dn, removed, added in diff_entries(iter(old), iter(new)):
+                changes += 1
+                print "%s %s" % (change, dn)
+                for attribute, value in removed:
+                    print "    - %s" % ldif_value(attribute, value)
+                for attribute, value in added:
+                    print "    + %s" % ldif_value(attribute, value)
+        finally:
+            old.close()
+            new.close()
+        logger.info("%d entries differ" % changes)
+        if changes:
+            sys.exit(1)
+
+    def _sorted_ldif(self, path, chunk):
+        """
+        Return the entries of an LDIF file, plain or gzip, sorted by DN
+        """
+        try:
+            f = open(path, 'rb')
+            if f.read(2) == '\x1f\x8b':
+                f.seek(0)
+                f = gzip.GzipFile(fileobj=f, mode='rb')
+            else:
+                f.seek(0)
+        except IOError as e:
+            logger.error("Can't open LDIF file: %s" % e)
+            sys.exit(1)
+        entries = ExternalSort(chunk)
+        parser = ldif.LDIFParser(f)
+        parser.handle = entries.add
+        try:
+            parser.parse()
+        finally:
+            f.close()
+        return entries
+
+    def plan(self, args):
+        """
+        Shows the changes bringing users and groups to a desired state
+
+        Usage: ldapuser plan [--prune] <file>
+
+        Options:
+        --prune             Also delete the users and groups missing from <file>
+
+        <file> is JSON, or YAML when named *.yaml or *.yml and PyYAML is
+        installed, with users and groups maps:
+
+            {"users": {"alice": {"shell": "/bin/zsh", "groups": ["devs"],
+                                 "hosts": ["web01"]}},
+             "groups": {"devs": {"gid": 2000}}}
+
+        Users may set uid, gid, home, shell, gecos, mail, sshkey, hosts,
+        groups and password (new users only), groups may set gid, members
+        and groupofnames. Only the attributes given are managed. A user
+        listing its groups leaves the others, a group listing its members
+        keeps only them and the users listing it.
+
+        Added entries are shown with +, changed ones with ~ followed by the
+        values added (+), removed (-) or replaced (=) and deleted ones with -.
+        """
+        operations = self.plan_state(self._load_state(args.get('<file>')), args.get('--prune'))
+        self._show_plan(operations)
+
+    def apply(self, args):
+        """
+        Brings users and groups to a desired state
+
+        Usage: ldapuser apply [--prune] [--window SIZE] <file>
+
+        Options:
+        --prune             Also delete the users and groups missing from <file>
+        --window SIZE       Maximum number of LDAP operations in flight [default: 64]
+
+        Shows the plan, see `ldapuser help plan`, then runs its operations.
+        """
+        state = self._load_state(args.get('<file>'))
+        operations = self.plan_state(state, args.get('--prune'), conn=self.conn)
+        self._show_plan(operations)
+        if not operations:
+            return
+        created = set(name for (kind, name), method, arguments in operations
+                      if kind == 'user' and method == 'add')
+        failed = 0
+        for (kind, name), error in self.apply_plan(operations, int(args.get('--window') or 64)):
+            if error:
+                failed += 1
+                print "[FAILED] %s '%s': %s" % (kind, name, ldap_error(error))
+            elif kind == 'user' and name in created:
+                print "[OK] user '%s' created with password: %s" % (name, state['users'][name]['password'])
+            else:
+                print "[OK] %s '%s'" % (kind, name)
+
+        logger.info("Applied %d operations, %d failed" % (len(operations), failed))
+        if failed:
+            sys.exit(1)
+
+    def _load_state(self, path):
+        try:
+            with open(path) as f:
+                if os.path.splitext(path)[1].lower() in ('.yaml', '.yml'):
+                    try:
+                        import yaml
+                    except ImportError:
+                        logger.error("Reading YAML needs PyYAML, use JSON instead")
+                        sys.exit(1)
+                    return utf8(yaml.safe_load(f) or {})
+                return utf8(json.load(f))
+        except IOError:
+            logger.error("Can't open state file: %s" % path)
+            sys.exit(1)
+        except ValueError as e:
+            logger.error("Invalid state file %s: %s" % (path, e))
+            sys.exit(1)
+
+    def _show_plan(self, operations):
+        signs = {ldap.MOD_ADD: '+', ldap.MOD_DELETE: '-', ldap.MOD_REPLACE: '='}
+        counts = dict((method, 0) for method in ('add', 'modify', 'delete'))
+        for (kind, name), method, arguments in operations:
+            counts[method] += 1
+            print "%s %s %s" % ({'add': '+', 'modify': '~', 'delete': '-'}[method], kind, name)
+            if method == 'modify':
+                for operation, attribute, values in arguments[1]:
+                    for value in values:
+                        print "    %s %s" % (signs[operation], ldif_value(attribute, value))
+        logger.info("Plan: %(add)d to add, %(modify)d to change, %(delete)d to delete" % counts)
+
+    def check(self, args):
+        """
+        Checks users and groups for inconsistencies
+
+        Usage: ldapuser check [--fix] [--window SIZE]
+
+        Options:
+        --fix               Repair what can be repaired safely
+        --window SIZE       Maximum number of LDAP operations in flight [default: 64]
+
+        Reports memberUid and member values naming no user or group, uid and
+        gid numbers used twice or outside the configured ranges, users whose
+        gidNumber has no posixGroup and cycles of nested groups. --fix
+        removes the dangling values, with one modify per group, and creates
+        the missing primary group of users not sharing their gidNumber. IDs
+        are never renumbered. Exits with 1 when problems are left.
+        """
+        # repairs are decided from the providers they are written to
+        conn = self.conn if args.get('--fix') else None
+        problems, operations = self.check_consistency(conn)
+        for check, kind, name, detail in problems:
+            print "[%s] %s '%s': %s" % (check, kind, name, detail)
+        logger.info("Found %d problems, %d can be fixed" % (len(problems), len(operations)))
+        if not args.get('--fix') or not operations:
+            if problems:
+                sys.exit(1)
+            return
+
+        failed = 0
+        for (kind, name), error in self.apply_plan(operations, int(args.get('--window') or 64)):
+            if error:
+                failed += 1
+                print "[FAILED] %s '%s': %s" % (kind, name, ldap_error(error))
+            else:
+                print "[OK] %s '%s'" % (kind, name)
+        logger.info("Applied %d fixes, %d failed" % (len(operations), failed))
+        if failed or self.check_consistency(conn)[0]:
+            sys.exit(1)
+
+    def export_maps(self, args):
+        """
+        Writes passwd, group and shadow files for a host
+
+        Usage: ldapuser export-maps --host HOST [--output DIR] [--full]
+
+        Options:
+        --host HOST         Host whose users are written
+        --output DIR        Directory the maps are written to [default: .]
+        --full              Read every entry instead of the changes since the last run
+
+        The users with the host value and the posixGroups are kept in
+        DIR/.ldapuser-maps, so later runs only read the entries
+        modified since (by modifyTimestamp) and the DNs of the others.
+        Files are replaced atomically, shadow is only readable by its owner.
+        """
+        host = args.get('--host')
+        output = args.get('--output') or '.'
+        cache = os.path.join(output, '.ldapuser-maps')
+        entries = None
+        if not args.get('--full'):
+            try:
+                with open(cache, 'rb') as f:
+                    entries = marshal.load(f)
+            except (IOError, EOFError, ValueError, TypeError):
+                pass
+        entries = self.host_entries(host, entries)
+        maps = self.host_maps(entries)
+        try:
+            for name, lines in sorted(maps.iteritems()):
+                self._write_atomic(os.path.join(output, name), ''.join(line + '\n' for line in lines),
+                                   0600 if name == 'shadow' else 0644)
+            self._write_atomic(cache, marshal.dumps(entries), 0600)
+        except (IOError, OSError) as e:
+            logger.error("Can't write maps to %s: %s" % (output, e))
+            sys.exit(1)
+        logger.info("Read %d entries, wrote %d users and %d groups for host '%s'" %
+                    (entries['fetched'], len(maps['passwd']), len(maps['group']), host))
+
+    def _write_atomic(self, path, data, mode):
+        f = tempfile.NamedTemporaryFile(dir=os.path.dirname(path) or '.', delete=False)
+        try:
+            f.write(data)
+            f.close()
+            os.chmod(f.name, mode)
+            os.rename(f.name, path)
+        except Exception:
+            os.unlink(f.name)
+            raise
+
+    def sync(self, args):
+        """
+        Refreshes the local snapshot read by --cached
+
+        Usage: ldapuser sync [--full]
+
+        Options:
+        --full              Read every entry again instead of the changes
+
+        The snapshot is kept in the file set by the path option of the cache
+        section, see ldapuser.conf. Read-only commands run with --cached, or
+        all of them with the enabled option, read users and groups from it
+        after syncing it when it is older than max_staleness seconds or
+        other commands may have written since. Commands that write, or plan
+        writes, always read from the directory. Changes
+        are read with syncrepl or by modifyTimestamp, see the sync option.
+        Running this from cron keeps the snapshot fresh between commands.
+        """
+        snapshot = self._snapshot()
+        try:
+            changes = snapshot.sync(self, full=args.get('--full'))
+        finally:
+            snapshot.close()
+        logger.info("Snapshot synced, %d entries read or deleted" % changes)
+
+    def keys(self, args):
+        """
+        Prints the SSH public keys of a user
+
+        Usage: ldapuser keys [--host HOST] [--refresh] <user>
+
+        Options:
+        --host HOST         Print nothing unless user has access to HOST
+        --refresh           Read the keys from the directory even when cached
+
+        Meant for the sshd AuthorizedKeysCommand. The keys are cached in the
+        file set by the cache option of the keys section: fresh entries are
+        answered without contacting the directory, stale ones are answered
+        right away while a background process reads them again, and when
+        the directory can't be reached the last keys read are used.
+        """
+        name = args.get('<user>')
+        cache = self._key_cache()
+        now = time.time()
+        cached = cache and cache.get(name)
+        if cached and not args.get('--refresh'):
+            found, keys, hosts, fetched = cached
+            ttl = cache.ttl if found else cache.negative_ttl
+            if now - fetched < ttl + cache.stale:
+                if now - fetched >= ttl and cache.claim(name, now):
+                    self._refresh_keys(cache, name)
+                return self._print_keys(name, found, keys, hosts, args.get('--host'))
+
+        try:
+            found, keys, hosts = self._read_keys(name)
+        except ldap.LDAPError as e:
+            if not cached:
+                raise
+            logger.warning("Using the cached keys of '%s': %s" % (name, ldap_error(e)))
+            found, keys, hosts = cached[:3]
+        else:
+            if cache:
+                cache.put(name, found, keys, hosts, now)
+        self._print_keys(name, found, keys, hosts, args.get('--host'))
+
+    def _key_cache(self):
+        path = getattr(self, 'keys_cache', None)
+        if not path:
+            return None
+        try:
+            return KeyCache(path, float(getattr(self, 'keys_ttl', 300)),
+                            float(getattr(self, 'keys_negative_ttl', 60)),
+                            float(getattr(self, 'keys_stale', 86400)))
+        except sqlite3.Error as e:
+            logger.warning("Can't open key cache %s: %s" % (path, e))
+            return None
+
+    def _read_keys(self, name):
+        """
+        Return whether user name exists, its keys and its hosts
+        """
+        try:
+            user = self.get_user(name, ['sshPublicKey', 'host'])
+        except NoSuchUser:
+            return False, [], []
+        return True, user.ssh_keys, user.hosts
+
+    def _refresh_keys(self, cache, name):
+        """
+        Read the keys of user name again and cache them
+
+        A forked child does it so the cached keys are answered right away,
+        except when serving where the pooled connection is used in place
+        """
+        if isinstance(sys.stdout, ThreadLocalStream):
+            try:
+                cache.put(name, *self._read_keys(name) + (time.time(),))
+            except ldap.LDAPError as e:
+                logger.warning("Can't refresh the keys of '%s': %s" % (name, ldap_error(e)))
+            return
+        sys.stdout.flush()
+        sys.stderr.flush()
+        if os.fork():
+            return
+        status = 1
+        try:
+            os.setsid()
+            # let sshd see the output end as soon as the parent exits
+            devnull = os.open(os.devnull, os.O_RDWR)
+            for fd in (0, 1, 2):
+                os.dup2(devnull, fd)
+            self._connect()
+            cache = KeyCache(cache.path)
+            cache.put(name, *self._read_keys(name) + (time.time(),))
+            status = 0
+        finally:
+            os._exit(status)
+
+    def _print_keys(self, name, found, keys, hosts, host=None):
+        if not found:
+            logger.warning("User not found '%s'" % name)
+        elif host and not [value for value in hosts if host_matches(value, host)]:
+            logger.warning("User '%s' has no access to host '%s'" % (name, host))
+        else:
+            for key in keys:
+                print key
+
+    def user(self):
+        """
+        Valid commands are:
+
+        user create         Create a new user
+        user update         Updates an user
+        user delete         Deletes an user
+        user show           Shows info about user(s)
+        user hosts          Shows the hosts an user has access to
+        user groups         Shows the groups of an user
+
+        Use `ldapuser help [command]` to learn more
+        """
+        sys.exit(1)
+
+    def user_hosts(self, args):
+        """
+        Shows the hosts an user has access to
+
+        Usage: ldapuser user hosts [--json] <user>
+
+        Options:
+        --json              Shows the hosts as a JSON list
+        """
+        hosts = self.get_user_hosts(args.get('<user>'))
+        if args.get('--json'):
+            print json.dumps(hosts)
+        else:
+            for host in hosts:
+                print host
+
+    def user_memberships(self, args):
+        """
+        Shows the groups of an user
+
+        Usage: ldapuser user groups [--effective] [--json] <user>
+
+        Options:
+        --effective         Also shows the groups user belongs to through nested groups
+        --json              Shows the groups as a JSON list
+        """
+        user = args.get('<user>')
+        if args.get('--effective'):
+            groups = self.effective_groups(user)
+        else:
+            groups = sorted(self.get_user(user, ['group']).groups)
+        if args.get('--json'):
+            print json.dumps(groups)
+        else:
+            for group in groups:
+                print group
+
+    def user_create(self, args):
+        """
+        Create a new user
+
+        Usage: ldapuser user create [--uid UID] [--gid GID] [--group GROUP ...] [--pass PASSWORD]
+                                  [--home HOME] [--shell SHELL] [--gecos GECOS] [--sshkey SSHKEY]
+                                  [--host HOST ...] [--mail MAIL] <user>
+
+        Options:
+        --uid UID               User ID
+        --gid GID               Group ID
+        --group GROUP           Additional groups user belongs to
+        --pass PASSWORD         Password
+        --home HOME             Home directory
+        --shell SHELL           Default shell
+        --gecos GECOS           Gecos
+        --sshkey SSHKEY         Public SSH key
+        --host HOST             Hosts user has an access to
+        --mail MAIL
+
+        """
+        user = args.get('<user>')
+        sshkey = self._getsshkey(args.get('--sshkey'))
+
+        errors = []
+        try:
+            new_user = self.create_user(user, uid=args.get('--uid'), gid=args.get('--gid'),
+                                        groups=args.get('--group'), password=args.get('--pass'),
+                                        home=args.get('--home'), shell=args.get('--shell'),
+                                        mail=args.get('--mail'), sshkey=sshkey,
+                                        hosts=self._gethosts(args.get('--host')))
+        except AlreadyExists as e:
+            logger.error(e)
+            return
+        except PartialFailure as e:
+            new_user, errors = e.result, e.errors
+        logger.info("User '%s' created successfully with password: %s" %
+                    (user, new_user.password))
+        for group in new_user.groups:
+            logger.info("Added '%s' to group '%s'" % (user, group))
+        if errors:
+            for (kind, group), error in errors:
+                if kind == 'group':
+                    logger.error("Error creating group '%s': %s" % (group, ldap_error(error)))
+                else:
+                    logger.error("Error adding '%s' to a group '%s': %s" % (user, group, ldap_error(error)))
+            sys.exit(1)
+
+    def user_update(self, args):
+        """
+        Updates an user
+
+        Usage: ldapuser user update [--uid UID] [--gid GID] [--group GROUP ...] [--pass PASSWORD]
+                                  [--home HOME] [--shell SHELL] [--gecos GECOS] [--sshkey SSHKEY]
+                                  [--host HOST ...]  [--mail MAIL] <user>
+
+        Options:
         --uid UID               User ID
         --gid GID               Group ID
         --group GROUP           Additional groups user belongs to
@@ -179,538 +2823,1431 @@ class ldapuser():
         --mail MAIL             User email address
 
         """
-        user = args.get('<user>')
-        uidNumber = args.get('--uid')
-        gidNumber = args.get('--gid')
-        groups = args.get('--group')
-        userPassword = args.get('--pass')
-        homeDirectory = args.get('--home')
-        loginShell = args.get('--shell')
-        givenName = args.get('--gecos')
-        sshPublicKey = args.get('--sshkey')
-        host = self._gethosts(args.get('--host'))
-        mail = args.get('--mail')
-
-        if userPassword:
-            userPassword = self._getpass(userPassword)
-            clearTextPassword = userPassword[0]
+        user = args.get('<user>')
+        groups = args.get('--group')
+        password = args.get('--pass')
+
+        modlist = self.update_user(user, uid=args.get('--uid'), gid=args.get('--gid'),
+                                   password=password, home=args.get('--home'),
+                                   shell=args.get('--shell'), gecos=args.get('--gecos'),
+                                   sshkey=self._getsshkey(args.get('--sshkey')),
+                                   hosts=self._gethosts(args.get('--host')), mail=args.get('--mail'))
+        if modlist:
+            logger.info("User '%s' updated successfuly with password: %s" %
+                        (user, password or "*UNCHANGED*"))
+        else:
+            logger.info("User '%s' is up to date" % user)
+
+        if groups:
+            added, removed = self.set_user_groups(user, groups)
+            for group in removed:
+                logger.info("Deleted '%s' from a group '%s'" % (user, group))
+            for group in added:
+                logger.info("Added '%s' to group '%s'" % (user, group))
+
+    def user_delete(self, args):
+        """
+        Deletes a user
+
+        Usage: ldapuser user delete <user>
+
+        """
+        user = args.get('<user>')
+        self.delete_user(user)
+        logger.info("User '%s' deleted successfully" % user)
+
+    def user_show(self, args):
+        """
+        Shows info about user(s)
+
+        Usage: ldapuser user show [--json | --ndjson] [--filter FILTER ...] [--attrs ATTRS] [<user>]
+
+        Options:
+        --json              Shows information as a single JSON document
+        --ndjson            Shows information as JSON, one user per line
+        --filter FILTER     Only shows users matching attribute=value, * matches any
+                            text, attribute>=value and attribute<=value compare values.
+                            Repeated filters must all match
+        --attrs ATTRS       Comma separated attributes to show, `group` for the groups
+
+        """
+        user = args.get('<user>')
+        filters = args.get('--filter') or []
+        attributes = None
+        if args.get('--attrs'):
+            attributes = [a.strip() for a in args.get('--attrs').split(',') if a.strip()]
+        if user and not filters:
+            users = [self.get_user(user, attributes)]
+        else:
+            filterstr = attribute_filter(filters)
+            if user:
+                filterstr = '(&(uid=%s)%s)' % (ldap.filter.escape_filter_chars(user), filterstr)
+            users = self.iter_users(filterstr, attributes)
+
+        logger.info(' Searching for user data...')
+        writer = self._writer(args, hidden=() if attributes else ('cn', 'sn', 'objectClass'))
+        for user in users:
+            writer.write(user.name, user.dn, user.attributes)
+        writer.close()
+
+    def host(self):
+        """
+        Valid commands are:
+
+        host show           Shows the users with access to a host
+        host index          Shows the users with access to every host
+
+        Use `ldapuser help [command]` to learn more
+        """
+        sys.exit(1)
+
+    def host_show(self, args):
+        """
+        Shows the users with access to a host
+
+        Usage: ldapuser host show [--json] <host>
+
+        Options:
+        --json              Shows the users as a JSON list
+
+        <host> may contain * matching any text, users with the host value *
+        have access to every host.
+        """
+        users = self.host_users(args.get('<host>'))
+        if args.get('--json'):
+            print json.dumps(users)
+        else:
+            for user in users:
+                print user
+
+    def host_index(self, args):
+        """
+        Shows the users with access to every host
+
+        Usage: ldapuser host index [--json] [<host>]
+
+        Options:
+        --json              Shows a JSON object of host -> users
+
+        The index is built from one search of the users. <host> limits it to
+        the matching hosts, * matches any text. Users with access to every
+        host are listed under *.
+        """
+        index = self.index_hosts(args.get('<host>'))
+        if args.get('--json'):
+            print json.dumps(index, sort_keys=True)
+        else:
+            for host in sorted(index):
+                print "%s: %s" % (host, ' '.join(index[host]))
+
+    def group(self):
+        """
+        Valid commands are:
+
+        group create         Create a new group
+        group update         Updates a group
+        group delete         Deletes a group
+        group show           Shows info about a group(s)
+        group member         Manages group members
+
+        Use `ldapuser help [command]` to learn more
+        """
+        sys.exit(1)
+
+    def group_member(self, args):
+        """
+        Manages group members
+
+        Usage: ldapuser group member [--effective] <group>
+               ldapuser group member [--add <user>] <group>
+               ldapuser group member [--del <user>] <group>
+               ldapuser group member [--update <user> ...] <group>
+
+               <group> Shows group memberships
+               --effective           Shows the users that are members through nested groups too
+               --add <user> <group>  Adds comma separated list of users to a group membership
+               --del <user> <group>  Removes comma separated list of users from a group membership
+               --update <user> <group> Updates membership
+        """
+        delete = args.get('--del')
+        add = args.get('--add')
+        update = args.get('--update')
+        group = args.get('<group>')
+
+        if add:
+            self.group_create_member({'group': group, 'user': add.split(',')})
+        elif delete:
+            self.group_delete_member({'group': group, 'user': delete.split(',')})
+        elif update:
+            self.group_update_member({'group': group, 'user': update})
+        else:
+            self.group_show_member({'group': group, 'effective': args.get('--effective')})
+
+    def group_create(self, args):
+        """
+        Create a new group
+
+        Usage: ldapuser group create [(--groupofnames --member USER ...) | --gid GID [--member USER ...]] <group>
+
+        --gid <gid>             Group ID
+        --groupofnames          Specifies groupOfNames type [default: posixGroup]
+        --member USER ...       Specifies members that belong to the group
+
+        """
+        group = args.get('<group>')
+        try:
+            self.create_group(group, gid=args.get('--gid'), members=args.get('--member'),
+                              groupofnames=args.get('--groupofnames'))
+            logger.info("Group '%s' created successfully" % group)
+        except AlreadyExists as e:
+            logger.error(e)
+
+    def group_delete(self, args):
+        """
+        Deletes a group
+
+        Usage: ldapuser group delete <group>
+
+        """
+        group = args.get('<group>')
+        try:
+            self.delete_group(group)
+            logger.info("Group '%s' deleted successfully" % group)
+        except NoSuchGroup as e:
+            logger.error(e)
+
+    def group_update(self, args):
+        """
+        Updates a  group
+
+        Usage: ldapuser group update [options] <group>
+
+        --gid <gid>             Group ID
+
+        """
+        group = args.get('<group>')
+        if self.update_group(group, gid=args.get('--gid')):
+            logger.info("Group '%s' modified successfully" % group)
+        else:
+            logger.info("Group '%s' is up to date" % group)
+
+    def group_show(self, args):
+        """
+        Shows group information
+
+        Usage: ldapuser group show [--json | --ndjson] [<group>]
+
+        Options:
+        --json              Shows information as a single JSON document
+        --ndjson            Shows information as JSON, one group per line
+
+        """
+        group = args.get('<group>')
+        groups = [self.get_group(group)] if group else self.iter_groups()
+
+        logger.info('Searching for group data...')
+        writer = self._writer(args, hidden=('cn', 'sn'))
+        for group in groups:
+            writer.write(group.name, group.dn, group.attributes)
+        writer.close()
+
+    def group_create_member(self, args):
+        """
+        Adds users to a group
+        """
+        group = args.get('group')
+        users = args.get('user')
+        added = self.add_members(group, users)
+        for user in users:
+            if user in added:
+                logger.info("Added '%s' to group '%s'" % (user, group))
+            else:
+                logger.info("'%s' is already a member of group '%s'" % (user, group))
+
+    def group_delete_member(self, args):
+        """
+        Deletes users from a group
+        """
+        group = args.get('group')
+        users = args.get('user')
+        removed = self.remove_members(group, users)
+        for user in users:
+            if user in removed:
+                logger.info("Deleted '%s' from a group '%s'" % (user, group))
+            else:
+                logger.info("'%s' is not a member of group '%s'" % (user, group))
+
+    def group_update_member(self, args):
+        """
+        Replaces the members of a group
+        """
+        group = args.get('group')
+        members = self.set_members(group, args.get('user'))
+        logger.info("Updated members of '%s'. Current members:" % group)
+        for idx, member in enumerate(members):
+            print "[%s] '%s'" % (idx, member)
+
+    def group_show_member(self, args):
+        """
+        Shows members of a group
+        """
+        if args.get('effective'):
+            members = self.effective_members(args.get('group'))
+            logger.info("Searching group '%s'. Current members, with nested groups:" % args.get('group'))
+        else:
+            group = self.get_group(args.get('group'))
+            logger.info("Searching group '%s'. Current members:" % group.name)
+            members = group.attributes.get('memberUid', []) + group.attributes.get('member', [])
+        for idx, member in enumerate(members):
+            print "[%s] '%s'" % (idx, member)
+
+    def _writer(self, args, hidden=()):
+        """
+        Return the output writer selected by the --json/--ndjson flags
+        """
+        if args.get('--json'):
+            return JSONWriter(sys.stdout)
+        if args.get('--ndjson'):
+            return NDJSONWriter(sys.stdout)
+        return TextWriter(sys.stdout, hidden)
+
+    def _getsshkey(self, sshkey=None):
+        """
+        Return the first line of the given ssh key file
+        """
+        if not sshkey:
+            return None
+        try:
+            with open(sshkey) as f:
+                return f.readlines()[0].strip()
+        except:
+            logger.error("Can't open ssh key file: %s" % sshkey)
+            sys.exit(1)
+
+    def _gethosts(self, host=None):
+        for h in host:
+            if h and (h.startswith('/') or h.startswith('./')):
+                try:
+                    host_file = open(h)
+                except IOError:
+                    logger.error("Can't open host file: %s" % host)
+                    sys.exit(1)
+                hosts = []
+                for line in host_file.readlines():
+                    hosts.append(line.rstrip())
+                return hosts
+            elif h and ',' in h:
+                return h.split(',')
+            else:
+                return host
+        return None
+
+
+class Pending(object):
+    """
+    Result of an operation sent by AsyncDirectory
+
+    Once done is set either result holds the value of the operation or
+    error the exception it failed with. Callbacks added with add_callback
+    are called with the Pending when it is done
+    """
+    def __init__(self, client):
+        self.client = client
+        self.done = False
+        self.result = None
+        self.error = None
+        self.callbacks = []
+
+    def add_callback(self, callback):
+        if self.done:
+            callback(self)
+        else:
+            self.callbacks.append(callback)
+
+    def wait(self):
+        """
+        Poll the client until the operation is done and return its result
+        """
+        self.client.wait([self])
+        if self.error:
+            raise self.error
+        return self.result
+
+    def _finish(self, result=None, error=None):
+        self.done = True
+        self.result = result
+        self.error = error
+        for callback in self.callbacks:
+            callback(self)
+        self.callbacks = []
+
+
+class AsyncDirectory(object):
+    """
+    Directory operations with many requests in flight
+
+    Every operation is sent right away on the least busy of size provider
+    connections using the python-ldap message id API, and returns a
+    Pending. poll() waits on the connection sockets with select and
+    completes the operations whose results arrived, so hundreds of
+    operations progress together on one thread:
+
+        client = AsyncDirectory(Directory())
+        pending = [client.add_members(group, ['alice']) for group in groups]
+        client.wait()
+
+    To drive it from another event loop watch the descriptors returned by
+    filenos() and call poll(0) when one is readable. directory provides the
+    configuration, the group type cache and ID allocation, which stays
+    synchronous. Requests sent to a server that goes down fail with
+    SERVER_DOWN and are not retried. Not thread safe
+    """
+    def __init__(self, directory, size=4):
+        self.directory = directory
+        providers = [uri for role, uri in directory.servers if role == 'provider']
+        self.connections = [FailoverConnection([(providers, False)], directory._bind)
+                            for i in range(size)]
+        # per connection: msgid -> (pending, convert, failed)
+        self.requests = [{} for conn in self.connections]
+
+    def filenos(self):
+        """
+        Return the descriptors of the connections waiting for results
+        """
+        return [self.connections[i].fileno() for i, requests in enumerate(self.requests) if requests]
+
+    def poll(self, timeout=None):
+        """
+        Complete the operations whose results arrived
+
+        Waits up to timeout seconds (forever when None) when no result is
+        ready yet. Returns the number of operations completed
+        """
+        busy = [i for i, requests in enumerate(self.requests) if requests]
+        completed = sum(self._collect(i) for i in busy)
+        if completed or not busy or timeout == 0:
+            return completed
+        select.select([self.connections[i] for i in busy], [], [], timeout)
+        return sum(self._collect(i) for i in busy)
+
+    def wait(self, pendings=None, timeout=None):
+        """
+        Poll until the given operations, or all of them, are done
+
+        Returns False when timeout seconds passed first
+        """
+        deadline = timeout is not None and time.time() + timeout
+        while any(self.requests) and (pendings is None or
+                                      [pending for pending in pendings if not pending.done]):
+            remaining = None
+            if deadline:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+            self.poll(remaining)
+        return True
+
+    def search(self, base, scope, filterstr='(objectClass=*)', attrlist=None):
+        """
+        Search without paging, the server sizelimit applies
+
+        Resolves to a list of (dn, attributes)
+        """
+        return self._send('search_ext', (base, scope, filterstr, attrlist), self._entries)
+
+    def add(self, dn, modlist):
+        return self._send('add', (dn, modlist))
+
+    def modify(self, dn, modlist):
+        return self._send('modify', (dn, modlist))
+
+    def delete(self, dn):
+        return self._send('delete', (dn,))
+
+    def get_user(self, name):
+        """
+        Resolves to the User called name, with its groups
+        """
+        directory = self.directory
+        user_dn = directory._user_dn(name)
+
+        def user(results):
+            users, groups = results
+            if not users:
+                raise NoSuchUser("User not found '%s'" % name)
+            return directory._user(users[0][0], users[0][1], directory._index_groups(groups))
+
+        return self._gather([
+            self._send('search_ext', (user_dn, ldap.SCOPE_BASE, '(objectclass=posixAccount)'),
+                       self._entries, self._raise(ldap.NO_SUCH_OBJECT, NoSuchUser("User not found '%s'" % name))),
+            self.search(directory.group_basedn, ldap.SCOPE_SUBTREE,
+                        '(|(memberUid=%s)(member=%s))' % (ldap.filter.escape_filter_chars(name),
+                                                          ldap.filter.escape_filter_chars(user_dn)),
+                        ['memberUid', 'member'])], user)
+
+    def get_group(self, name):
+        """
+        Resolves to the Group called name
+        """
+        error = NoSuchGroup("Group not found '%s'" % name)
+
+        def group(rdata):
+            groups = self._entries(rdata)
+            if not groups:
+                raise error
+            return self.directory._group(*groups[0])
+
+        return self._send('search_ext', (self.directory._group_dn(name), ldap.SCOPE_BASE,
+                                         '(|(objectclass=posixGroup)(objectclass=groupOfNames))'),
+                          group, self._raise(ldap.NO_SUCH_OBJECT, error))
+
+    def create_group(self, name, gid=None, members=None, groupofnames=False):
+        """
+        Resolves to the new Group, see Directory.create_group
+        """
+        directory = self.directory
+        if groupofnames:
+            group_record = directory._group_record(name, members=members or [], groupofnames=True)
+        else:
+            group_record = directory._group_record(name, gid=directory._getgid(gid=gid), members=members)
+        group_dn = directory._group_dn(name)
+
+        def created(rdata):
+            directory._cache_group_type(name, dict(group_record))
+            return Group(name, group_dn, dict(group_record))
+
+        return self._send('add', (group_dn, group_record), created,
+                          self._raise(ldap.ALREADY_EXISTS, AlreadyExists("Group '%s' already exists" % name)))
+
+    def delete_group(self, name):
+        return self._send('delete', (self.directory._group_dn(name),),
+                          lambda rdata: self.directory._member_attributes.pop(name, None) and None,
+                          self._raise(ldap.NO_SUCH_OBJECT, NoSuchGroup("Group '%s' doesnt exist" % name)))
+
+    def create_user(self, name, uid=None, gid=None, groups=None, password=None, home=None,
+                    shell=None, mail=None, sshkey=None, hosts=None):
+        """
+        Resolves to the new User, see Directory.create_user
+
+        The groups are checked and the IDs allocated before returning. Once
+        the user entry is added its primary group and memberships are all
+        sent at once
+        """
+        directory = self.directory
+        groups = [g for g in groups or [] if g]
+        found = directory._groups(groups)
+        for group in groups:
+            if group not in found:
+                raise NoSuchGroup("Invalid group: %s" % group)
+        uid = directory._getuid(uid=uid)
+        gid = directory._getgid(gid=gid)
+        password = directory._getpass(password=password)
+        user_dn = directory._user_dn(name)
+        user_record = directory._user_record(name, uid, gid, password[1], home=home, shell=shell,
+                                             mail=mail, sshkey=sshkey, host=hosts)
+
+        # failed steps resolve to their error, so every step is collected
+        def group_added(rdata):
+            directory._member_attributes[name] = 'memberUid'
+
+        def group_failed(error):
+            if isinstance(error, ldap.ALREADY_EXISTS):
+                logger.warning("Group '%s' already exists" % name)
+                return None
+            return error
+
+        def member_failed(error):
+            if isinstance(error, ldap.TYPE_OR_VALUE_EXISTS):
+                return None
+            return error
+
+        def add_member(group):
+            return self._then(self._member_attribute(group), lambda attribute: self._send(
+                'modify', (directory._group_dn(group),
+                           [(ldap.MOD_ADD, attribute, [directory._member_value(attribute, name)])]),
+                None, member_failed))
+
+        def created(results):
+            errors = [(key, error) for key, error in
+                      zip([('group', name)] + [('member', group) for group in groups], results) if error]
+            user = User(name, user_dn, dict(user_record))
+            user.attributes['group'] = [group for group in groups if ('member', group) not in dict(errors)]
+            user.password = password[0]
+            if errors:
+                raise PartialFailure("User '%s' created, %d of its group operations failed" %
+                                     (name, len(errors)), user, errors)
+            return user
+
+        return self._then(
+            self._send('add', (user_dn, user_record), None,
+                       self._raise(ldap.ALREADY_EXISTS, AlreadyExists("User '%s' already exists" % name))),
+            lambda result: self._gather(
+                [self._send('add', (directory._group_dn(name), directory._group_record(name, gid=gid)),
+                            group_added, group_failed)] +
+                [add_member(group) for group in groups], created))
+
+    def update_user(self, name, uid=None, gid=None, password=None, home=None, shell=None,
+                    gecos=None, sshkey=None, hosts=None, mail=None):
+        """
+        Resolves to the modifications made, see Directory.update_user
+        """
+        directory = self.directory
+        changes = directory._user_changes(uid=uid, gid=gid, home=home, shell=shell, gecos=gecos,
+                                          sshkey=sshkey, hosts=hosts, mail=mail)
+        if password:
+            changes.append(('userPassword', [directory._getpass(password)[1]]))
+        user_dn = directory._user_dn(name)
+        error = NoSuchUser("No such user: '%s'" % name)
+
+        def modify(entries):
+            if not entries:
+                raise error
+            modlist = directory._modlist(entries[0][1], changes)
+            if not modlist:
+                return self._done(modlist)
+            return self._send('modify', (user_dn, modlist), lambda rdata: modlist,
+                              self._raise(ldap.TYPE_OR_VALUE_EXISTS,
+                                          LdapUserError("User '%s' has a duplicate host value" % name)))
+
+        return self._then(self._send('search_ext', (user_dn, ldap.SCOPE_BASE, '(objectclass=posixAccount)',
+                                                    [k for k, v in changes] or ['1.1']),
+                                     self._entries, self._raise(ldap.NO_SUCH_OBJECT, error)), modify)
+
+    def delete_user(self, name):
+        """
+        Delete a user, then its primary group
+        """
+        def group_missing(error):
+            if isinstance(error, ldap.NO_SUCH_OBJECT):
+                logger.warning("Group '%s' doesnt exist" % name)
+                return None
+            raise error
+
+        return self._then(
+            self._send('delete', (self.directory._user_dn(name),), None,
+                       self._raise(ldap.NO_SUCH_OBJECT, NoSuchUser("User '%s' doesnt exist" % name))),
+            lambda result: self._send('delete', (self.directory._group_dn(name),), None, group_missing))
+
+    def add_members(self, group, users):
+        """
+        Add users to a group with one modify per user, all in flight at once
+
+        Resolves to the users that were added
+        """
+        return self._change_members(group, users, ldap.MOD_ADD, ldap.TYPE_OR_VALUE_EXISTS)
+
+    def remove_members(self, group, users):
+        """
+        Resolves to the users that were removed from a group
+        """
+        return self._change_members(group, users, ldap.MOD_DELETE, ldap.NO_SUCH_ATTRIBUTE)
+
+    def set_members(self, group, users):
+        """
+        Resolves to the users that are now the only members of a group
+        """
+        directory = self.directory
+        users = directory._unique(users)
+        return self._then(self._member_attribute(group), lambda attribute: self._send(
+            'modify', (directory._group_dn(group),
+                       [(ldap.MOD_REPLACE, attribute,
+                         [directory._member_value(attribute, user) for user in users])]),
+            lambda rdata: users))
+
+    def _change_members(self, group, users, operation, skipped):
+        directory = self.directory
+        users = directory._unique(users)
+
+        def skip(error):
+            if isinstance(error, skipped):
+                return False
+            raise error
+
+        def send(attribute):
+            return self._gather(
+                [self._send('modify', (directory._group_dn(group),
+                                       [(operation, attribute, [directory._member_value(attribute, user)])]),
+                            lambda rdata: True, skip) for user in users],
+                lambda results: [user for user, changed in zip(users, results) if changed])
+
+        return self._then(self._member_attribute(group), send)
+
+    def _member_attribute(self, group):
+        """
+        Resolves to the attribute holding the members of group, cached by
+        the directory
+        """
+        directory = self.directory
+        if group in directory._member_attributes:
+            return self._done(directory._member_attributes[group])
+
+        def cache(entries):
+            directory._cache_group_type(group, entries[0][1])
+            return directory._member_attributes[group]
+
+        return self._send('search_ext', (directory._group_dn(group), ldap.SCOPE_BASE,
+                                         '(objectClass=*)', ['objectClass']), cache,
+                          self._raise(ldap.NO_SUCH_OBJECT, NoSuchGroup("Group not found '%s'" % group)))
+
+    def _send(self, method, arguments, convert=None, failed=None):
+        """
+        Send a request on the least busy connection
+
+        convert is called with the result data and returns the result of the
+        Pending, failed is called with an LDAPError and returns a result or
+        raises
+        """
+        index = min(range(len(self.connections)), key=lambda i: len(self.requests[i]))
+        pending = Pending(self)
+        try:
+            msgid = getattr(self.connections[index], method)(*arguments)
+        except ldap.LDAPError as e:
+            self._fail(pending, failed, e)
+            return pending
+        self.requests[index][msgid] = (pending, convert, failed)
+        return pending
+
+    def _collect(self, index):
+        conn = self.connections[index]
+        requests = self.requests[index]
+        completed = 0
+        for msgid in list(requests):
+            pending, convert, failed = requests[msgid]
+            try:
+                rtype, rdata = conn.result3(msgid, 1, 0)[:2]
+            except ldap.SERVER_DOWN as e:
+                # everything sent on this connection is lost
+                lost = requests.values()
+                requests.clear()
+                for pending, convert, failed in lost:
+                    pending._finish(error=e)
+                return completed + len(lost)
+            except ldap.LDAPError as e:
+                del requests[msgid]
+                self._fail(pending, failed, e)
+                completed += 1
+                continue
+            if rtype is None:
+                continue
+            del requests[msgid]
+            try:
+                pending._finish(convert(rdata) if convert else None)
+            except Exception as e:
+                pending._finish(error=e)
+            completed += 1
+        return completed
+
+    def _fail(self, pending, failed, error):
+        if failed:
+            try:
+                return pending._finish(failed(error))
+            except Exception as e:
+                error = e
+        pending._finish(error=error)
+
+    def _raise(self, error_class, error):
+        """
+        Return a failed handler raising error instead of error_class
+        """
+        def failed(e):
+            if isinstance(e, error_class):
+                raise error
+            raise e
+        return failed
+
+    def _entries(self, rdata):
+        return [(dn, attributes) for dn, attributes in rdata if dn is not None]
+
+    def _done(self, result):
+        pending = Pending(self)
+        pending._finish(result)
+        return pending
+
+    def _then(self, pending, next_step):
+        """
+        Return a Pending for the Pending next_step returns when called with
+        the result of pending
+        """
+        chained = Pending(self)
+
+        def done(pending):
+            if pending.error:
+                return chained._finish(error=pending.error)
+            try:
+                following = next_step(pending.result)
+            except Exception as e:
+                return chained._finish(error=e)
+            following.add_callback(lambda following: chained._finish(following.result, following.error))
+
+        pending.add_callback(done)
+        return chained
+
+    def _gather(self, pendings, combine):
+        """
+        Return a Pending done with combine called with the results of all
+        pendings, or with the first error
+        """
+        gathered = Pending(self)
+
+        def done(pending):
+            if gathered.done:
+                return
+            if pending.error:
+                return gathered._finish(error=pending.error)
+            if not [p for p in pendings if not p.done]:
+                try:
+                    gathered._finish(combine([p.result for p in pendings]))
+                except Exception as e:
+                    gathered._finish(error=e)
+
+        if not pendings:
+            gathered._finish(combine([]))
+        for pending in pendings:
+            pending.add_callback(done)
+        return gathered
+
+
+class FailoverConnection(object):
+    """
+    LDAP connection moving to the next server when the current one fails
+
+    groups is a list of (uris, race) pairs tried in order. With race the
+    servers of a group are connected to concurrently and the first one to
+    bind is used, otherwise they are tried one after another. connect is
+    called with an uri and returns a bound LDAPObject.
+
+    Reads failing with SERVER_DOWN are retried on the next server. Writes
+    may have reached the failed server before it went down, so they raise
+    and the next call connects to the next server, as do the result methods
+    whose requests went to the failed server. A failed server is skipped
+    for FAILED_SERVER_DELAY seconds
+    """
+    # methods safe to send again to another server
+    RETRIED = frozenset(['search', 'search_s', 'search_st', 'search_ext', 'search_ext_s',
+                         'compare', 'compare_s', 'compare_ext', 'compare_ext_s', 'whoami_s'])
+
+    def __init__(self, groups, connect):
+        self.groups = groups
+        self.connect = connect
+        self.uri = None
+        self.conn = None
+        # uri -> time it went down
+        self.failed = {}
+
+    def _open(self):
+        now = time.time()
+        for uris, race in self.groups:
+            available = [candidate for candidate in uris
+                         if now - self.failed.get(candidate, 0) > FAILED_SERVER_DELAY]
+            if not available:
+                continue
+            if race:
+                self.uri, self.conn = self._race(available)
+                if self.conn:
+                    self.failed.pop(self.uri, None)
+                    return
+            else:
+                for uri in available:
+                    try:
+                        self.uri, self.conn = uri, self.connect(uri)
+                        self.failed.pop(uri, None)
+                        return
+                    except ldap.SERVER_DOWN:
+                        logger.warning("LDAP server (%s) is down" % uri)
+                        self.failed[uri] = time.time()
+        servers = ', '.join(chain.from_iterable(uris for uris, race in self.groups))
+        self.failed = {}
+        raise ldap.SERVER_DOWN({'desc': "Can't contact LDAP server", 'info': servers})
+
+    def _race(self, uris):
+        results = Queue.Queue()
+
+        def attempt(uri):
+            try:
+                results.put((uri, self.connect(uri)))
+            except ldap.LDAPError:
+                results.put((uri, None))
+
+        def close(remaining):
+            for count in range(remaining):
+                uri, conn = results.get()
+                if conn:
+                    try:
+                        conn.unbind_s()
+                    except ldap.LDAPError:
+                        pass
+
+        for uri in uris:
+            thread = threading.Thread(target=attempt, args=(uri,))
+            thread.daemon = True
+            thread.start()
+        for count in range(len(uris)):
+            uri, conn = results.get()
+            if conn:
+                # the slower servers still connecting are unbound once bound
+                thread = threading.Thread(target=close, args=(len(uris) - count - 1,))
+                thread.daemon = True
+                thread.start()
+                return uri, conn
+            logger.warning("LDAP server (%s) is down" % uri)
+            self.failed[uri] = time.time()
+        return None, None
+
+    def __getattr__(self, name):
+        if self.conn is None:
+            self._open()
+        attribute = getattr(self.conn, name)
+        if not callable(attribute):
+            return attribute
+
+        def call(*args, **kwargs):
+            while True:
+                try:
+                    return getattr(self.conn, name)(*args, **kwargs)
+                except ldap.SERVER_DOWN:
+                    logger.warning("LDAP server (%s) is down" % self.uri)
+                    self.failed[self.uri] = time.time()
+                    self.conn = None
+                    if name not in self.RETRIED:
+                        raise
+                    self._open()
+        return call
+
+
+class Profile(object):
+    """
+    Record of the LDAP requests made while running a command
+
+    Every request is kept as a dict with its operation, base (or DN),
+    scope, filter, attributes, the number and approximate size in bytes of
+    the entries returned, its latency in milliseconds and the error it
+    failed with. Asynchronous requests
+    are timed until their result is collected
+    """
+    def __init__(self, command):
+        self.command = command
+        self.start = time.time()
+        self.records = []
+
+    def wrap(self, conn):
+        return ProfiledConnection(conn, self)
+
+    def add(self, operation, arguments, kwargs, elapsed, entries=(), error=None):
+        def argument(position, name):
+            if len(arguments) > position:
+                return arguments[position]
+            return kwargs.get(name)
+
+        record = {'operation': operation, 'base': argument(0, 'base'), 'ms': elapsed * 1000,
+                  'entries': len(entries), 'error': error and error.__class__.__name__,
+                  'bytes': sum(len(dn or '') + sum(len(k) + sum(len(v) for v in values)
+                                                   for k, values in (attributes or {}).iteritems())
+                               for dn, attributes in entries)}
+        if operation == 'search':
+            record.update([('scope', argument(1, 'scope')),
+                           ('filter', argument(2, 'filterstr') or '(objectClass=*)'),
+                           ('attributes', argument(3, 'attrlist'))])
+        self.records.append(record)
+
+    def totals(self):
+        """
+        Return the count, entries, bytes, total and maximum latency per
+        operation
+        """
+        totals = {}
+        for record in self.records:
+            total = totals.setdefault(record['operation'],
+                                      {'count': 0, 'entries': 0, 'bytes': 0, 'ms': 0.0, 'max_ms': 0.0})
+            total['count'] += 1
+            total['entries'] += record['entries']
+            total['bytes'] += record['bytes']
+            total['ms'] += record['ms']
+            total['max_ms'] = max(total['max_ms'], record['ms'])
+        return totals
+
+    def report(self, stream, slowest=5):
+        """
+        Write a summary table and the slowest requests to stream
+        """
+        totals = self.totals()
+        stream.write("\n%-12s %8s %10s %10s %12s %10s\n" % ('operation', 'count', 'entries', 'kbytes',
+                                                             'total ms', 'max ms'))
+        for operation in sorted(totals):
+            total = totals[operation]
+            stream.write("%-12s %8d %10d %10.1f %12.1f %10.1f\n" % (
+                operation, total['count'], total['entries'], total['bytes'] / 1024.0,
+                total['ms'], total['max_ms']))
+        stream.write("%-12s %8d %10d %10.1f %12.1f\n" % ('total', len(self.records),
+                                                         sum(r['entries'] for r in self.records),
+                                                         sum(r['bytes'] for r in self.records) / 1024.0,
+                                                         sum(r['ms'] for r in self.records)))
+        stream.write("wall time: %.1f ms\n" % ((time.time() - self.start) * 1000))
+        if self.records:
+            stream.write("\nslowest requests:\n")
+            for record in sorted(self.records, key=lambda r: -r['ms'])[:slowest]:
+                stream.write("%8.1f ms  %-7s %s %s %s\n" % (
+                    record['ms'], record['operation'], record['base'], record.get('filter', ''),
+                    record['error'] or ''))
+        stream.flush()
+
+    def dump(self, target):
+        """
+        Send the statistics of the command to target
+
+        udp://host:port sends StatsD counters and timers, any other target
+        is a file the requests are appended to as one JSON line
+        """
+        totals = self.totals()
+        wall_ms = (time.time() - self.start) * 1000
+        if target.startswith('udp://'):
+            host, port = target[len('udp://'):].rsplit(':', 1)
+            prefix = 'ldapuser.%s' % self.command
+            metrics = ['%s.time:%.3f|ms' % (prefix, wall_ms),
+                       '%s.requests:%d|c' % (prefix, len(self.records))]
+            for operation, total in sorted(totals.iteritems()):
+                metrics.extend(['%s.%s.count:%d|c' % (prefix, operation, total['count']),
+                                '%s.%s.entries:%d|c' % (prefix, operation, total['entries']),
+                                '%s.%s.bytes:%d|c' % (prefix, operation, total['bytes']),
+                                '%s.%s.time:%.3f|ms' % (prefix, operation, total['ms'])])
+            client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            try:
+                client.sendto("\n".join(metrics), (host, int(port)))
+            finally:
+                client.close()
         else:
-            clearTextPassword = "*UNCHANGED*"
+            with open(target, 'a') as f:
+                f.write(json.dumps({'command': self.command, 'time': self.start, 'ms': wall_ms,
+                                    'totals': totals, 'requests': self.records}) + "\n")
+
+
+class ProfiledConnection(object):
+    """
+    Connection wrapper recording the requests made through it in a Profile
+    """
+    # LDAPObject methods recorded -> (operation, asynchronous)
+    RECORDED = dict([
+        ('search_s', ('search', False)),
+        ('search_ext', ('search', True)),
+        ('add_s', ('add', False)),
+        ('add', ('add', True)),
+        ('modify_s', ('modify', False)),
+        ('modify', ('modify', True)),
+        ('delete_s', ('delete', False)),
+        ('delete', ('delete', True)),
+        ('whoami_s', ('whoami', False)),
+    ])
+
+    def __init__(self, conn, profile):
+        self.conn = conn
+        self.profile = profile
+        # msgid -> (operation, arguments, kwargs, start)
+        self.pending = {}
+
+    def __getattr__(self, name):
+        attribute = getattr(self.conn, name)
+        if name in ('result', 'result2', 'result3'):
+            return self._result(attribute)
+        if name not in self.RECORDED:
+            return attribute
+        operation, asynchronous = self.RECORDED[name]
+
+        def call(*args, **kwargs):
+            start = time.time()
+            try:
+                result = attribute(*args, **kwargs)
+            except ldap.LDAPError as e:
+                self.profile.add(operation, args, kwargs, time.time() - start, error=e)
+                raise
+            if asynchronous:
+                self.pending[result] = (operation, args, kwargs, start)
+            else:
+                self.profile.add(operation, args, kwargs, time.time() - start,
+                                 entries=result if operation == 'search' else ())
+            return result
+        return call
+
+    def _result(self, method):
+        def call(msgid=ldap.RES_ANY, *args, **kwargs):
+            try:
+                result = method(msgid, *args, **kwargs)
+            except ldap.LDAPError as e:
+                if msgid in self.pending:
+                    operation, arguments, kw, start = self.pending.pop(msgid)
+                    self.profile.add(operation, arguments, kw, time.time() - start, error=e)
+                raise
+            if result[0] is not None and msgid in self.pending:
+                operation, arguments, kw, start = self.pending.pop(msgid)
+                self.profile.add(operation, arguments, kw, time.time() - start,
+                                 entries=result[1] or () if operation == 'search' else ())
+            return result
+        return call
+
+
+class ConnectionPool(object):
+    """
+    Pool of bound ldapuser clients shared by the server threads
+
+    A client idle for more than check seconds is health checked with a
+    whoami request before it is handed out and rebound if the server went
+    away
+    """
+    def __init__(self, clients, check=30):
+        self.check = check
+        self.clients = Queue.Queue()
+        for cli in clients:
+            self.clients.put((cli, time.time()))
+
+    def get(self):
+        cli, last_used = self.clients.get()
+        if time.time() - last_used > self.check:
+            try:
+                cli.conn.whoami_s()
+            except ldap.LDAPError:
+                self.reconnect(cli)
+        cli._reset()
+        return cli
+
+    def put(self, cli):
+        self.clients.put((cli, time.time()))
+
+    def reconnect(self, cli):
+        logger.warning("Reconnecting to LDAP servers")
+        cli._connect()
 
-        if sshPublicKey:
-            try:
-                with open(sshPublicKey) as f:
-                    sshPublicKey = f.readlines()[0].strip()
-            except:
-                logger.error("Can't open ssh key file: %s" % sshPublicKey)
-                sys.exit(1)
 
-        user_dn = "uid=%s,%s" % (user, self.user_basedn)
-        try:
-            user_records = self.conn.search_s(user_dn, ldap.SCOPE_SUBTREE, '(objectclass=posixAccount)')
-        except ldap.NO_SUCH_OBJECT:
-            logger.error("No such user: '%s'" % user)
-            sys.exit(1)
-        new_user_record = []
-        for record in user_records[0]:
-            if isinstance(record, dict):
-                for k, v in record.iteritems():
-                        new_user_record.append((ldap.MOD_REPLACE, k, v))
-
-        for idx, record in enumerate(new_user_record):
-            if uidNumber and 'uidNumber' in record:
-                new_user_record[idx] = (ldap.MOD_REPLACE, 'uidNumber', uidNumber)
-            if gidNumber and 'gidNumber' in record:
-                new_user_record[idx] = (ldap.MOD_REPLACE, 'gidNumber', gidNumber)
-            if userPassword and 'userPassword' in record:
-                new_user_record[idx] = (ldap.MOD_REPLACE, 'userPassword', [userPassword[1]])
-            if homeDirectory and 'homeDirectory' in record:
-                new_user_record[idx] = (ldap.MOD_REPLACE, 'homeDirectory', homeDirectory)
-            if loginShell and 'loginShell' in record:
-                new_user_record[idx] = (ldap.MOD_REPLACE, 'loginShell', loginShell)
-            if givenName and 'givenName' in record:
-                new_user_record[idx] = (ldap.MOD_REPLACE, 'givenName', givenName)
-            if sshPublicKey and 'sshPublicKey' in record:
-                new_user_record[idx] = (ldap.MOD_REPLACE, 'sshPublicKey', sshPublicKey)
-            if host and 'host' in record:
-                new_user_record[idx] = (ldap.MOD_REPLACE, 'host', host)
-            if mail and 'mail' in record:
-                new_user_record[idx] = (ldap.MOD_REPLACE, 'mail', mail)
-
-        try:
-            self.conn.modify_s(user_dn, new_user_record)
-            logger.info("User '%s' updated successfuly with password: %s" %
-                        (user, clearTextPassword))
-            if groups:
-                group_basedn = self.group_basedn
-                if not '' in groups:
-                    for group in groups:
-                        group_dn = "cn=%s,%s" % (group, self.group_basedn)
-                        try:
-                            ret = self.conn.search_s(group_dn, ldap.SCOPE_SUBTREE,
-                                         '(objectClass=*)', ['member', 'memberUid'])
-                        except Exception:
-                            logger.error("Invalid group: %s" % group)
-                            sys.exit(1)
-
-                all_groups = self.conn.search_s(group_basedn, ldap.SCOPE_SUBTREE,
-                                     '(objectClass=*)', ['member', 'memberUid'])
-                for group in all_groups:
-                    members = group[1]
-                    group_dn = group[0]
-                    if members.get('member') or members.get('memberUid'):
-                        for k, v in members.iteritems():
-                            user_dn = "uid=%s,%s" % (user, self.user_basedn)
-                            if user in v or user_dn in v:
-                                group = group_dn.split(',')[0].split('cn=')[1]
-                                if group not in groups:
-                                    self.group_delete_member({'group': group, 'user': user})
-                for grp in groups:
-                    if grp != '':
-                        self.group_create_member({'group': grp, 'user': user})
-
-        except ldap.TYPE_OR_VALUE_EXISTS:
-            logger.error("User '%s' has a duplicate host value" % user)
+class ThreadLocalStream(object):
+    """
+    Stand-in for sys.stdout/sys.stderr sending each server thread's output
+    to the client it is serving
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
 
-    def user_delete(self, args):
-        """
-        Deletes a user
+    def write(self, data):
+        (getattr(self.local, 'target', None) or self.stream).write(data)
 
-        Usage: ldapuser user delete <user>
+    def flush(self):
+        (getattr(self.local, 'target', None) or self.stream).flush()
 
-        """
-        user = group = args.get('<user>')
-        user_dn = "uid=%s,%s" % (user, self.user_basedn)
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
 
-        try:
-            self.conn.delete_s(user_dn)
-            logger.info("User '%s' deleted successfully" % user)
-            self.group_delete({'<group>': group})
-        except ldap.NO_SUCH_OBJECT:
-            logger.error("User '%s' doesnt exist" % user)
-            sys.exit(1)
 
-    def user_show(self, args):
-        """
-        Create a new user
+class FrameWriter(object):
+    """
+    Buffers one output stream of a command and sends it as JSON frames
+    """
+    def __init__(self, wfile, name, size=8192):
+        self.wfile = wfile
+        self.name = name
+        self.size = size
+        self.buffer = []
+        self.length = 0
 
-        Usage: ldapuser user show [--json] [<user>]
+    def write(self, data):
+        self.buffer.append(data)
+        self.length += len(data)
+        if self.length >= self.size:
+            self.flush()
 
-        Options:
-        --json              Shows information in JSON format
+    def flush(self):
+        if self.buffer:
+            self.wfile.write(json.dumps({self.name: ''.join(self.buffer)}) + "\n")
+            self.wfile.flush()
+            self.buffer = []
+            self.length = 0
 
-        """
-        user = args.get('<user>')
-        if user:
-            user_dn = "uid=%s,%s" % (user, self.user_basedn)
-        else:
-            user_dn = self.user_basedn
+
+class CommandHandler(SocketServer.StreamRequestHandler):
+    """
+    Runs one forwarded command on a pooled client
+
+    The request is a JSON line {"argv": [...]}, the reply a series of
+    {"stdout": ...} and {"stderr": ...} lines closed by {"status": code}
+    """
+    def handle(self):
+        argv = [arg.encode('utf-8') for arg in json.loads(self.rfile.readline())['argv']]
+        stdout = FrameWriter(self.wfile, 'stdout')
+        stderr = FrameWriter(self.wfile, 'stderr')
+        sys.stdout.local.target = stdout
+        sys.stderr.local.target = stderr
+        cli = self.server.pool.get()
+        status = 0
         try:
-            users = self.conn.search_s(user_dn, ldap.SCOPE_SUBTREE, '(objectclass=posixAccount)')
-        except ldap.NO_SUCH_OBJECT:
-            logger.error("User not found '%s'" % user)
-            sys.exit(1)
+            run(argv, cli)
+        except SystemExit as e:
+            if isinstance(e.code, basestring):
+                stderr.write(e.code + "\n")
+                status = 1
+            else:
+                status = e.code or 0
+        except ldap.SERVER_DOWN as e:
+            logger.error("Cant connect to LDAP server (%s)" % ldap_error(e))
+            self.server.pool.reconnect(cli)
+            status = 1
+        except Exception as e:
+            logger.error(e)
+            status = 1
+        finally:
+            self.server.pool.put(cli)
+            stdout.flush()
+            stderr.flush()
+            sys.stdout.local.target = sys.stderr.local.target = None
+        self.wfile.write(json.dumps({'status': status}) + "\n")
 
-        logger.info(' Searching for user data...')
-        print ""
-        for idx, user in enumerate(users):
-            user_dn, user_attributes = user[0], user[1]
-            print "[%d] => NAME: %s, DN: %s" % (idx, user_dn.split(',')[0].split('uid=')[1], user_dn)
-            print "----------------------------------------------------------------------------------"
-            group_dn = self.group_basedn
-            groups = self.conn.search_s(group_dn, ldap.SCOPE_SUBTREE,
-                                        '(objectClass=*)', ['memberUid', 'member'])
-            user_attributes['group'] = []
-            for group in groups:
-                group_memberUid, group_member = group[1].get('memberUid'), group[1].get('member')
-                if group_memberUid:
-                    if user_attributes['uid'][0] in group_memberUid:
-                        user_attributes['group'].append(group[0].split(',')[0].split('cn=')[1])
-                if group_member:
-                    if "uid=%s,%s" % (user_attributes['uid'][0], self.user_basedn) in group_member:
-                        user_attributes['group'].append(group[0].split(',')[0].split('cn=')[1])
-
-            for attribute_key, attribute_value in user_attributes.iteritems():
-                if 'cn' in attribute_key or \
-                   'sn' in attribute_key or \
-                   'objectClass' in attribute_key:
-                    pass
-                else:
-                    if len(attribute_value) > 1:
-                        for attribute in attribute_value:
-                            print "%s: %s" % (attribute_key, attribute)
-                    elif len(attribute_value) == 1:
-                        print "%s: %s" % (attribute_key, attribute_value[0])
-                    else:
-                        print "%s: %s" % (attribute_key, '')
-            print ""
 
-    def group(self):
-        """
-        Valid commands are:
+class CommandServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
 
-        group create         Create a new group
-        group update         Updates a group
-        group delete         Deletes a group
-        group show           Shows info about a group(s)
-        group member         Manages group members
+    def __init__(self, path, pool):
+        self.pool = pool
+        old_umask = os.umask(0177)
+        try:
+            SocketServer.UnixStreamServer.__init__(self, path, CommandHandler)
+        finally:
+            os.umask(old_umask)
+        sys.stdout = ThreadLocalStream(sys.stdout)
+        sys.stderr = ThreadLocalStream(sys.stderr)
+        ch.stream = sys.stderr
 
-        Use `ldapuser help [command]` to learn more
-        """
-        sys.exit(1)
 
-    def group_member(self, args):
-        """
-        Manages group members
+def forward(path, argv, stream=None):
+    """
+    Run a command on the ldapuser server listening on path
 
-        Usage: ldapuser group member <group>
-               ldapuser group member [--add <user>] <group>
-               ldapuser group member [--del <user>] <group>
-               ldapuser group member [--update <user> ...] <group>
+    Returns the exit status of the command. Raises socket.error when the
+    server can't be reached
+    """
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.connect(path)
+    try:
+        client.sendall(json.dumps({'argv': argv}) + "\n")
+        for line in client.makefile('r'):
+            message = json.loads(line)
+            if 'status' in message:
+                return message['status']
+            for name, data in message.iteritems():
+                (stream or getattr(sys, name)).write(data.encode('utf-8'))
+    finally:
+        client.close()
+    return 1
 
-               <group> Shows group memberships
-               --add <user> <group>  Adds comma separated list of users to a group membership
-               --del <user> <group>  Removes comma separated list of users from a group membership
-               --update <user> <group> Updates membership
-        """
-        delete = args.get('--del')
-        add = args.get('--add')
-        update = args.get('--update')
-        group = args.get('<group>')
 
-        if add:
-            self.group_create_member({'group': group, 'user': add})
-        elif delete:
-            self.group_delete_member({'group': group, 'user': delete})
-        elif update:
-            self.group_update_member({'group': group, 'user': update})
-        else:
-            self.group_show_member({'group': group})
+# attribute=value filter expression, attribute is a name or an OID
+FILTER_EXPRESSION = re.compile(r'^([A-Za-z][A-Za-z0-9-]*|[0-9]+(?:\.[0-9]+)+)(>=|<=|=)(.+)$')
 
-    def group_create(self, args):
-        """
-        Create a new group
 
-        Usage: ldapuser group create [(--groupofnames --member USER ...) | --gid GID [--member USER ...]] <group>
+def attribute_filter(expressions):
+    """
+    Return an LDAP filter matching all the attribute=value expressions
 
-        --gid <gid>             Group ID
-        --groupofnames          Specifies groupOfNames type [default: posixGroup]
-        --member USER ...       Specifies members that belong to the group
+    Values are escaped except for the * wildcards of equality expressions,
+    attribute>=value and attribute<=value compare values. Returns None
+    without expressions and raises LdapUserError for malformed ones
+    """
+    filters = []
+    for expression in expressions or []:
+        match = FILTER_EXPRESSION.match(expression)
+        if not match:
+            raise LdapUserError("Invalid filter '%s', expected attribute=value" % expression)
+        attribute, operator, value = match.groups()
+        if operator == '=':
+            value = '*'.join(ldap.filter.escape_filter_chars(part)
+                             for part in re.sub(r'\*+', '*', value).split('*'))
+        else:
+            value = ldap.filter.escape_filter_chars(value)
+        filters.append('(%s%s%s)' % (attribute, operator, value))
+    if len(filters) > 1:
+        return '(&%s)' % ''.join(filters)
+    return filters[0] if filters else None
 
-        """
 
-        group = args.get('<group>')
-        gid = self._getgid(gid=args.get('--gid'))
-        groupOfNames = args.get('--groupofnames')
-        members = args.get('--member')
+# attribute, operator and value of a filter item
+FILTER_ITEM = re.compile(r'^([A-Za-z0-9.;-]+)(>=|<=|~=|=)(.*)$', re.S)
 
-        group_dn = "cn=%s,%s" % (group, self.group_basedn)
-        group_record = [('cn', [group])]
-        if groupOfNames:
-            group_record.append(('objectClass', ['top', 'groupOfNames']))
-            group_record.append(('member', ["uid=%s,%s" % (member, self.user_basedn) for member in members]))
-        else:
-            group_record.append(('objectClass', ['top', 'posixGroup']))
-            group_record.append(('gidNumber', [gid]))
-            if members:
-                group_record.append(('memberUid', members))
+# attributes whose values are indexed by Snapshot, lowercased
+SNAPSHOT_INDEXED = set(['uid', 'cn', 'uidnumber', 'gidnumber', 'memberuid', 'member', 'host'])
 
-        try:
-            self.conn.add_s(group_dn, group_record)
-            logger.info("Group '%s' created successfully" % group)
-        except ldap.ALREADY_EXISTS:
-            logger.error("Group '%s' already exists" % group)
 
-    def group_delete(self, args):
-        """
-        Deletes a group
+def parse_filter(filterstr):
+    """
+    Parse an LDAP filter into nested tuples for match_filter
 
-        Usage: ldapuser group delete <group>
+    & and | become (operator, [operands]), ! becomes ('!', operand) and
+    items (operator, lowercased attribute, escaped value). Raises
+    LdapUserError for malformed filters
+    """
+    filterstr = filterstr.strip()
+    if not filterstr.startswith('('):
+        filterstr = '(%s)' % filterstr
+    try:
+        node, end = _parse_filter(filterstr, 0)
+    except (IndexError, ValueError):
+        end = None
+    if end != len(filterstr):
+        raise LdapUserError("Invalid filter '%s'" % filterstr)
+    return node
 
-        """
-        group = args.get('<group>')
-        group_dn = "cn=%s,%s" % (group, self.group_basedn)
 
-        try:
-            self.conn.delete_s(group_dn)
-            logger.info("Group '%s' deleted successfully" % group)
-        except ldap.NO_SUCH_OBJECT:
-            logger.error("Group '%s' doesnt exist" % group)
+def _parse_filter(filterstr, i):
+    # filterstr[i] is the opening parenthesis of a filter
+    i += 1
+    if filterstr[i] in '&|':
+        operator, operands = filterstr[i], []
+        i += 1
+        while filterstr[i] == '(':
+            node, i = _parse_filter(filterstr, i)
+            operands.append(node)
+        return (operator, operands), filterstr.index(')', i) + 1
+    if filterstr[i] == '!':
+        node, i = _parse_filter(filterstr, i + 1)
+        return ('!', node), filterstr.index(')', i) + 1
+    end = filterstr.index(')', i)
+    attribute, operator, value = FILTER_ITEM.match(filterstr[i:end]).groups()
+    return (operator, attribute.lower(), value), end + 1
 
-    def group_update(self, args):
-        """
-        Updates a  group
 
-        Usage: ldapuser group update [options] <group>
+def unescape_filter_value(value):
+    return re.sub(r'\\([0-9a-fA-F]{2})', lambda m: chr(int(m.group(1), 16)), value)
 
-        --gid <gid>             Group ID
 
-        """
-        group = args.get('<group>')
-        gid = args.get('--gid')
+def match_filter(node, attributes):
+    """
+    Return whether attributes, keyed by lowercased name, match a filter
+    parsed by parse_filter
 
-        group_dn = "cn=%s,%s" % (group, self.group_basedn)
-        group_record = [(ldap.MOD_REPLACE, 'objectClass', ['top', 'posixGroup']),
-                        (ldap.MOD_REPLACE, 'cn', [group])]
-        try:
-            res = self.conn.search_s(group_dn, ldap.SCOPE_SUBTREE, '(objectclass=posixGroup)')
-        except ldap.NO_SUCH_OBJECT:
-            logger.error("Group not found '%s'" % group)
-            sys.exit(1)
-        for k, v in res[0][1].iteritems():
-            if k != 'objectClass' and k != 'cn':
-                if gid:
-                    if k != 'gidNumber':
-                        group_record.append((ldap.MOD_REPLACE, k, v))
-                    else:
-                        group_record.append((ldap.MOD_REPLACE, k, v))
-        if gid:
-            group_record.append((ldap.MOD_REPLACE, 'gidNumber', [gid]))
+    Values compare without case, as numbers when both are numbers
+    """
+    operator = node[0]
+    if operator == '&':
+        return all(match_filter(operand, attributes) for operand in node[1])
+    if operator == '|':
+        return any(match_filter(operand, attributes) for operand in node[1])
+    if operator == '!':
+        return not match_filter(node[1], attributes)
+    operator, attribute, value = node
+    values = attributes.get(attribute, [])
+    if operator == '=' and value == '*':
+        return bool(values)
+    if operator == '=' and '*' in value:
+        pattern = re.compile('.*'.join(re.escape(unescape_filter_value(part))
+                                       for part in value.split('*')) + '$', re.I | re.S)
+        return any(pattern.match(v) for v in values)
+    value = unescape_filter_value(value).lower()
 
-        try:
-            self.conn.modify_s(group_dn, group_record)
-            logger.info("Group '%s' modified successfully" % group)
-        except Exception as e:
-            logger.error("Error modyfing group '%s' '%s'" % (group,e ))
+    def compare(stored):
+        stored = stored.lower()
+        if stored.isdigit() and value.isdigit():
+            return cmp(int(stored), int(value))
+        return cmp(stored, value)
 
-    def group_show(self, args):
-        """
-        Shows group information
+    if operator == '>=':
+        return any(compare(v) >= 0 for v in values)
+    if operator == '<=':
+        return any(compare(v) <= 0 for v in values)
+    return any(compare(v) == 0 for v in values)
 
-        Usage: ldapuser group show [--json] [<group>]
 
-        Options:
-        --json              Shows information in JSON format
+def host_matches(value, pattern):
+    """
+    Return whether a host value grants access to the hosts matching pattern
 
-        """
-        group = args.get('<group>')
-        if group:
-            group_dn = "cn=%s,%s" % (group, self.group_basedn)
-        else:
-            group_dn = self.group_basedn
-        try:
-            group = self.conn.search_s(group_dn, ldap.SCOPE_SUBTREE, '(|(objectclass=posixGroup)(objectclass=groupOfNames))')
-        except ldap.NO_SUCH_OBJECT:
-            logger.error("Group not found '%s'" % group)
-            sys.exit(1)
+    Host names match without case, as the server does, and the value *
+    matches every host
+    """
+    return value == '*' or fnmatchcase(value.lower(), pattern.lower())
 
-        logger.info('Searching for group data...')
-        print ""
-        for idx, group in enumerate(group):
-            group_dn, group_attributes = group[0], group[1]
-            print "[%d] => NAME: %s, DN: %s" % (idx, group_dn.split(',')[0].split('cn=')[1], group_dn)
-            print "----------------------------------------------------------------------------------"
-
-            for attribute_key, attribute_value in group_attributes.iteritems():
-                if 'cn' in attribute_key or \
-                   'sn' in attribute_key:
-                    pass
-                else:
-                    if len(attribute_value) > 1:
-                        for attribute in attribute_value:
-                            print "%s: %s" % (attribute_key, attribute)
-                    elif len(attribute_value) == 1:
-                        print "%s: %s" % (attribute_key, attribute_value[0])
-                    else:
-                        print "%s: %s" % (attribute_key, '')
-            print ""
 
-    def group_create_member(self, args):
-        """
-        Creates a new memberUid entry in a group(s)
+def dn_key(dn):
+    """
+    Return the normalized form of a DN used to sort and compare entries
+    """
+    return ','.join('='.join(part.strip() for part in rdn.split('=', 1))
+                    for rdn in dn.lower().split(','))
 
-        """
-        group = args.get('group')
-        member = args.get('user')
-        group_dn = "cn=%s,%s" % (group, self.group_basedn)
-        try:
-            try:
-                members = self.conn.search_s(group_dn, ldap.SCOPE_SUBTREE,
-                                        '(objectClass=*)', ['memberUid', 'member'])[0][1]['memberUid']
-                members.append(member)
-                group_record = [(ldap.MOD_REPLACE, 'objectClass', ['top', 'posixGroup']),
-                                (ldap.MOD_REPLACE, 'cn', [group]),
-                                (ldap.MOD_REPLACE, 'memberUid', list(set(members)))]
-            except:
-                members = self.conn.search_s(group_dn, ldap.SCOPE_SUBTREE,
-                                         '(objectClass=*)', ['memberUid', 'member'])[0][1]['member']
-                member_dn = "uid=%s,%s" % (member, self.user_basedn)
-                members.append(member_dn)
-                group_record = [(ldap.MOD_REPLACE, 'objectClass', ['top', 'groupOfNames']),
-                                (ldap.MOD_REPLACE, 'cn', [group]),
-                                (ldap.MOD_REPLACE, 'member', list(set(members)))]
-        except ldap.NO_SUCH_OBJECT:
-            logger.error("Adding member to a group - group (%s) does not exit." % group)
-            sys.exit(1)
 
-        try:
-            self.conn.modify_s(group_dn, group_record)
-            logger.info("Added '%s' to group '%s'" % (member, group))
-        except Exception as e:
-            logger.error("Error adding '%s' to a group '%s': '%s'" % (member, group, e))
+def diff_entries(old, new):
+    """
+    Compare two iterators of (dn, attributes) sorted by DN
 
-    def group_delete_member(self, args):
-        """
-        Deletes a member from the group
-        """
-        group = args.get('group')
-        member = args.get('user')
-        group_dn = "cn=%s,%s" % (group, self.group_basedn)
-        try:
-            try:
-                members = self.conn.search_s(group_dn, ldap.SCOPE_SUBTREE,
-                                         '(objectClass=*)', ['memberUid', 'member'])[0][1]['memberUid']
-                members.remove(member)
-                group_record = [(ldap.MOD_REPLACE, 'objectClass', ['top', 'posixGroup']),
-                        (ldap.MOD_REPLACE, 'cn', [group]),
-                        (ldap.MOD_REPLACE, 'memberUid', list(set(members)))]
-
-            except:
-                members = self.conn.search_s(group_dn, ldap.SCOPE_SUBTREE,
-                                         '(objectClass=*)', ['memberUid', 'member'])[0][1]['member']
-                member_dn = "uid=%s,%s" % (member, self.user_basedn)
-                members.remove(member_dn)
-                group_record = [(ldap.MOD_REPLACE, 'objectClass', ['top', 'groupOfNames']),
-                        (ldap.MOD_REPLACE, 'cn', [group]),
-                        (ldap.MOD_REPLACE, 'member', list(set(members)))]
+    Yields (change, dn, removed, added) where change is + for entries only
+    in new, - for entries only in old and ~ for changed entries; removed
+    and added list the differing (attribute, value) pairs
+    """
+    old_entry = next(old, None)
+    new_entry = next(new, None)
+    while old_entry or new_entry:
+        old_key = old_entry and dn_key(old_entry[0])
+        new_key = new_entry and dn_key(new_entry[0])
+        if new_entry is None or (old_entry and old_key < new_key):
+            yield '-', old_entry[0], _values(old_entry[1]), []
+            old_entry = next(old, None)
+        elif old_entry is None or new_key < old_key:
+            yield '+', new_entry[0], [], _values(new_entry[1])
+            new_entry = next(new, None)
+        else:
+            old_values = set(_values(old_entry[1]))
+            new_values = set(_values(new_entry[1]))
+            if old_values != new_values:
+                yield ('~', new_entry[0], sorted(old_values - new_values),
+                       sorted(new_values - old_values))
+            old_entry = next(old, None)
+            new_entry = next(new, None)
 
-        except ldap.NO_SUCH_OBJECT:
-            logger.error("Deleting member from a group - group (%s) does not exit." % group)
 
-        try:
-            self.conn.modify_s(group_dn, group_record)
-            logger.info("Deleted '%s' from a group '%s'" % (member, group))
-        except Exception:
-            logger.error("Error deleting '%s' from a group '%s'" % (member, group))
+def _values(attributes):
+    # attribute names compare without case but are shown as found
+    return sorted((CaseInsensitive(attribute), value) for attribute, values in attributes.iteritems()
+                  for value in values)
 
-    def group_update_member(self, args):
-        """
-        Updates group memberUid attribute
-        """
-        group = args.get('group')
-        members = args.get('user')
-        group_dn = "cn=%s,%s" % (group, self.group_basedn)
-        try:
-            group_record = [(ldap.MOD_REPLACE, 'objectClass', ['top', 'posixGroup']),
-                        (ldap.MOD_REPLACE, 'cn', [group]),
-                        (ldap.MOD_REPLACE, 'memberUid', list(set(members)))]
-            self.conn.modify_s(group_dn, group_record)
-            logger.info("Updated members of '%s'. Current members" % group)
-            for idx, member in enumerate(members):
-                print "[%s] '%s'" % (idx, member)
-        except:
-            members = ["uid=%s,%s" % (user, self.user_basedn) for user in members]
-            group_record = [(ldap.MOD_REPLACE, 'objectClass', ['top', 'groupOfNames']),
-                        (ldap.MOD_REPLACE, 'cn', [group]),
-                        (ldap.MOD_REPLACE, 'member', list(set(members)))]
-            self.conn.modify_s(group_dn, group_record)
-            logger.info("Updated members of '%s'. Current members:" % group)
-            for idx, member in enumerate(members):
-                print "[%s] '%s'" % (idx, member)
 
+class CaseInsensitive(str):
+    """
+    String comparing and hashing without case
+    """
+    def __eq__(self, other):
+        return self.lower() == other.lower()
 
+    def __ne__(self, other):
+        return not self == other
 
-    def group_show_member(self, args):
-        """
-        Shows members of a group
-        """
-        group = args.get('group')
-        group_dn = "cn=%s,%s" % (group, self.group_basedn)
-        try:
-            members = self.conn.search_s(group_dn, ldap.SCOPE_SUBTREE,
-                                     '(objectClass=*)', ['memberUid'])[0][1]['memberUid']
-        except:
-            members = self.conn.search_s(group_dn, ldap.SCOPE_SUBTREE,
-                                     '(objectClass=*)', ['member'])[0][1]['member']
-        logger.info("Searching group '%s'. Current members:" % group)
-        for idx, member in enumerate(members):
-            print "[%s] '%s'" % (idx, member)
+    def __lt__(self, other):
+        return self.lower() < other.lower()
 
+    def __hash__(self):
+        return hash(self.lower())
 
-    def _getuid(self, uid=None):
-        """
-        Return valid UID
 
-        If no UID provided use the last available one
-        Raise an exception if provided UID already exists
-        """
-        users = self.conn.search_s(self.user_basedn,
-                                   ldap.SCOPE_SUBTREE,
-                                   'objectClass=posixAccount',
-                                   ['uidNumber'])
-        uids = []
-        minuid = int(getattr(self, 'user_minuid', 1500))
-        maxuid = int(getattr(self, 'user_maxuid', 2000))
-        if uid:
-            uid = int(uid)
-            if minuid < uid < maxuid:
-                for dn, u in users:
-                    if str(uid) in u['uidNumber']:
-                        # UID already exists - rise exception
-                        raise Exception("UID (%s) already exists" % uid)
-                return str(uid)
-            else:
-                raise Exception("Invalid UID: %s, Valid range: %s..%s" % (uid, minuid, maxuid))
-        else:
-            for dn, uid  in users:
-                uid = int(uid['uidNumber'][0])
-                if minuid < uid < maxuid:
-                    uids.append(uid)
-            uid = minuid if len(uids) == 0 else sorted(uids)[-1] + 1
-            return str(uid)
+def utf8(value):
+    """
+    Return value with the unicode strings in it, in nested dicts and lists
+    too, encoded to UTF-8 str as python-ldap expects in modlists
+    """
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, dict):
+        return dict((utf8(k), utf8(v)) for k, v in value.iteritems())
+    if isinstance(value, list):
+        return [utf8(item) for item in value]
+    return value
 
-    def _getgid(self, gid=None):
-        """
-        Return valid GID
 
-        If no GID provided use the last available one
-        """
-        groups = self.conn.search_s(self.group_basedn,
-                                    ldap.SCOPE_SUBTREE,
-                                    'objectClass=posixGroup',
-                                    ['gidNumber'])
-        gids = []
-        mingid = int(getattr(self, 'user_mingid', 1500))
-        maxgid = int(getattr(self, 'user_maxgid', 2000))
-        if gid:
-            gid = int(gid)
-            if mingid < gid < maxgid:
-                return str(gid)
-            else:
-                raise Exception("Invalid GID: %s, Valid range: %s..%s" % (gid, mingid, maxgid))
-        else:
-            for dn, gid in groups:
-                gid = int(gid['gidNumber'][0])
-                if mingid < gid < maxgid:
-                    gids.append(gid)
-            gid = mingid if len(gids) == 0 else sorted(gids)[-1] + 1
-            return str(gid)
+def ldif_value(attribute, value):
+    """
+    Return an attribute value as an LDIF line, base64 encoded unless printable
+    """
+    if value and all(32 <= ord(c) < 127 for c in value) and value[0] not in ' :<':
+        return "%s: %s" % (attribute, value)
+    return "%s:: %s" % (attribute, base64.b64encode(value))
 
-    def _getpass(self, password=None, size=9, chars=ascii_lowercase + ascii_uppercase + digits):
-        if not password:
-            password = ''.join(choice(chars) for x in range(size))
-        salt = os.urandom(4)
-        h = hashlib.sha1(password)
-        h.update(salt)
-        return password, '{SSHA}' + base64.encodestring(h.digest() + salt)[:-1]
 
-    def _gethosts(self, host=None):
-        for h in host:
-            if h and (h.startswith('/') or h.startswith('./')):
-                try:
-                    host_file = open(h)
-                except IOError:
-                    logger.error("Can't open host file: %s" % host)
-                    sys.exit(1)
-                hosts = []
-                for line in host_file.readlines():
-                    hosts.append(line.rstrip())
-                return hosts
-            elif h and ',' in host:
-                return h.split(',')
-            else:
-                return host
-        return None
+def ldap_error(e):
+    """
+    Return a readable description of a python-ldap exception
+    """
+    info = e.args[0] if e.args and isinstance(e.args[0], dict) else {}
+    return ': '.join(str(info[k]) for k in ('desc', 'info') if info.get(k)) or str(e)
 
 
 def trim(docstring):
@@ -748,7 +4285,10 @@ USER_SHORTCUTS = dict([
     ('create', 'user:create'),
     ('update', 'user:update'),
     ('delete', 'user:delete'),
-    ('show', 'user:show')
+    ('show', 'user:show'),
+    ('hosts', 'user:hosts'),
+    # user_groups is the Directory method
+    ('groups', 'user:memberships'),
 ])
 
 GROUP_SHORTCUTS = dict([
@@ -759,31 +4299,66 @@ GROUP_SHORTCUTS = dict([
     ('member', 'group:member'),
 ])
 
+HOST_SHORTCUTS = dict([
+    ('show', 'host:show'),
+    ('index', 'host:index'),
+])
+
 SHORTCUTS = dict([
     ('user', USER_SHORTCUTS),
     ('group', GROUP_SHORTCUTS),
+    ('host', HOST_SHORTCUTS),
+])
+
+# commands that run without any arguments
+STANDALONE = ['serve', 'export', 'sync', 'check']
+
+# read-only commands served from the snapshot with --cached -> the options
+# that make them write
+CACHED = dict([
+    ('export', []),
+    ('diff', []),
+    ('export_maps', []),
+    ('keys', []),
+    ('check', ['--fix']),
+    ('user_show', []),
+    ('user_hosts', []),
+    ('user_memberships', []),
+    ('host_show', []),
+    ('host_index', []),
+    ('group_show', []),
+    ('group_member', ['--add', '--del', '--update']),
+])
+
+# commands whose name can't be used as a method name
+ALIASES = dict([
+    ('import', 'bulk_import'),
+    ('export-maps', 'export_maps'),
 ])
 
 
-def parse_args(cmd):
+def parse_args(cmd, argv=None):
     """
     Parse command-line args applying shortcuts and looking for help flags
     """
+    if argv is None:
+        argv = sys.argv[1:]
     if cmd == 'help':
         try:
-            cmd = sys.argv[2]
-            subcmd = sys.argv[3]
+            cmd = argv[1]
+            subcmd = argv[2]
         except IndexError:
             subcmd = None
         help_flag = True
     else:
         try:
-            cmd = sys.argv[1]
-            subcmd = sys.argv[2]
+            cmd = argv[0]
+            subcmd = argv[1]
             help_flag = False
         except IndexError:
             subcmd = None
-            help_flag = True
+            # commands without arguments still run when they need none
+            help_flag = cmd in SHORTCUTS or cmd not in STANDALONE
 
     # swap cmd with shortcut
     if cmd in SHORTCUTS:
@@ -791,6 +4366,8 @@ def parse_args(cmd):
             cmd = SHORTCUTS[cmd][subcmd]
         else:
             help_flag = True
+    elif cmd in ALIASES:
+        cmd = ALIASES[cmd]
 
     # convert : to _ for matching method names and docstrings
     if ':' in cmd:
@@ -801,39 +4378,116 @@ def parse_args(cmd):
 def _dispatch_cmd(method, args):
     try:
         method(args)
+    except ldap.SERVER_DOWN:
+        # let callers owning the connection reconnect
+        raise
     except Exception as e:
         logger.error(e)
         sys.exit(1)
 
 
-def main():
-    """
-    Create a client, parse the arguments received on the command line, and
-    call the appropriate method on the client.
+def run(argv, cli=None):
     """
+    Parse argv (without the program name) and call the appropriate method
+    on the client
 
-    cli = ldapuser()
-    args = docopt(__doc__, version='ldapuser CLI {}',
+    The client is only created (reading the configuration) once the command
+    line has been parsed, so help and usage errors never touch the directory
+    """
+    args = docopt(__doc__, argv=argv, version='ldapuser CLI {}'.format(__version__),
                   options_first=True)
+    # the command line without the global options
+    argv = [args['<command>']] + args['<args>']
 
     cmd = args['<command>']
-    cmd, help_flag = parse_args(cmd)
+    cmd, help_flag = parse_args(cmd, argv)
     # print help if it was asked for
     if help_flag:
-        if cmd != 'help' and cmd in dir(cli):
-            print(trim(getattr(cli, cmd).__doc__))
+        if cmd != 'help' and cmd in vars(ldapuser):
+            print(trim(getattr(ldapuser, cmd).__doc__))
             return
         docopt(__doc__, argv=['--help'])
-    # unless cmd needs to use sys.argv directly
-    if hasattr(cli, cmd):
-        method = getattr(cli, cmd)
-    else:
+    # unless cmd needs to use sys.argv directly, the Directory API
+    # methods inherited by ldapuser are not commands
+    if cmd not in vars(ldapuser):
         raise DocoptExit('Found no matching command, try `ldapuser help`')
-    docstring = trim(getattr(cli, cmd).__doc__)
+    docstring = trim(getattr(ldapuser, cmd).__doc__)
     if 'Usage: ' in docstring:
-            args.update(docopt(docstring))
-    # dispatch the CLI command
-    _dispatch_cmd(method, args)
+            args.update(docopt(docstring, argv=argv))
+    if cli is None:
+        cli = ldapuser()
+
+    stats = args.get('--stats') or getattr(cli, 'profile_stats', None)
+    profile = (args.get('--profile') or stats) and Profile(cmd)
+    use_cache = cmd != 'sync' and (args.get('--cached') or
+                                   getattr(cli, 'cache_enabled', 'no').lower() in ('yes', 'true', '1'))
+    # commands that write, or plan writes, never trust a stale snapshot
+    cached = use_cache and cmd in CACHED and not [option for option in CACHED[cmd] if args.get(option)]
+    if not profile and not use_cache:
+        # dispatch the CLI command
+        return _dispatch_cmd(getattr(cli, cmd), args)
+    conn, rconn = cli.conn, cli.rconn
+    if profile:
+        cli.conn = profile.wrap(conn)
+        cli.rconn = cli.conn if rconn is conn else profile.wrap(rconn)
+    snapshot = None
+    try:
+        if cached:
+            # reads go to the snapshot, writes and the reads they depend on
+            # still go to the providers
+            try:
+                snapshot = cli.open_snapshot()
+            except LdapUserError as e:
+                logger.error(e)
+                sys.exit(1)
+            cli.rconn = SnapshotConnection(snapshot)
+            if profile:
+                cli.rconn = profile.wrap(cli.rconn)
+        _dispatch_cmd(getattr(cli, cmd), args)
+    finally:
+        cli.conn, cli.rconn = conn, rconn
+        if snapshot:
+            snapshot.close()
+        elif use_cache:
+            # the snapshot has not seen what this command wrote
+            try:
+                cli.invalidate_snapshot()
+            except (LdapUserError, sqlite3.Error) as e:
+                logger.warning("Can't invalidate the snapshot: %s" % e)
+        if profile and args.get('--profile'):
+            profile.report(sys.stderr)
+        if profile and stats:
+            try:
+                profile.dump(stats)
+            except (IOError, socket.error) as e:
+                logger.warning("Can't write statistics to %s: %s" % (stats, e))
+
+
+def main():
+    """
+    Parse the arguments received on the command line and call the
+    appropriate method on a client.
+
+    When LDAPUSER_SOCKET points to a running `ldapuser serve` the command is
+    forwarded to it instead.
+    """
+    socket_path = os.environ.get('LDAPUSER_SOCKET')
+    if socket_path and sys.argv[1:2] != ['serve']:
+        try:
+            sys.exit(forward(socket_path, sys.argv[1:]))
+        except socket.error as e:
+            logger.warning("Can't reach ldapuser server (%s): %s, running locally" %
+                           (socket_path, e))
+
+    try:
+        run(sys.argv[1:])
+    except Exception as e:
+        # checked here rather than in an except clause so that help and
+        # usage exits don't import python-ldap
+        if not isinstance(e, ldap.SERVER_DOWN):
+            raise
+        logger.error("Cant connect to LDAP server (%s)" % ldap_error(e))
+        sys.exit(1)
 
 
 if __name__ == '__main__':